@@ -0,0 +1,78 @@
+"""
+Time and peak memory of the annotation checks of one group, the pdist/squareform and scikit-learn version against
+the shared KD-tree of annotation_qc, on random groups of growing size. Results of both are compared on the way.
+
+    python benchmarks/annotation_qc.py --sizes 1000 4000 16000
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.spatial.distance import pdist, squareform
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import KDTree, NearestNeighbors
+
+from batch_fit.annotation_qc import GroupIndex
+
+
+def matrix_checks(group, other, k):
+    distance_matrix = squareform(pdist(group))
+    mean_distance = np.mean(distance_matrix)
+    distances, _ = NearestNeighbors(n_neighbors=k).fit(group).kneighbors(group)
+    noise = DBSCAN(eps=1, min_samples=2).fit_predict(group) == -1
+    nearest, _ = KDTree(other).query(group)
+    return mean_distance, distances.mean(axis=1), noise, nearest[:, 0]
+
+
+def index_checks(group, other, k):
+    group_index = GroupIndex(group)
+    mean_distance, _ = group_index.distance_statistics()
+    avg_distances = group_index.mean_knn_distance(k, include_self=True)
+    noise = group_index.noise_mask(eps=1, min_samples=2)
+    nearest, _ = GroupIndex(other).nearest(group)
+    return mean_distance, avg_distances, noise, nearest
+
+
+def measure(function, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / (1024 * 1024)
+
+
+def main():
+    ar = argparse.ArgumentParser()
+    ar.add_argument('--sizes', type=int, nargs='+', default=[1000, 4000, 16000], help='Points per group')
+    ar.add_argument('--skip-matrix-above', type=int, default=20000,
+                    help='Largest group to run the distance matrix version on')
+    ar.add_argument('-k', type=int, default=5, help='Neighbours of the k-distance graph')
+    args = vars(ar.parse_args())
+
+    generator = np.random.default_rng(0)
+    print(f'{"points":>8} {"matrix s":>9} {"matrix MB":>10} {"index s":>8} {"index MB":>9}')
+    for size in args['sizes']:
+        group = generator.normal(scale=10.0, size=(size, 3))
+        other = group + generator.normal(scale=0.5, size=group.shape)
+
+        (mean_distance, avg_distances, noise, nearest), index_time, index_memory = \
+            measure(index_checks, group, other, args['k'])
+        if size > args['skip_matrix_above']:
+            print(f'{size:8d} {"-":>9} {"-":>10} {index_time:8.3f} {index_memory:9.1f}')
+            continue
+
+        expected, matrix_time, matrix_memory = measure(matrix_checks, group, other, args['k'])
+        print(f'{size:8d} {matrix_time:9.3f} {matrix_memory:10.1f} {index_time:8.3f} {index_memory:9.1f}')
+
+        # the distance mean is streamed exactly up to the default exact limit, sampled above it
+        assert np.isclose(mean_distance, expected[0], rtol=1e-6 if size <= 5000 else 1e-2)
+        assert np.allclose(avg_distances, expected[1])
+        assert np.array_equal(noise, expected[2])
+        assert np.allclose(nearest, expected[3])
+
+
+if __name__ == '__main__':
+    main()
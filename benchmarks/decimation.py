@@ -0,0 +1,68 @@
+"""
+Fit wall time against final RMS for a range of decimation spacings. Groups get their spacing as in the pipeline,
+from the file stem the group mapping of the config gives their name, so edge_* groups use the edge spacing. The
+default data file is a left lung without edges; pass a combined right lung file to decimate edges too.
+
+    python benchmarks/decimation.py --spacings 0 1 2 4 8 --settings fit_settings/settings_02.json
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from omegaconf import OmegaConf
+
+from batch_fit.core import BatchFit
+from batch_fit.data_combiner import write_ex
+from batch_fit.decimation import decimate_groups, group_spacing
+from batch_fit.ex_reader import read_ex_points
+
+
+ROOT = Path(__file__).parent.parent
+RESOURCES = ROOT / 'tests' / 'resources'
+
+
+def main():
+    ar = argparse.ArgumentParser()
+    ar.add_argument('-m', '--model', default=str(RESOURCES / 'lung_mesh.exf'), help='Scaffold model file')
+    ar.add_argument('-d', '--data', default=str(RESOURCES / 'hla-tlc_pred.exdata'), help='Combined data file')
+    ar.add_argument('-s', '--settings', default=str(ROOT / 'fit_settings' / 'settings_02.json'), help='Fit settings')
+    ar.add_argument('-c', '--config', default=str(ROOT / 'configs' / 'fit.yaml'),
+                    help='Config with the groups_right_lung mapping of file stems to group names')
+    ar.add_argument('--spacings', type=float, nargs='+', default=[0.0, 1.0, 2.0, 4.0, 8.0],
+                    help='Surface spacings; edge_* groups use a quarter of it')
+    args = vars(ar.parse_args())
+
+    points = read_ex_points(args['data'])
+    data = {group_name: points.coordinates[rows] for group_name, rows in points.groups.items()}
+    groups = OmegaConf.to_container(OmegaConf.load(args['config']).groups_right_lung)
+    stems = {group_name: stem for stem, group_name in groups.items()}
+    edge_groups = [group_name for group_name in data if stems.get(group_name, group_name).startswith('edge_')]
+    print(f'{len(data)} groups, {len(edge_groups)} edges')
+
+    print(f'{"spacing":>8} {"points":>8} {"decimate s":>11} {"fit s":>8} {"rms":>10} {"max error":>10}')
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_dir = Path(output_dir)
+        for spacing in args['spacings']:
+            start = time.perf_counter()
+            decimation = {'surface_spacing': spacing, 'edge_spacing': spacing / 4}
+            spacings = {group_name: group_spacing(stems.get(group_name, group_name), decimation) for group_name in data}
+            decimated, report = decimate_groups(data, spacings)
+            decimate_time = time.perf_counter() - start
+
+            data_file = output_dir / f'data_{spacing}.ex'
+            write_ex(data_file, decimated)
+
+            start = time.perf_counter()
+            batch_fit = BatchFit(Path(args['model']), data_file, output_dir / f'fit_{spacing}_')
+            batch_fit.load_fit_settings(Path(args['settings']))
+            batch_fit.run()
+            fit_time = time.perf_counter() - start
+            rms, max_error = batch_fit.get_total_rms()
+
+            points_out = sum(points_out for _, points_out in report.values())
+            print(f'{spacing:8.2f} {points_out:8d} {decimate_time:11.3f} {fit_time:8.2f} {rms:10.4f} {max_error:10.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+Throughput of the native EX point reader against the Zinc reader. Their results are compared in
+tests/test_ex_reader.py.
+
+    python benchmarks/ex_reader.py --repeat 10
+"""
+import argparse
+import time
+from pathlib import Path
+
+from batch_fit.ex_reader import parse_ex_points, read_ex_points_zinc
+
+
+RESOURCES = Path(__file__).parent.parent / 'tests' / 'resources'
+
+
+def throughput(reader, file_name: Path, repeat: int):
+    size_mb = file_name.stat().st_size / 1e6
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        reader(file_name, nodeset='datapoints')
+        timings.append(time.perf_counter() - start)
+    return size_mb / min(timings)
+
+
+def main():
+    ar = argparse.ArgumentParser()
+    ar.add_argument('-f', '--file', default=str(RESOURCES / 'hla-tlc_pred.exdata'), help='EX data file')
+    ar.add_argument('-r', '--repeat', type=int, default=10, help='Number of timed reads')
+    args = vars(ar.parse_args())
+    file_name = Path(args['file'])
+
+    print(f'native : {throughput(parse_ex_points, file_name, args["repeat"]):.1f} MB/s')
+    print(f'zinc   : {throughput(read_ex_points_zinc, file_name, args["repeat"]):.1f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
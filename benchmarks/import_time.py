@@ -0,0 +1,157 @@
+"""
+Import time of the batch_fit package and its entry points, as `python -X importtime` reports it, and the heavy
+dependencies every import pulls in.
+
+Each target is imported in a fresh interpreter --repeat times and the fastest cumulative import time is kept. A
+target fails when it loads one of the heavy packages it is not allowed to, when it is slower than --budget-ms, or,
+with --compare, when it is more than --tolerance times slower than in the earlier results. The exit status is non-zero
+on any failure, so the script can guard worker spawn latency in CI.
+
+    python benchmarks/import_time.py -o import_time_before.json
+    python benchmarks/import_time.py -o import_time_after.json --compare import_time_before.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+ROOT = Path(__file__).parent.parent
+
+# packages too slow to load for code paths that do not use them
+HEAVY = ('pandas', 'matplotlib', 'mpl_toolkits', 'sklearn', 'opencmiss', 'scaffoldfitter')
+
+# target module -> heavy packages it may load
+TARGETS = {
+    'batch_fit': (),
+    'main': (),
+    'batch_fit.manifest': (),
+    'batch_fit.scheduler': (),
+    'batch_fit.progress': (),
+    'batch_fit.results': (),
+    'batch_fit.work_queue': (),
+    'batch_fit.sweep': (),
+    'batch_fit.fit_output': (),
+    'batch_fit.ex_reader': (),
+    'batch_fit.point_cache': (),
+    'batch_fit.annotation_check': (),
+    'batch_fit.fix_annotations': (),
+    'batch_fit.pipeline': (),
+    'batch_fit.core': ('opencmiss', 'scaffoldfitter'),
+}
+
+_IMPORTTIME_PATTERN = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+
+def import_profile(module: str) -> dict:
+    """
+    Import a module in a fresh interpreter with -X importtime.
+
+    :return: dict with the cumulative import 'time' of the module in seconds, the top level 'packages' it loaded and
+    the 'slowest' modules by self time, or the 'error' if the import failed.
+    """
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join([str(ROOT / 'src'), str(ROOT)] +
+                                                ([environment['PYTHONPATH']] if environment.get('PYTHONPATH') else []))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=str(ROOT),
+                             env=environment, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    if process.returncode != 0:
+        return {'error': process.stderr.strip().splitlines()[-1]}
+
+    cumulative = dict()
+    self_times = dict()
+    for line in process.stderr.splitlines():
+        match = _IMPORTTIME_PATTERN.match(line)
+        if match is not None:
+            self_times[match.group(4)] = int(match.group(1)) * 1e-6
+            cumulative[match.group(4)] = int(match.group(2)) * 1e-6
+    slowest = sorted(self_times, key=self_times.get, reverse=True)[:10]
+    return {'time': cumulative.get(module, 0.0),
+            'packages': sorted({name.split('.')[0] for name in cumulative}),
+            'slowest': [[name, self_times[name]] for name in slowest]}
+
+
+def profile_target(module: str, repeat: int) -> dict:
+    profiles = [import_profile(module) for _ in range(repeat)]
+    failed = [profile for profile in profiles if 'error' in profile]
+    if failed:
+        return failed[0]
+    fastest = min(profiles, key=lambda profile: profile['time'])
+    fastest['times'] = [profile['time'] for profile in profiles]
+    return fastest
+
+
+def check_target(module: str, result: dict, budget: float = None, baseline: dict = None,
+                 tolerance: float = 1.5) -> list:
+    """
+    :return: the reasons the target fails, empty if it passes.
+    """
+    if 'error' in result:
+        return [f'import failed: {result["error"]}']
+    problems = list()
+    heavy = sorted(set(result['packages']) & set(HEAVY) - set(TARGETS.get(module, ())))
+    if heavy:
+        problems.append(f'loads {", ".join(heavy)}')
+    if budget is not None and result['time'] > budget:
+        problems.append(f'{result["time"] * 1e3:.0f} ms over the {budget * 1e3:.0f} ms budget')
+    if baseline is not None and 'time' in baseline and result['time'] > tolerance * baseline['time']:
+        problems.append(f'{result["time"] / baseline["time"]:.2f}x slower than the baseline')
+    return problems
+
+
+def main():
+    ar = argparse.ArgumentParser()
+    ar.add_argument('-t', '--targets', nargs='+', default=list(TARGETS), help='Modules to import')
+    ar.add_argument('-r', '--repeat', type=int, default=5, help='Imports per target, the fastest is kept')
+    ar.add_argument('--budget-ms', type=float, default=None, help='Maximum import time of every target')
+    ar.add_argument('--tolerance', type=float, default=1.5,
+                    help='Maximum slowdown against the --compare results before a target fails')
+    ar.add_argument('-o', '--output', default=f'import_time_{time.strftime("%Y%m%d-%H%M%S")}.json',
+                    help='JSON results file')
+    ar.add_argument('--compare', default=None, help='Earlier JSON results to compare with')
+    args = vars(ar.parse_args())
+
+    baseline = dict()
+    if args['compare']:
+        with open(args['compare'], 'r') as f:
+            baseline = json.load(f)['targets']
+    budget = None if args['budget_ms'] is None else args['budget_ms'] * 1e-3
+
+    results = dict()
+    failures = dict()
+    print(f'{"target":>28} {"ms":>8} {"vs base":>8}  heavy packages')
+    for module in args['targets']:
+        result = profile_target(module, args['repeat'])
+        results[module] = result
+        problems = check_target(module, result, budget, baseline.get(module), args['tolerance'])
+        if problems:
+            failures[module] = problems
+        if 'error' in result:
+            print(f'{module:>28} {"-":>8} {"-":>8}  {result["error"]}')
+            continue
+        ratio = f'{result["time"] / baseline[module]["time"]:.2f}x' \
+            if 'time' in baseline.get(module, dict()) and baseline[module]['time'] else '-'
+        heavy = ', '.join(package for package in result['packages'] if package in HEAVY) or '-'
+        print(f'{module:>28} {result["time"] * 1e3:8.1f} {ratio:>8}  {heavy}')
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'platform': {'python': platform.python_version(), 'system': platform.platform()},
+              'arguments': {key: value for key, value in args.items() if key not in ('output', 'compare')},
+              'targets': results,
+              'failures': failures}
+    with open(args['output'], 'w') as f:
+        json.dump(report, f, indent=4)
+
+    for module, problems in failures.items():
+        print(f'FAIL {module}: {"; ".join(problems)}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
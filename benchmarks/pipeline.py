@@ -0,0 +1,328 @@
+"""
+Stage timings and memory of the combine -> fit -> report pipeline on synthetic cohorts.
+
+Every cohort is generated from the scaffold: for each key of groups_right_lung in configs/fit.yaml, points are
+sampled on the surface (or, for edge_* groups, the lines) of the scaffold group of the same name and written to
+<subject>/<key>.exdata, with a random stretch, shift and noise per subject. The scaffold in tests/resources is a left
+lung whose right lung groups are empty, so a right lung group missing from the scaffold is sampled from its left lung
+counterpart, or from --fallback-group when there is none; which group every key was sampled from is recorded.
+
+Each cohort size runs in a process of its own, so the memory figures of one do not carry over into the next. The
+stages are timed per subject: read_single_group over all the subject's files, write_ex, BatchFit.__init__,
+BatchFit.run (with the settings loaded) and the RMS writeout into a results store, plus the cohort's CSV export.
+With --in-memory the combined points are handed to BatchFit directly and write_ex is left out. Results are written
+as JSON; pass an earlier file with --compare to print the change of every stage.
+
+    python benchmarks/pipeline.py --subjects 1 4 --points 200 1000 -o pipeline_before.json
+    python benchmarks/pipeline.py --subjects 1 4 --points 200 1000 -o pipeline_after.json --compare pipeline_before.json
+    python benchmarks/pipeline.py --in-memory -o pipeline_in_memory.json --compare pipeline_after.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from omegaconf import OmegaConf
+from opencmiss.zinc.context import Context
+from opencmiss.zinc.result import RESULT_OK
+
+from batch_fit.core import BatchFit
+from batch_fit.data_combiner import read_single_group, write_ex
+from batch_fit.results import ResultsStore
+from batch_fit.scheduler import peak_rss_mb, process_rss_mb, run_parallel
+
+
+ROOT = Path(__file__).parent.parent
+RESOURCES = ROOT / 'tests' / 'resources'
+STAGES = ('read_single_group', 'write_ex', 'BatchFit.__init__', 'BatchFit.run', 'rms_writeout')
+
+
+class SurfaceSampler:
+    """
+    Random points on the groups of a scaffold, evaluated with Zinc at random element locations. Elements are picked
+    in proportion to the area (length for lines) of the polygon through their corners, so points spread roughly
+    evenly over a group.
+    """
+
+    def __init__(self, model_file: Path, fallback_group: str):
+        self._context = Context('Synthetic cohort')
+        region = self._context.getDefaultRegion()
+        result = region.readFile(str(model_file))
+        assert result == RESULT_OK, 'Failed to load model file ' + str(model_file)
+        self._fieldmodule = region.getFieldmodule()
+        self._fieldcache = self._fieldmodule.createFieldcache()
+        self._coordinates = self._fieldmodule.findFieldByName('coordinates')
+        self._fallback_group = fallback_group
+        self._elements = dict()
+
+    def _evaluate(self, element, xi):
+        self._fieldcache.setMeshLocation(element, xi)
+        _, x = self._coordinates.evaluateReal(self._fieldcache, 3)
+        return x
+
+    def _group_elements(self, group_name: str, dimension: int):
+        """
+        :return: elements of the group's mesh of the given dimension and their sampling weights, or None if the
+        scaffold has no such elements.
+        """
+        key = (group_name, dimension)
+        if key not in self._elements:
+            self._elements[key] = None
+            group = self._fieldmodule.findFieldByName(group_name).castGroup()
+            if group.isValid():
+                element_group = group.getFieldElementGroup(self._fieldmodule.findMeshByDimension(dimension))
+                if element_group.isValid() and element_group.getMeshGroup().getSize():
+                    elements = list()
+                    iterator = element_group.getMeshGroup().createElementiterator()
+                    element = iterator.next()
+                    while element.isValid():
+                        elements.append(element)
+                        element = iterator.next()
+                    corners = [[0.0], [1.0]] if dimension == 1 else [[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0]]
+                    weights = np.array([element_measure([self._evaluate(element, xi) for xi in corners])
+                                        for element in elements])
+                    self._elements[key] = (elements, weights / weights.sum())
+        return self._elements[key]
+
+    def source_group(self, group_name: str, dimension: int) -> str:
+        """
+        :return: the scaffold group the points of `group_name` are sampled from.
+        """
+        for candidate in (group_name, group_name.replace('right', 'left'), self._fallback_group):
+            if self._group_elements(candidate, dimension) is not None:
+                return candidate
+        raise ValueError(f'No {dimension}D elements in {group_name} or the fallback group {self._fallback_group}')
+
+    def sample(self, group_name: str, dimension: int, count: int, generator) -> np.ndarray:
+        elements, weights = self._group_elements(self.source_group(group_name, dimension), dimension)
+        chosen = generator.choice(len(elements), size=count, p=weights)
+        xi = generator.random((count, dimension))
+        return np.array([self._evaluate(elements[index], location.tolist()) for index, location in zip(chosen, xi)])
+
+
+def element_measure(corners) -> float:
+    """
+    :return: length of a line, or area of a quadrilateral as two triangles, through the given corner coordinates.
+    """
+    corners = np.asarray(corners)
+    if len(corners) == 2:
+        return float(np.linalg.norm(corners[1] - corners[0]))
+    return float(np.linalg.norm(np.cross(corners[1] - corners[0], corners[2] - corners[0])) / 2 +
+                 np.linalg.norm(np.cross(corners[2] - corners[0], corners[3] - corners[0])) / 2)
+
+
+def write_exdata(file_name: Path, points: np.ndarray):
+    """
+    Write points as the nodes of an EX file, in the layout of the annotation files of a subject.
+    """
+    with open(file_name, 'w') as f:
+        f.write('EX Version: 3\nRegion: /\n!#nodeset nodes\nDefine node template: node1\nShape. Dimension=0\n'
+                '#Fields=1\n1) coordinates, coordinate, rectangular cartesian, real, #Components=3\n'
+                ' x. #Values=1 (value)\n y. #Values=1 (value)\n z. #Values=1 (value)\nNode template: node1\n')
+        for identifier, xyz in enumerate(points, start=1):
+            f.write(f'Node: {identifier}\n' + ''.join(f' {value:24.15e}\n' for value in xyz))
+
+
+def generate_cohort(sampler: SurfaceSampler, groups: dict, cohort_dir: Path, subjects: int, points: int,
+                    noise: float, seed: int) -> dict:
+    """
+    Write `subjects` synthetic subjects with `points` points per group into cohort_dir.
+
+    :param noise: standard deviation of the point noise and of the per-subject stretch, relative to the size of
+    the scaffold.
+    :return: dict of group key to the scaffold group its points were sampled from.
+    """
+    generator = np.random.default_rng(seed)
+    sources = dict()
+    for subject in range(subjects):
+        subject_dir = cohort_dir / f'SYN{subject:04d}'
+        subject_dir.mkdir(parents=True)
+        sampled = dict()
+        for key, group_name in groups.items():
+            dimension = 1 if key.startswith('edge_') else 2
+            sources[key] = sampler.source_group(group_name, dimension)
+            sampled[key] = sampler.sample(group_name, dimension, points, generator)
+
+        all_points = np.concatenate(list(sampled.values()))
+        centre = all_points.mean(axis=0)
+        size = np.ptp(all_points, axis=0).max()
+        stretch = 1.0 + generator.normal(scale=noise, size=3)
+        shift = generator.normal(scale=noise * size, size=3)
+        for key, group_points in sampled.items():
+            moved = (group_points - centre) * stretch + centre + shift
+            write_exdata(subject_dir / f'{key}.exdata',
+                         moved + generator.normal(scale=noise * size, size=group_points.shape))
+    return sources
+
+
+def measure(stages: dict, stage: str, function, *args):
+    """
+    Run one stage and record its wall time, the resident set size after it and its change, and the peak resident
+    set size of the process so far.
+    """
+    rss_before = process_rss_mb(os.getpid())
+    start = time.perf_counter()
+    value = function(*args)
+    elapsed = time.perf_counter() - start
+    rss_after = process_rss_mb(os.getpid())
+    stages[stage] = {'time': elapsed,
+                     'rss_mb': rss_after,
+                     'rss_delta_mb': None if rss_before is None or rss_after is None else rss_after - rss_before,
+                     'peak_rss_mb': peak_rss_mb()}
+    return value
+
+
+def read_groups(subject_dir: Path, groups: dict) -> dict:
+    return {groups[ex_file.stem]: read_single_group(str(ex_file))
+            for ex_file in sorted(subject_dir.glob('*.exdata')) if ex_file.stem in groups}
+
+
+def create_batch_fit(model_file: Path, data_file: Path, output_dir: Path, cache_scaffold: bool, data: dict):
+    return BatchFit(model_file, data_file, output_dir / 'fit_', cache_scaffold=cache_scaffold, data=data)
+
+
+def fit(batch_fit: BatchFit, setting_file: Path):
+    batch_fit.load_fit_settings(setting_file)
+    batch_fit.run()
+
+
+def write_rms(results_store: ResultsStore, subject: str, batch_fit: BatchFit):
+    total_rms, max_error = batch_fit.get_total_rms()
+    results_store.append(subject, batch_fit.get_group_rms(), total_rms, max_error=max_error, setting_id='benchmark',
+                         steps=batch_fit.get_step_metrics())
+    return total_rms
+
+
+def run_cohort(model_file: Path, setting_file: Path, groups: dict, subjects: int, points: int, noise: float,
+               seed: int, fallback_group: str, work_dir: Path, cache_scaffold: bool, in_memory: bool) -> dict:
+    """
+    Generate a cohort and run every stage of the pipeline on each of its subjects.
+
+    :return: JSON-ready dict with the stage measurements of every subject and their totals.
+    """
+    cohort_dir = work_dir / f'cohort_{subjects}x{points}'
+    start = time.perf_counter()
+    sources = generate_cohort(SurfaceSampler(model_file, fallback_group), groups, cohort_dir, subjects, points,
+                              noise, seed)
+    generation_time = time.perf_counter() - start
+
+    results_store = ResultsStore(cohort_dir / 'results.sqlite')
+    subject_results = dict()
+    for subject_dir in sorted(path for path in cohort_dir.iterdir() if path.is_dir()):
+        stages = dict()
+        data = measure(stages, 'read_single_group', read_groups, subject_dir, groups)
+        data_file = subject_dir / f'{subject_dir.stem}_combined_lung_data.ex'
+        if not in_memory:
+            measure(stages, 'write_ex', write_ex, data_file, data)
+        output_dir = cohort_dir / 'fit' / subject_dir.stem
+        output_dir.mkdir(parents=True)
+        batch_fit = measure(stages, 'BatchFit.__init__', create_batch_fit, model_file, data_file, output_dir,
+                            cache_scaffold, data if in_memory else None)
+        measure(stages, 'BatchFit.run', fit, batch_fit, setting_file)
+        total_rms = measure(stages, 'rms_writeout', write_rms, results_store, subject_dir.stem, batch_fit)
+        subject_results[subject_dir.stem] = {'stages': stages, 'total_rms': total_rms,
+                                             'data_points': sum(len(group_points) for group_points in data.values())}
+        del batch_fit
+
+    export = dict()
+    measure(export, 'export_csv', results_store.export_csv, cohort_dir / 'rms.csv', 'benchmark')
+
+    totals = dict()
+    for stage in (stage for stage in STAGES if stage != 'write_ex' or not in_memory):
+        times = [result['stages'][stage]['time'] for result in subject_results.values()]
+        totals[stage] = {'total': sum(times), 'mean': float(np.mean(times)), 'min': min(times), 'max': max(times),
+                         'peak_rss_mb': max(result['stages'][stage]['peak_rss_mb'] or 0.0
+                                            for result in subject_results.values())}
+    return {'subjects': subjects, 'points_per_group': points, 'in_memory': in_memory,
+            'generation_time': generation_time,
+            'sampled_from': sources, 'stages': totals, 'export_csv': export['export_csv'],
+            'subject_results': subject_results}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=str(ROOT), stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_runs(runs: list, baseline: dict = None):
+    """
+    Print the mean time of every stage per cohort, with the ratio to the same cohort of the baseline if given.
+    """
+    baseline_runs = {(run['subjects'], run['points_per_group']): run for run in (baseline or dict()).get('runs', [])}
+    print(f'{"subjects":>8} {"points":>7} {"stage":>18} {"mean s":>9} {"peak MB":>8}' +
+          (f' {"vs base":>8}' if baseline else ''))
+    for run in runs:
+        base = baseline_runs.get((run['subjects'], run['points_per_group']))
+        for stage, totals in run['stages'].items():
+            line = f'{run["subjects"]:8d} {run["points_per_group"]:7d} {stage:>18} {totals["mean"]:9.3f} ' \
+                   f'{totals["peak_rss_mb"]:8.1f}'
+            if base is not None and base['stages'].get(stage, dict()).get('mean'):
+                line += f' {totals["mean"] / base["stages"][stage]["mean"]:7.2f}x'
+            print(line)
+
+
+def main():
+    ar = argparse.ArgumentParser()
+    ar.add_argument('-m', '--model', default=str(RESOURCES / 'lung_mesh.exf'), help='Scaffold model file')
+    ar.add_argument('-s', '--settings', default=str(ROOT / 'fit_settings' / 'settings_02.json'), help='Fit settings')
+    ar.add_argument('-c', '--config', default=str(ROOT / 'configs' / 'fit.yaml'),
+                    help='Config file holding groups_right_lung')
+    ar.add_argument('--subjects', type=int, nargs='+', default=[1, 4], help='Cohort sizes')
+    ar.add_argument('--points', type=int, nargs='+', default=[200, 1000], help='Points per group')
+    ar.add_argument('--noise', type=float, default=0.01, help='Noise and stretch, relative to the scaffold size')
+    ar.add_argument('--seed', type=int, default=0, help='Seed of the cohort generator')
+    ar.add_argument('--fallback-group', default='left lung surface',
+                    help='Scaffold group sampled for groups missing from the scaffold')
+    ar.add_argument('--no-cache-scaffold', action='store_true', help='Read the scaffold file for every subject')
+    ar.add_argument('--in-memory', action='store_true', help='Hand the combined points to BatchFit in memory')
+    ar.add_argument('-w', '--work-dir', default=None, help='Keep the cohorts and fit output here')
+    ar.add_argument('-o', '--output', default=f'pipeline_{time.strftime("%Y%m%d-%H%M%S")}.json',
+                    help='JSON file the results are written to')
+    ar.add_argument('--compare', default=None, help='Earlier JSON results to compare with')
+    args = vars(ar.parse_args())
+
+    model_file = Path(args['model']).resolve()
+    setting_file = Path(args['settings']).resolve()
+    groups = OmegaConf.to_container(OmegaConf.load(args['config']).groups_right_lung)
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        work_dir = Path(args['work_dir'] or temporary_dir).resolve()
+        jobs = {f'{subjects}x{points}': (model_file, setting_file, groups, subjects, points, args['noise'],
+                                         args['seed'], args['fallback_group'], work_dir, not args['no_cache_scaffold'],
+                                         args['in_memory'])
+                for subjects in args['subjects'] for points in args['points']}
+        runs = dict()
+        for result in run_parallel(run_cohort, jobs, 1):
+            if result.error is not None:
+                raise RuntimeError(f'Cohort {result.name} failed:\n{result.error}')
+            runs[result.name] = result.value
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'git_revision': git_revision(),
+              'platform': {'python': platform.python_version(), 'system': platform.platform(),
+                           'processor': platform.processor(), 'cpu_count': os.cpu_count()},
+              'arguments': {key: value for key, value in args.items() if key not in ('output', 'compare', 'work_dir')},
+              'runs': [runs[name] for name in jobs]}
+    output_path = Path(args['output'])
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    baseline = None
+    if args['compare']:
+        with open(args['compare'], 'r') as f:
+            baseline = json.load(f)
+    print_runs(report['runs'], baseline)
+    print(f'written to {output_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Conversion time of the cubic Hermite to quadratic Lagrange converter, checked against a nearest-node lookup: the
+Hermite geometry is evaluated at the 27 node locations of every element and all of them are matched to the converted
+nodes in one batched tree query.
+
+    python benchmarks/quad_lagrange.py --repeat 3
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from opencmiss.zinc.context import Context
+
+from batch_fit.cubichermite_to_quadlagrange import QUADRATIC_LAGRANGE_INDEXES, convert, create_middle_nodes
+
+
+RESOURCES = Path(__file__).parent.parent / 'tests' / 'resources'
+
+
+def evaluate_element_nodes(model_file: Path) -> np.ndarray:
+    """
+    :return: (elements, 27, 3) coordinates of the Hermite mesh at the quadratic Lagrange node locations.
+    """
+    context = Context('reference')
+    region = context.getDefaultRegion()
+    region.readFile(str(model_file))
+    field_module = region.getFieldmodule()
+    coordinates = field_module.findFieldByName('coordinates').castFiniteElement()
+    fieldcache = field_module.createFieldcache()
+    mesh3d = field_module.findMeshByDimension(3)
+
+    element_points = list()
+    element_iterator = mesh3d.createElementiterator()
+    element = element_iterator.next()
+    while element.isValid():
+        for index in QUADRATIC_LAGRANGE_INDEXES:
+            fieldcache.setMeshLocation(element, [i / 2 for i in index])
+            result, x = coordinates.evaluateReal(fieldcache, 3)
+            element_points.append(x)
+        element = element_iterator.next()
+    return np.asarray(element_points).reshape(-1, 27, 3)
+
+
+def main():
+    ar = argparse.ArgumentParser()
+    ar.add_argument('-m', '--model', default=str(RESOURCES / 'lung_mesh.exf'), help='Cubic Hermite model file')
+    ar.add_argument('-r', '--repeat', type=int, default=3, help='Number of conversions to time')
+    args = vars(ar.parse_args())
+    model_file = Path(args['model'])
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        timings = list()
+        for repeat in range(args['repeat']):
+            start = time.perf_counter()
+            convert(model_file, Path(output_dir) / f'quad_lagrange_{repeat}.exf')
+            timings.append(time.perf_counter() - start)
+
+    node_ids, points, elem_node_lists = create_middle_nodes(model_file)
+    elem_node_lists = np.asarray(elem_node_lists)
+    print(f'{len(elem_node_lists)} elements, {len(node_ids)} nodes')
+    print(f'convert: best {min(timings):.3f} s, mean {np.mean(timings):.3f} s over {len(timings)} runs')
+
+    start = time.perf_counter()
+    element_points = evaluate_element_nodes(model_file)
+    distances, rows = cKDTree(points['coordinates']).query(element_points.reshape(-1, 3))
+    lookup_time = time.perf_counter() - start
+    print(f'27-point evaluation and batched tree query: {lookup_time:.3f} s')
+
+    row_of = {node_id: row for row, node_id in enumerate(node_ids)}
+    assigned = points['coordinates'][np.vectorize(row_of.get)(elem_node_lists)]
+    errors = np.linalg.norm(assigned - element_points, axis=-1)
+    nearest_ids = node_ids[rows].reshape(elem_node_lists.shape)
+    mismatches = np.count_nonzero(nearest_ids != elem_node_lists)
+    print(f'max distance of an element node to its converted node {errors.max():.3e}, '
+          f'{mismatches} of {elem_node_lists.size} element nodes are not their nearest node '
+          f'(max nearest distance {distances.max():.3e})')
+    assert errors.max() < 1e-8, 'converted nodes do not match the Hermite geometry'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Registration runtime against point count: affine ICP alone and followed by the deformable CPD, on copies of a data
+file resampled to every size and moved by a known rotation, scaling and bend.
+
+    python benchmarks/registration.py --sizes 5000 20000 80000
+"""
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+from batch_fit.ex_reader import read_ex_points
+from batch_fit.registration import register_points
+
+
+RESOURCES = Path(__file__).parent.parent / 'tests' / 'resources'
+
+
+def deform(points: np.ndarray, bend: float) -> np.ndarray:
+    angle = np.radians(12.0)
+    rotation = np.array([[np.cos(angle), -np.sin(angle), 0.0], [np.sin(angle), np.cos(angle), 0.0], [0.0, 0.0, 1.0]])
+    centre = points.mean(axis=0)
+    height = (points[:, 2] - points[:, 2].min()) / np.ptp(points[:, 2])
+    bent = points.copy()
+    bent[:, 0] += bend * np.sin(np.pi * height)
+    return (bent - centre) @ rotation.T * 1.15 + centre + [15.0, -8.0, 4.0]
+
+
+def main():
+    ar = argparse.ArgumentParser()
+    ar.add_argument('-d', '--data', default=str(RESOURCES / 'hla-tlc_pred.exdata'), help='Data file')
+    ar.add_argument('--sizes', type=int, nargs='+', default=[5000, 20000, 80000], help='Points per cloud')
+    ar.add_argument('--bend', type=float, default=12.0, help='Amplitude of the non-rigid bend, in data units')
+    args = vars(ar.parse_args())
+
+    data = read_ex_points(args['data']).coordinates
+    generator = np.random.default_rng(0)
+    spacing = np.cbrt(np.prod(np.ptp(data, axis=0)) / len(data))
+
+    print(f'{"points":>8} {"icp s":>7} {"icp rms":>8} {"+cpd s":>7} {"+cpd rms":>9}')
+    for size in args['sizes']:
+        target = data[generator.integers(len(data), size=size)] + generator.normal(scale=0.1 * spacing, size=(size, 3))
+        source = deform(data[generator.integers(len(data), size=size)], args['bend'])
+
+        start = time.perf_counter()
+        rigid = register_points(source, target, mode='affine')
+        icp_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        deformable = register_points(source, target, mode='affine', deformable=True)
+        cpd_time = time.perf_counter() - start
+
+        print(f'{size:8d} {icp_time:7.2f} {rigid.rms:8.3f} {cpd_time:7.2f} {deformable.rms:9.3f}')
+
+
+if __name__ == '__main__':
+    main()
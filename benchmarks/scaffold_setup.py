@@ -0,0 +1,55 @@
+"""
+Per-subject setup time of BatchFit reading the scaffold from its file or from the in-memory buffer. Both parse the
+scaffold, so the difference is the file read only.
+
+    python benchmarks/scaffold_setup.py --repeat 5
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from batch_fit import core
+from batch_fit.core import BatchFit
+
+
+RESOURCES = Path(__file__).parent.parent / 'tests' / 'resources'
+
+
+def time_setup(model_file: Path, data_file: Path, output_dir: Path, repeat: int, cache_scaffold: bool):
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        BatchFit(model_file, data_file, output_dir / 'fit_', cache_scaffold=cache_scaffold)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    ar = argparse.ArgumentParser()
+    ar.add_argument('-m', '--model', default=str(RESOURCES / 'lung_mesh.exf'), help='Scaffold model file')
+    ar.add_argument('-d', '--data', default=str(RESOURCES / 'hla-tlc_pred.exdata'), help='Data file')
+    ar.add_argument('-r', '--repeat', type=int, default=5, help='Number of subjects to simulate')
+    args = vars(ar.parse_args())
+
+    model_file = Path(args['model'])
+    data_file = Path(args['data'])
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_dir = Path(output_dir)
+
+        uncached = time_setup(model_file, data_file, output_dir, args['repeat'], cache_scaffold=False)
+
+        core._scaffold_buffers.clear()
+        start = time.perf_counter()
+        core.load_scaffold_template(model_file)
+        template_time = time.perf_counter() - start
+        cached = time_setup(model_file, data_file, output_dir, args['repeat'], cache_scaffold=True)
+
+    print(f'model: {model_file.name}, data: {data_file.name}, subjects: {args["repeat"]}')
+    print(f'setup from file     : mean {sum(uncached) / len(uncached):.3f} s, min {min(uncached):.3f} s')
+    print(f'buffer load         : {template_time:.3f} s (once per process)')
+    print(f'setup from buffer   : mean {sum(cached) / len(cached):.3f} s, min {min(cached):.3f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Iterations and wall time of a warm-started fit against a cold start from the scaffold.
+
+A cold fit is run first and its output is used to warm start the same data again, the situation of a rerun with
+slightly changed settings. Pass --warm-data to warm start a different data set instead, e.g. the same subject at
+another lung volume. Both fits use convergence-controlled iterations, so the saving shows up as iterations skipped.
+
+    python benchmarks/warm_start.py --tolerance 1e-3
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from batch_fit.core import BatchFit, latest_fit_file
+
+
+ROOT = Path(__file__).parent.parent
+RESOURCES = ROOT / 'tests' / 'resources'
+
+
+def fit(model_file: Path, data_file: Path, settings_file: Path, output_dir: Path, tolerance: float,
+        warm_start_file: Path = None):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    batch_fit = BatchFit(model_file, data_file, output_dir / 'fit_', convergence_tolerance=tolerance,
+                         warm_start_file=warm_start_file)
+    batch_fit.load_fit_settings(settings_file)
+    batch_fit.run()
+    wall_time = time.perf_counter() - start
+    iterations = sum(step['iterations'] or 0 for step in batch_fit.get_step_metrics())
+    return wall_time, iterations, batch_fit.get_total_rms()[0]
+
+
+def main():
+    ar = argparse.ArgumentParser()
+    ar.add_argument('-m', '--model', default=str(RESOURCES / 'lung_mesh.exf'), help='Scaffold model file')
+    ar.add_argument('-d', '--data', default=str(RESOURCES / 'hla-tlc_pred.exdata'), help='Data file of the cold fit')
+    ar.add_argument('-w', '--warm-data', default=None, help='Data file of the warm fit, the cold fit data by default')
+    ar.add_argument('-s', '--settings', default=str(ROOT / 'fit_settings' / 'settings_02.json'), help='Fit settings')
+    ar.add_argument('-t', '--tolerance', type=float, default=1e-3, help='Convergence tolerance of both fits')
+    args = vars(ar.parse_args())
+
+    model_file = Path(args['model'])
+    settings_file = Path(args['settings'])
+    warm_data = Path(args['warm_data'] or args['data'])
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_dir = Path(output_dir)
+        cold = fit(model_file, Path(args['data']), settings_file, output_dir / 'cold', args['tolerance'])
+        if args['warm_data']:
+            cold = fit(model_file, warm_data, settings_file, output_dir / 'cold_warm_data', args['tolerance'])
+        warm = fit(model_file, warm_data, settings_file, output_dir / 'warm', args['tolerance'],
+                   warm_start_file=latest_fit_file(output_dir / 'cold'))
+
+    print(f'{"":6} {"wall s":>8} {"iterations":>10} {"rms":>10}')
+    for name, (wall_time, iterations, rms) in (('cold', cold), ('warm', warm)):
+        print(f'{name:6} {wall_time:8.2f} {iterations:10d} {rms:10.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,93 +1,507 @@
+import json
 import os
+import shutil
 import hydra
+from omegaconf import OmegaConf
 from omegaconf.dictconfig import DictConfig
 
 from pathlib import Path
 from loguru import logger
 
-import pandas as pd
-
-from batch_fit import BatchFit
-from batch_fit.data_combiner import Point, read_single_group, write_ex
+# the fitting stack (Zinc, scaffoldfitter) and the annotation checks are imported by the code paths that use them, so
+# a run with nothing left to fit, and every worker spawned rather than forked, starts without loading them
+from batch_fit.fit_output import OutputPolicy
+from batch_fit.manifest import RunManifest, hash_file, hash_object, subject_data_key, subject_fit_key
+from batch_fit.pipeline import FitJob
+from batch_fit.profiling import ProfileSettings, SubjectProfiler, write_cohort_report
+from batch_fit.progress import ProgressMonitor
+from batch_fit.results import ResultsStore
+from batch_fit.scheduler import run_parallel
+from batch_fit.sweep import rank_settings, write_reduced_settings, write_sweep_settings
+from batch_fit.work_queue import WorkQueue
 
 
 @hydra.main(config_path="configs", config_name="fit.yaml")
 def main(cfg: DictConfig):
     # iterate through subjects' directories
 
-    right_lung_groups = cfg.groups_right_lung
+    right_lung_groups = OmegaConf.to_container(cfg.groups_right_lung)
     scaffold_path = Path(cfg.scaffold_path)
     setting_files_path = Path(__file__).parent / 'fit_settings'
+    setting_file = setting_files_path / f'settings_{cfg.fit_setting}.json'
+    decimation = OmegaConf.to_container(cfg.decimation) if cfg.decimation.enabled else None
+    convergence_tolerance = cfg.convergence.tolerance if cfg.convergence.enabled else None
+    output_policy = OutputPolicy.create(**OmegaConf.to_container(cfg.fit_output))
+
+    output_csv_path = Path(__file__).parent / Path(cfg.rms_output_directory) / f'{Path(cfg.rms_output_file_name)}.csv'
+
+    # create an output directory using Hydra to store all the fitting files
+    hydra_cfg = hydra.core.hydra_config.HydraConfig.get()
+    current_hydra_output_dir = Path(hydra_cfg.runtime.output_dir)
 
     if Path(cfg.root_directory).exists():
 
-        for subject_path in Path(cfg.root_directory).iterdir():
+        # hidden directories, like the default work queue directory, are not subjects
+        subject_paths = [subject_path for subject_path in sorted(Path(cfg.root_directory).iterdir())
+                         if subject_path.is_dir() and not subject_path.name.startswith('.')]
+
+        if cfg.annotation_check.enabled:
+            subject_paths = run_annotation_gate(cfg, subject_paths, right_lung_groups, current_hydra_output_dir)
+
+        # hash everything a fit depends on, so subjects whose fit is still valid can be skipped
+        manifest = RunManifest(Path(__file__).parent / Path(cfg.rms_output_directory) / cfg.manifest_file)
+        results_store = ResultsStore(Path(__file__).parent / Path(cfg.rms_output_directory) / cfg.results_store,
+                                     wal=not cfg.work_queue.enabled)
+        scaffold_key = hash_file(scaffold_path) if scaffold_path.is_file() else None
+        settings_key = hash_file(setting_file) if setting_file.is_file() else None
+        if convergence_tolerance is not None:
+            settings_key = hash_object({'settings': settings_key, 'convergence_tolerance': convergence_tolerance})
+        if cfg.warm_start.enabled:
+            settings_key = hash_object({'settings': settings_key,
+                                        'warm_start': OmegaConf.to_container(cfg.warm_start)})
+
+        if cfg.sweep.enabled:
+            run_sweep(cfg, subject_paths, right_lung_groups, scaffold_path, setting_file, manifest, results_store,
+                      current_hydra_output_dir, decimation, convergence_tolerance, output_policy)
+            return
+
+        if cfg.work_queue.enabled:
+            progress = create_progress(cfg, len(subject_paths), current_hydra_output_dir)
+            progress.start()
+            try:
+                run_work_queue(cfg, subject_paths, right_lung_groups, scaffold_path, setting_file, manifest,
+                               results_store, scaffold_key, settings_key, decimation, convergence_tolerance,
+                               output_policy, progress)
+            finally:
+                progress.stop()
+            results_store.export_csv(output_csv_path, setting_id=cfg.fit_setting)
+            return
+
+        fit_output_dir = Path(cfg.fit_output_directory) if cfg.fit_output_directory else \
+            current_hydra_output_dir / 'fit_files'
+        jobs = dict()
+        keys = dict()
+        progress = create_progress(cfg, len(subject_paths), current_hydra_output_dir)
+        for subject_path in subject_paths:
+            subject = subject_path.stem
+            data_key = subject_data_key(subject_path, right_lung_groups, decimation=decimation)
+            fit_key = subject_fit_key(data_key, scaffold_key, settings_key, output_policy._asdict())
+            if cfg.resume and manifest.is_fit_valid(subject, fit_key):
+                logger.info(f'Subject {subject} is up to date, skipping')
+                progress.skipped(subject)
+                continue
+
+            rebuild_data = not manifest.is_combined_valid(subject, data_key)
+            output_fit_dir = fit_output_dir / f'{subject}'
+            warm_start_file = find_warm_start_file(cfg.warm_start, subject, manifest) if cfg.warm_start.enabled \
+                else None
+            jobs[subject] = FitJob(subject_path, right_lung_groups, scaffold_path, setting_file, output_fit_dir,
+                                   rebuild_data=rebuild_data, point_cache=cfg.point_cache, decimation=decimation,
+                                   convergence_tolerance=convergence_tolerance, warm_start_file=warm_start_file,
+                                   in_memory=cfg.combined_data.in_memory, write_combined=cfg.combined_data.write_file,
+                                   output_policy=output_policy,
+                                   profiler=create_profiler(cfg, subject, current_hydra_output_dir))
+            keys[subject] = (data_key, fit_key, output_fit_dir)
+
+        def record(subject, result):
+            data_key, fit_key, output_fit_dir = keys[subject]
+            results_store.append(subject, result['group_rms'], result['total_rms'], max_error=result['max_error'],
+                                 setting_id=cfg.fit_setting, wall_time=result['wall_time'],
+                                 input_hashes={'data': data_key, 'scaffold': scaffold_key, 'settings': settings_key},
+                                 steps=result['steps'])
+            manifest.update(subject, data_key, fit_key, output_fit_dir)
+
+        if jobs:
+            # loaded before any worker is forked, so the workers inherit it
+            from batch_fit.core import load_scaffold_template
+            from batch_fit.pipeline import fit_subject
+
+        failed = dict()
+        progress.start()
+        try:
+            if not jobs:
+                logger.info('Every subject is up to date')
+            # time and memory limits need every subject in a process of its own, even when fitting one at a time
+            elif cfg.num_workers > 1 or is_supervised(cfg.limits):
+                logger.info(f'Fitting {len(jobs)} subjects with {cfg.num_workers} workers')
+
+                # read the scaffold once here so forked workers inherit its buffer instead of each reading the file
+                if scaffold_path.is_file():
+                    load_scaffold_template(scaffold_path)
+
+                stopped = list()
+                for result in run_parallel(fit_subject, jobs, cfg.num_workers, time_limit=cfg.limits.time_limit,
+                                           memory_limit=cfg.limits.memory_limit, on_start=progress.started):
+                    if result.error is not None or result.value is None:
+                        error = result.error or 'scaffold or combined data file missing'
+                        logger.error(f'Subject {result.name} failed: {error}')
+                        failed[result.name] = error
+                        if result.limit is not None:
+                            record_stopped(results_store, result, cfg.fit_setting, keys[result.name][2])
+                            stopped.append(result.name)
+                        progress.failed(result.name, error)
+                    else:
+                        logger.info(f'Subject {result.name} done')
+                        record(result.name, result.value)
+                        progress.finished(result.name, result.value)
+
+                if stopped and cfg.limits.retry.enabled:
+                    failed.update(retry_reduced(cfg, {subject: jobs[subject] for subject in stopped}, results_store,
+                                                current_hydra_output_dir, fit_output_dir, progress))
+
+            else:
+                for subject, args in jobs.items():
+                    logger.info('-------')
+                    logger.info(f'Subject {subject}')
+
+                    progress.started(subject, os.getpid())
+                    result = fit_subject(*args)
+                    if result is not None:
+                        record(subject, result)
+                        progress.finished(subject, result)
+                    else:
+                        failed[subject] = 'scaffold or combined data file missing'
+                        progress.failed(subject, failed[subject])
+        finally:
+            progress.stop()
+        report_profiles(cfg, current_hydra_output_dir)
+
+        if failed:
+            with open(current_hydra_output_dir / 'failed_subjects.json', 'w') as f:
+                json.dump(failed, f, indent=4)
+
+        # the wide RMS table is an export of the results store, written once per run
+        results_store.export_csv(output_csv_path, setting_id=cfg.fit_setting)
+
+
+def create_progress(cfg, total: int, output_dir: Path) -> ProgressMonitor:
+    """
+    :return: the progress monitor of a run of `total` jobs, keeping its status file in `output_dir` unless
+    progress.status_file is set. With progress disabled it only keeps count, nothing is written or served.
+    """
+    if not cfg.progress.enabled:
+        return ProgressMonitor(total)
+    status_file = Path(cfg.progress.status_file) if cfg.progress.status_file else output_dir / 'status.json'
+    return ProgressMonitor(total, status_file, update_interval=cfg.progress.update_interval,
+                           prometheus_port=cfg.progress.prometheus_port, prometheus_host=cfg.progress.prometheus_host,
+                           straggler_factor=cfg.progress.straggler_factor)
+
+
+def profile_settings(cfg, output_dir: Path, run_id: str = None) -> ProfileSettings:
+    """
+    :return: the profile settings of the run, keeping the profiles in profiling.directory or <output_dir>/profiles.
+    Without a `run_id`, e.g. the one of a work queue, the run id comes from the output directory, unique to the run,
+    so every job of the run gets the same one.
+    """
+    directory = Path(cfg.profiling.directory) if cfg.profiling.directory else output_dir / 'profiles'
+    return ProfileSettings(directory, cprofile=cfg.profiling.cprofile,
+                           sampling_interval=cfg.profiling.sampling_interval,
+                           flush_interval=cfg.profiling.flush_interval,
+                           run_id=run_id or hash_object(str(output_dir.resolve()))[:12])
+
+
+def create_profiler(cfg, name: str, output_dir: Path, run_id: str = None):
+    """
+    :return: the profiler of the job `name`, or None with profiling disabled.
+    """
+    if not cfg.profiling.enabled:
+        return None
+    return SubjectProfiler(name, profile_settings(cfg, output_dir, run_id))
+
+
+def report_profiles(cfg, output_dir: Path, run_id: str = None):
+    """
+    Merge the profiles of the jobs of the run, leaving out those of earlier runs sharing profiling.directory, into the
+    hot function report and collapsed stack file of the cohort.
+    """
+    if not cfg.profiling.enabled:
+        return
+    settings = profile_settings(cfg, output_dir, run_id)
+    written = write_cohort_report(settings.directory, top=cfg.profiling.top, run_id=settings.run_id)
+    if written:
+        logger.info(f'Profile of the cohort written to {", ".join(str(path) for path in written.values())}')
+
+
+def is_supervised(limits) -> bool:
+    return limits.time_limit is not None or limits.memory_limit is not None
+
+
+def record_stopped(results_store, result, setting_id, output_fit_dir):
+    """
+    Record a fit stopped for exceeding a limit, with the metrics of the fitter steps it got through.
+    """
+    from batch_fit.pipeline import read_step_events
+    results_store.append_failure(result.name.split('/')[0], result.limit, result.error, setting_id=setting_id,
+                                 steps=read_step_events(output_fit_dir))
+
+
+def retry_reduced(cfg, jobs, results_store, output_dir, fit_output_dir, progress):
+    """
+    Fit subjects stopped for exceeding a limit again with reduced settings: fewer iterations per fit step, and the
+    data decimated if limits.retry.decimation is set. Decimated data is combined to its own
+    <subject>_combined_lung_data-reduced.ex file, next to the combined file of the run. The results are stored under
+    the setting id <fit_setting>-reduced, and the manifest is left alone so the subjects are tried with the full
+    settings next run.
+
+    :param jobs: the FitJob of every stopped subject.
+    :return: dict of subject to error of the retries that failed too.
+    """
+    from batch_fit.pipeline import fit_subject
+    retry = cfg.limits.retry
+    setting_id = f'{cfg.fit_setting}-reduced'
+    decimation = OmegaConf.to_container(retry.decimation) if retry.decimation else None
+    reduced_jobs = dict()
+    for subject, job in jobs.items():
+        job = job._replace(output_fit_dir=fit_output_dir / f'{subject}-reduced',
+                           profiler=create_profiler(cfg, f'{subject}-reduced', output_dir))
+        if job.setting_file.is_file():
+            job = job._replace(setting_file=write_reduced_settings(job.setting_file, retry.iterations_scale,
+                                                                   output_dir / f'settings_{setting_id}.json'))
+        if decimation is not None:
+            # the reduced combined file is not in the manifest, so it is combined again on every retry
+            job = job._replace(rebuild_data=True, decimation=decimation, combined_suffix='-reduced')
+        reduced_jobs[subject] = job
+    logger.info(f'Retrying {len(reduced_jobs)} subjects with reduced settings')
+    progress.add_jobs(len(reduced_jobs))
+
+    failed = dict()
+    for result in run_parallel(fit_subject, reduced_jobs, cfg.num_workers, time_limit=cfg.limits.time_limit,
+                               memory_limit=cfg.limits.memory_limit,
+                               on_start=lambda subject, pid: progress.started(f'{subject}/{setting_id}', pid)):
+        if result.error is not None or result.value is None:
+            error = result.error or 'scaffold or combined data file missing'
+            logger.error(f'Subject {result.name} failed with reduced settings: {error}')
+            failed[f'{result.name}/{setting_id}'] = error
+            if result.limit is not None:
+                record_stopped(results_store, result, setting_id, reduced_jobs[result.name].output_fit_dir)
+            progress.failed(f'{result.name}/{setting_id}', error)
+        else:
+            logger.info(f'Subject {result.name} done with reduced settings')
+            results_store.append(result.name, result.value['group_rms'], result.value['total_rms'],
+                                 max_error=result.value['max_error'], setting_id=setting_id,
+                                 wall_time=result.value['wall_time'], steps=result.value['steps'])
+            progress.finished(f'{result.name}/{setting_id}', result.value)
+    return failed
+
+
+def find_warm_start_file(warm_start, subject, manifest):
+    """
+    Fit output to start a subject from: the last model file of the subject mapped to it in warm_start.subjects (the
+    subject itself by default), inside warm_start.fit_directory or, if that is not set, in that subject's last fit
+    recorded in the manifest.
+    """
+    from batch_fit.core import latest_fit_file
+    source_subject = (warm_start.subjects or dict()).get(subject, subject)
+    if warm_start.fit_directory:
+        fit_dir = Path(warm_start.fit_directory) / source_subject
+    else:
+        fit_dir = Path(manifest.get(source_subject).get('fit_dir', ''))
+
+    fit_file = latest_fit_file(fit_dir) if fit_dir.is_dir() else None
+    if fit_file is None:
+        logger.info(f'No earlier fit of {source_subject} to warm start {subject} from, fitting from the scaffold')
+    return fit_file
+
+
+def run_annotation_gate(cfg, subject_paths, groups, output_dir):
+    """
+    Check the annotations of every subject against the template subject before anything is fitted, write the report
+    and leave out the subjects with too many suspect points in any group if annotation_check.skip_suspect is set.
+
+    :return: the subject paths to fit.
+    """
+    from batch_fit.annotation_check import check_subject, is_suspect, load_template, write_report
+    check = cfg.annotation_check
+    template_path = Path(cfg.root_directory) / str(check.template_subject)
+    assert template_path.is_dir(), f'Template subject {template_path} not found'
+    template = load_template(template_path, groups)
+    logger.info(f'Checking the annotations of {len(subject_paths)} subjects against {template_path.stem}')
+
+    jobs = {subject_path.stem: (subject_path, groups, template, check.threshold_scale, check.isolation_factor,
+                                check.min_samples, check.registration, check.deformable)
+            for subject_path in subject_paths}
+    reports = dict()
+    failed = dict()
+    for result in run_parallel(check_subject, jobs, cfg.num_workers):
+        if result.error is not None:
+            logger.error(f'Subject {result.name} could not be checked: {result.error}')
+            failed[result.name] = result.error
+        else:
+            reports[result.name] = result.value
+            reports[result.name]['suspect'] = is_suspect(result.value, check.max_suspect_fraction)
+
+    report_path = Path(check.report) if check.report else output_dir / 'annotation_report.json'
+    write_report(report_path, template_path.stem, reports, failed)
+    suspects = sorted(subject for subject, report in reports.items() if report['suspect'])
+    if suspects:
+        logger.warning(f'Suspect annotations in {len(suspects)} subjects: {", ".join(suspects)}, see {report_path}')
 
-            subject_rms = dict()
+    if not check.skip_suspect:
+        return subject_paths
+    return [subject_path for subject_path in subject_paths if subject_path.stem not in suspects]
 
-            logger.info(f'-------')
-            logger.info(f'Subject {subject_path.stem}')
 
-            output_ex = subject_path / f'{subject_path.stem}_combined_lung_data.ex'
+def run_work_queue(cfg, subject_paths, groups, scaffold_path, setting_file, manifest, results_store, scaffold_key,
+                   settings_key, decimation, convergence_tolerance, output_policy, progress):
+    """
+    Fit the subjects as one of any number of workers, on any number of hosts, sharing the work queue directory.
+    A subject is only fitted by the worker holding its lease. The fit is written to a private directory, and the
+    worker still holding the lease when it finishes moves it to <fit_output_directory>/<subject>, stores its result
+    and only then marks the subject done, so every fit is published and stored once even if a worker dies part way.
+    Subjects finished or held by other workers count as skipped in the progress of this worker. Profiles are kept in
+    <work queue directory>/profiles unless profiling.directory is set, under the run id of the queue, so every worker
+    reports the profiles of all workers that finished subjects so far.
+    """
+    from batch_fit.core import load_scaffold_template
+    from batch_fit.pipeline import fit_subject
+    queue_dir = Path(cfg.work_queue.directory) if cfg.work_queue.directory else \
+        Path(cfg.root_directory) / '.work_queue'
+    fit_output_dir = Path(cfg.fit_output_directory) if cfg.fit_output_directory else queue_dir / 'fit_files'
+    fit_output_dir.mkdir(parents=True, exist_ok=True)
+    queue = WorkQueue(queue_dir, lease_seconds=cfg.work_queue.lease_seconds)
+    logger.info(f'Worker {queue.worker_id} taking subjects from {queue_dir}')
+    run_id = queue.run_id() if cfg.profiling.enabled else None
 
-            # first combine all .exdata files into one single .ex file
-            if subject_path.is_dir():
-                if not output_ex.exists():
-                    single_data = dict()
+    if scaffold_path.is_file():
+        load_scaffold_template(scaffold_path)
 
-                    logger.info(f'Generating EX file')
+    keys = dict()
 
-                    for ex_file in subject_path.glob("*.exdata"):
-                        points = list()
-                        file_name = ex_file.stem
-                        if file_name in right_lung_groups.keys():
-                            group_name = right_lung_groups[file_name]
-                            data = read_single_group(str(ex_file))
-                            for p in data:
-                                points.append(_create_point(p))
-                            single_data[group_name] = points
+    def claimed_jobs():
+        # claimed one at a time when a worker process is free, so idle workers on other hosts get the rest
+        for subject_path in subject_paths:
+            subject = subject_path.stem
+            data_key = subject_data_key(subject_path, groups, decimation=decimation)
+            fit_key = subject_fit_key(data_key, scaffold_key, settings_key, output_policy._asdict())
+            if not queue.claim(subject, fit_key):
+                progress.skipped(subject)
+                continue
 
-                    write_ex(output_ex, single_data)
+            temporary_dir = fit_output_dir / f'.{subject}.{queue.worker_id}'
+            warm_start_file = find_warm_start_file(cfg.warm_start, subject, manifest) if cfg.warm_start.enabled \
+                else None
+            keys[subject] = (data_key, fit_key, temporary_dir)
+            # the manifest is not shared between workers, only a point cache tells whether combined data is stale
+            yield subject, FitJob(subject_path, groups, scaffold_path, setting_file, temporary_dir,
+                                  rebuild_data=not cfg.point_cache, point_cache=cfg.point_cache, decimation=decimation,
+                                  convergence_tolerance=convergence_tolerance, warm_start_file=warm_start_file,
+                                  in_memory=cfg.combined_data.in_memory,
+                                  write_combined=cfg.combined_data.write_file, output_policy=output_policy,
+                                  profiler=create_profiler(cfg, subject, queue_dir, run_id))
 
-            # now fit the subject
-            # create an output directory using Hydra to store all the fitting files
-            hydra_cfg = hydra.core.hydra_config.HydraConfig.get()
-            current_hydra_output_dir = Path(hydra_cfg.runtime.output_dir)
-            output_fit_dir = current_hydra_output_dir / 'fit_files' / f'{subject_path.stem}'
-            output_fit_dir.mkdir(parents=True, exist_ok=True)
+    queue.start_heartbeat()
+    try:
+        for result in run_parallel(fit_subject, claimed_jobs(), cfg.num_workers, time_limit=cfg.limits.time_limit,
+                                   memory_limit=cfg.limits.memory_limit, on_start=progress.started):
+            data_key, fit_key, temporary_dir = keys.pop(result.name)
+            if result.error is not None or result.value is None:
+                error = result.error or 'scaffold or combined data file missing'
+                logger.error(f'Subject {result.name} failed: {error}')
+                if result.limit is not None:
+                    record_stopped(results_store, result, cfg.fit_setting, temporary_dir)
+                queue.fail(result.name, fit_key, error)
+                shutil.rmtree(temporary_dir, ignore_errors=True)
+                progress.failed(result.name, error)
+                continue
+            progress.finished(result.name, result.value)
 
-            logger.info(f'Fitting')
+            # called by publish right away, for this result
+            def record():
+                value = result.value
+                if not results_store.append(result.name, value['group_rms'], value['total_rms'],
+                                            max_error=value['max_error'], setting_id=cfg.fit_setting,
+                                            wall_time=value['wall_time'],
+                                            input_hashes={'data': data_key, 'scaffold': scaffold_key,
+                                                          'settings': settings_key, 'fit': fit_key},
+                                            steps=value['steps'], once=True):
+                    logger.info(f'Subject {result.name} was recorded by a worker that stopped before marking it done')
 
-            # define the fitter
-            if scaffold_path.is_file() and output_ex.is_file():
-                batch_fit = BatchFit(scaffold_path, output_ex, output_fit_dir / 'fit_')
-                setting_id = cfg.fit_setting
-                setting_file = setting_files_path / f'settings_{setting_id}.json'
-                batch_fit.load_fit_settings(setting_file)
-                batch_fit.run()
+            if queue.publish(result.name, fit_key, result.value, temporary_dir, fit_output_dir / result.name, record):
+                logger.info(f'Subject {result.name} done')
+            else:
+                logger.info(f'Subject {result.name} was taken over by another worker, discarding this fit')
+    finally:
+        queue.stop_heartbeat()
+    report_profiles(cfg, queue_dir, run_id)
 
-                subject_rms[subject_path.stem] = batch_fit.get_group_rms()
-                subject_rms[subject_path.stem].update({'total': batch_fit.get_total_rms()[0]})
 
-                output_csv_path = Path(__file__).parent / Path(
-                    cfg.rms_output_directory) / f'{Path(cfg.rms_output_file_name)}.csv'
+def run_sweep(cfg, subject_paths, groups, scaffold_path, setting_file, manifest, results_store, output_dir,
+              decimation, convergence_tolerance, output_policy):
+    """
+    Fit every subject with every setting of the sweep declared in fit.yaml. Each subject is combined once, and the
+    scaffold is parsed once before the workers start, so every (subject, setting) job only runs the fit.
+    """
+    from batch_fit.core import load_scaffold_template
+    from batch_fit.pipeline import combine_subject, fit_data
+    setting_files = write_sweep_settings(setting_file, cfg.fit_setting, OmegaConf.to_container(cfg.sweep),
+                                         output_dir / 'sweep_settings')
+    logger.info(f'Sweeping {len(setting_files)} settings over {len(subject_paths)} subjects')
 
-                df = pd.DataFrame(subject_rms)
+    combine_jobs = dict()
+    data_keys = dict()
+    for subject_path in subject_paths:
+        data_key = subject_data_key(subject_path, groups, decimation=decimation)
+        data_keys[subject_path.stem] = data_key
+        combine_jobs[subject_path.stem] = (subject_path, groups, not manifest.is_combined_valid(subject_path.stem,
+                                                                                                 data_key),
+                                           cfg.point_cache, decimation)
+    combined = dict()
+    for result in run_parallel(combine_subject, combine_jobs, cfg.num_workers):
+        if result.error is not None:
+            logger.error(f'Subject {result.name} failed to combine: {result.error}')
+        else:
+            combined[result.name] = result.value
+            # so the next sweep or run does not combine the subject again
+            if not manifest.is_combined_valid(result.name, data_keys[result.name]):
+                manifest.update_combined(result.name, data_keys[result.name])
 
-                if os.path.isfile(output_csv_path):
-                    existing_df = pd.read_csv(output_csv_path, index_col=0)
-                    combined_df = pd.concat([existing_df, df[subject_path.name]], axis=1)
+    if scaffold_path.is_file():
+        load_scaffold_template(scaffold_path)
 
-                else:
-                    combined_df = df
+    jobs = dict()
+    for subject, output_ex in combined.items():
+        for setting_id, sweep_setting_file in setting_files.items():
+            jobs[f'{subject}/{setting_id}'] = (output_ex, scaffold_path, sweep_setting_file,
+                                               output_dir / 'fit_files' / setting_id / subject, convergence_tolerance,
+                                               None, None, output_policy,
+                                               create_profiler(cfg, f'{subject}/{setting_id}', output_dir))
 
-                combined_df.to_csv(output_csv_path)
+    failed = dict()
+    progress = create_progress(cfg, len(jobs), output_dir)
+    progress.start()
+    try:
+        for result in run_parallel(fit_data, jobs, cfg.num_workers, time_limit=cfg.limits.time_limit,
+                                   memory_limit=cfg.limits.memory_limit, on_start=progress.started):
+            subject, setting_id = result.name.split('/')
+            if result.error is not None or result.value is None:
+                error = result.error or 'scaffold or combined data file missing'
+                logger.error(f'Subject {subject} with setting {setting_id} failed: {error}')
+                failed[result.name] = error
+                if result.limit is not None:
+                    record_stopped(results_store, result, setting_id, jobs[result.name][3])
+                progress.failed(result.name, error)
+            else:
+                logger.info(f'Subject {subject} with setting {setting_id} done')
+                results_store.append(subject, result.value['group_rms'], result.value['total_rms'],
+                                     max_error=result.value['max_error'], setting_id=setting_id,
+                                     wall_time=result.value['wall_time'], steps=result.value['steps'])
+                progress.finished(result.name, result.value)
+    finally:
+        progress.stop()
+    report_profiles(cfg, output_dir)
 
+    if failed:
+        with open(output_dir / 'failed_subjects.json', 'w') as f:
+            json.dump(failed, f, indent=4)
 
-def _create_point(pts):
-    return Point(float(pts[0]),
-                 float(pts[1]),
-                 float(pts[2]))
+    results = results_store.query()
+    results = results[results['setting_id'].isin(setting_files.keys()) & results['subject'].isin(combined.keys())]
+    if not results.empty:
+        ranking = rank_settings(results)
+        ranking.to_csv(Path(__file__).parent / Path(cfg.rms_output_directory) /
+                       f'{Path(cfg.rms_output_file_name)}_sweep_ranking.csv')
+        logger.info(f'Best setting on total RMS: {ranking.loc["total", "best_setting"]} '
+                    f'({ranking.loc["total", "best_rms"]:.4f})')
 
 
 if __name__ == '__main__':
@@ -1 +1,18 @@
-from .core import BatchFit
+import sys
+import types
+
+
+class _Package(types.ModuleType):
+    """
+    The batch_fit package, loading Zinc and scaffoldfitter only once BatchFit is used, not on every import of the
+    package. A module class rather than a module level __getattr__, which needs Python 3.7.
+    """
+
+    def __getattr__(self, name):
+        if name == 'BatchFit':
+            from .core import BatchFit
+            return BatchFit
+        raise AttributeError(f'module {self.__name__!r} has no attribute {name!r}')
+
+
+sys.modules[__name__].__class__ = _Package
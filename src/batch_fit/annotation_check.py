@@ -0,0 +1,118 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .annotation_qc import GroupIndex
+from .ex_reader import read_ex_points
+from .registration import register_points
+
+
+def load_subject_groups(subject_path: Path, groups: dict) -> dict:
+    """
+    Read the points of every annotated group of a subject from its .exdata files, in identifier order.
+
+    :return: dict of group name to ExPoints.
+    """
+    subject_groups = dict()
+    for ex_file in sorted(Path(subject_path).glob('*.exdata')):
+        if ex_file.stem in groups.keys():
+            subject_groups[groups[ex_file.stem]] = read_ex_points(str(ex_file), nodeset='nodes')
+    return subject_groups
+
+
+def normalise_to(points: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    """
+    Map points onto the frame of the reference points by matching their centroid and their spread along every axis.
+    """
+    scale = np.std(reference, axis=0) / np.maximum(np.std(points, axis=0), np.finfo(np.float64).tiny)
+    return (points - np.mean(points, axis=0)) * scale + np.mean(reference, axis=0)
+
+
+def load_template(template_path: Path, groups: dict) -> dict:
+    """
+    Index of every group of the template subject with the mean pairwise distance of the group, built once for the
+    whole cohort.
+
+    :return: dict of group name to (GroupIndex, mean distance).
+    """
+    template = dict()
+    for group_name, points in load_subject_groups(template_path, groups).items():
+        group_index = GroupIndex(points.coordinates)
+        mean_distance, _ = group_index.distance_statistics()
+        template[group_name] = (group_index, mean_distance)
+    return template
+
+
+def check_subject(subject_path: Path, groups: dict, template: dict, threshold_scale: float = 0.3,
+                  isolation_factor: float = 5.0, min_samples: int = 2, registration: str = 'normalise',
+                  deformable: bool = False) -> dict:
+    """
+    Look for suspect annotations of a subject, group by group, against a template subject:
+    'ectopic' points lie further from the template's group than threshold_scale times the mean pairwise distance of
+    the template's group, after the whole subject is mapped onto the template; 'isolated' points are DBSCAN noise
+    within their own group, with eps isolation_factor times the median nearest neighbour spacing of the group.
+
+    :param template: template subject, as returned by load_template.
+    :param registration: how the subject is mapped onto the template: 'normalise' to match centroid and spread, or
+    the ICP transform mode of register_points, optionally followed by a deformable CPD.
+    :return: report of the subject, with per group the number of points and the row indices and node identifiers of
+    the suspect points in the group's .exdata file, and the names of the groups the subject has no points for.
+    """
+    subject_groups = load_subject_groups(subject_path, groups)
+    report = {'groups': dict(), 'missing': sorted(set(groups.values()) - set(subject_groups))}
+    if not subject_groups:
+        return report
+
+    template_points = np.concatenate([group_index.points for group_index, _ in template.values()])
+    subject_points = np.concatenate([points.coordinates for points in subject_groups.values()])
+    if registration == 'normalise':
+        aligned_points = normalise_to(subject_points, template_points)
+    else:
+        aligned_points = register_points(subject_points, template_points, mode=registration,
+                                         deformable=deformable).points
+
+    start = 0
+    for group_name, points in subject_groups.items():
+        aligned = aligned_points[start:start + len(points.coordinates)]
+        start += len(points.coordinates)
+        group_index = GroupIndex(aligned)
+        suspects = dict()
+
+        if len(group_index) > 1:
+            spacing, _ = group_index.knn(1)
+            eps = isolation_factor * float(np.median(spacing))
+            suspects['isolated'] = np.flatnonzero(group_index.noise_mask(eps, min_samples))
+
+        if group_name in template and len(template[group_name][0]):
+            reference, mean_distance = template[group_name]
+            distances, _ = reference.nearest(aligned)
+            suspects['ectopic'] = np.flatnonzero(distances > threshold_scale * mean_distance)
+
+        group_report = {'points': len(points.coordinates)}
+        for check, rows in suspects.items():
+            group_report[check] = rows.tolist()
+            group_report[check + '_identifiers'] = points.identifiers[rows].tolist()
+        suspect_rows = np.unique(np.concatenate([rows for rows in suspects.values()])) if suspects else []
+        group_report['suspect_fraction'] = len(suspect_rows) / max(len(points.coordinates), 1)
+        report['groups'][group_name] = group_report
+    return report
+
+
+def is_suspect(report: dict, max_suspect_fraction: float) -> bool:
+    return any(group_report['suspect_fraction'] > max_suspect_fraction for group_report in report['groups'].values())
+
+
+def write_report(report_path: Path, template_subject: str, reports: dict, failed: dict):
+    """
+    Write the annotation report of a cohort as JSON: the template subject, the report of every subject checked and
+    the error of every subject that could not be checked.
+    """
+    report_path = Path(report_path)
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = report_path.with_name(report_path.name + '.tmp')
+    with open(temporary_path, 'w') as f:
+        json.dump({'template': template_subject, 'subjects': reports, 'failed': failed}, f, indent=4,
+                  sort_keys=True)
+    os.replace(temporary_path, report_path)
@@ -0,0 +1,140 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+
+class GroupIndex:
+    """
+    KD-tree over the points of one annotation group, built once and shared by every check on the group. Nearest
+    neighbour queries of the group's own points are cached, so the k-distance and density checks run a single query,
+    and nothing kept here grows faster than the number of points.
+    """
+
+    def __init__(self, points: np.ndarray):
+        self.points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+        self.tree = cKDTree(self.points)
+        self._knn_distances = np.empty((len(self.points), 0))
+        self._knn_indices = np.empty((len(self.points), 0), dtype=np.intp)
+
+    def __len__(self):
+        return len(self.points)
+
+    def knn(self, k: int):
+        """
+        :return: distances and indices of the k nearest other points of every point, (n, k) arrays padded with inf
+        and n when the group has fewer points, (0, k) arrays for an empty group.
+        """
+        if not len(self.points):
+            return np.empty((0, k)), np.empty((0, k), dtype=np.intp)
+        if k > self._knn_distances.shape[1]:
+            # the point itself is the first hit of its own query
+            distances, indices = self.tree.query(self.points, k=k + 1)
+            self._knn_distances = distances.reshape(len(self.points), -1)[:, 1:]
+            self._knn_indices = indices.reshape(len(self.points), -1)[:, 1:]
+        return self._knn_distances[:, :k], self._knn_indices[:, :k]
+
+    def mean_knn_distance(self, k: int, include_self: bool = False) -> np.ndarray:
+        """
+        :param include_self: count every point as its own first neighbour at distance 0, as NearestNeighbors does
+        for its training points.
+        :return: average distance of every point to its k nearest neighbours, the values of a k-distance graph.
+        """
+        if include_self:
+            distances, _ = self.knn(k - 1)
+            return np.sum(distances, axis=1) / k
+        distances, _ = self.knn(k)
+        return np.mean(distances, axis=1)
+
+    def noise_mask(self, eps: float, min_samples: int) -> np.ndarray:
+        """
+        Points DBSCAN labels as noise: points with fewer than `min_samples` points (themselves included) within
+        `eps` that are not within `eps` of such a core point either. Core points come from the cached nearest
+        neighbours, only the remaining points need a radius query.
+        """
+        if min_samples <= 1:
+            return np.zeros(len(self.points), dtype=bool)
+        distances, _ = self.knn(min_samples - 1)
+        core = distances[:, -1] <= eps
+        noise = ~core
+        candidates = np.flatnonzero(noise)
+        if candidates.size and core.any():
+            for row, neighbours in zip(candidates, self.tree.query_ball_point(self.points[candidates], eps)):
+                noise[row] = not core[neighbours].any()
+        return noise
+
+    def nearest(self, points: np.ndarray):
+        """
+        :return: distance to and index of the nearest point of the group for every given point.
+        """
+        return self.tree.query(np.asarray(points, dtype=np.float64).reshape(-1, 3))
+
+    def distance_statistics(self, exact_limit: int = 5000, sample_size: int = 1000000, chunk_size: int = 1024,
+                            seed: int = 0):
+        """
+        Mean and standard deviation of the full pairwise distance matrix of the group, diagonal included. Up to
+        `exact_limit` points the distances are streamed in blocks of `chunk_size` rows, above it `sample_size`
+        random pairs estimate them, so memory stays linear in the number of points either way.
+
+        :return: (mean, std) of the distances.
+        """
+        count = len(self.points)
+        if count == 0:
+            return np.nan, np.nan
+        if count <= exact_limit:
+            total = 0.0
+            total_squared = 0.0
+            for start in range(0, count, chunk_size):
+                distances = cdist(self.points[start:start + chunk_size], self.points)
+                total += distances.sum()
+                total_squared += np.square(distances).sum()
+            mean = total / count ** 2
+            return mean, np.sqrt(max(total_squared / count ** 2 - mean ** 2, 0.0))
+
+        generator = np.random.default_rng(seed)
+        first = generator.integers(count, size=sample_size)
+        second = generator.integers(count, size=sample_size)
+        distances = np.linalg.norm(self.points[first] - self.points[second], axis=1)
+        return distances.mean(), distances.std()
+
+
+class AnnotationQC:
+    """
+    Annotation checks over the labelled groups of one point set, with a GroupIndex built the first time a group is
+    used and reused by every later check.
+    """
+
+    def __init__(self, points: np.ndarray, groups: dict):
+        """
+        :param points: (n, 3) coordinates.
+        :param groups: dict of group name to the rows of its points.
+        """
+        self._points = np.asarray(points, dtype=np.float64)
+        self._groups = groups
+        self._indexes = dict()
+
+    def group_names(self):
+        return list(self._groups)
+
+    def group(self, group_name: str) -> GroupIndex:
+        index = self._indexes.get(group_name)
+        if index is None:
+            index = self._indexes[group_name] = GroupIndex(self._points[self._groups[group_name]])
+        return index
+
+    def distance_threshold(self, group_name: str, scale: float = 0.3) -> float:
+        """
+        :return: the distance from a group beyond which a point is taken as ectopic: `scale` times the mean pairwise
+        distance of the group.
+        """
+        mean_distance, _ = self.group(group_name).distance_statistics()
+        return mean_distance * scale
+
+    def ectopic(self, group_name: str, points: np.ndarray, scale: float = 0.3):
+        """
+        Compare points labelled as `group_name` elsewhere, e.g. in another subject registered onto this one, with
+        this group.
+
+        :return: mask of the points further than the distance threshold from the group, and their distances to it.
+        """
+        distances, _ = self.group(group_name).nearest(points)
+        return distances > self.distance_threshold(group_name, scale), distances
@@ -1,8 +1,140 @@
+import json
+import re
+import time
 from pathlib import Path
 
+from opencmiss.zinc.context import Context
+from opencmiss.zinc.field import Field
+from opencmiss.zinc.result import RESULT_OK
+
 from scaffoldfitter.fitter import Fitter
 from scaffoldfitter.fitterjson import decodeJSONFitterSteps
 
+from .data_combiner import load as load_data_points, region_buffer
+from .fit_output import OutputPolicy, apply_geometry, load_geometry, mesh_reference, read_model_buffer, \
+    step_type_name, write_model
+from .scheduler import peak_rss_since_reset_mb, reset_peak_rss
+
+
+# serialized scaffold regions of this process, keyed on (path, modification time, size) of the model file
+_scaffold_buffers = dict()
+
+
+def load_scaffold_template(model_file_path: Path) -> bytes:
+    """
+    Read the scaffold model file once per process and keep the region serialized in memory. Calling this in the
+    parent before starting worker processes lets forked workers inherit the buffer. Only the file read is saved: every
+    fitter still parses the buffer into a region of its own, Zinc has no cheaper way to copy a region into another
+    context.
+
+    :return: EX buffer of the scaffold region.
+    """
+    path = Path(model_file_path).resolve()
+    stat = path.stat()
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    buffer = _scaffold_buffers.get(key)
+    if buffer is None:
+        context = Context('Scaffold Template')
+        region = context.getDefaultRegion()
+        result = region.readFile(str(path))
+        assert result == RESULT_OK, "Failed to load model file " + str(path)
+        sir = region.createStreaminformationRegion()
+        srm = sir.createStreamresourceMemory()
+        region.write(sir)
+        result, buffer = srm.getBuffer()
+        assert result == RESULT_OK, "Failed to serialize model file " + str(path)
+        _scaffold_buffers[key] = buffer
+    return buffer
+
+
+class _BatchFitter(Fitter):
+    """
+    Fitter which reads its model region from an in-memory scaffold buffer instead of the model file, and takes its
+    data from memory instead of reading the data file, each when given.
+
+    This relies on Fitter._loadModel and Fitter._loadData reading through self._region.readFile and
+    self._rawDataRegion.readFile, as the scaffoldfitter versions in pyproject.toml do; tests/test_core.py checks it.
+    """
+
+    def __init__(self, zincModelFileName: str, zincDataFileName: str, model_buffer: bytes = None, data=None):
+        super(_BatchFitter, self).__init__(zincModelFileName, zincDataFileName)
+        self._model_buffer = model_buffer
+        self._data = data
+
+    def _loadModel(self):
+        if self._model_buffer is None:
+            super(_BatchFitter, self)._loadModel()
+            return
+        # the base class reads the model file into the fit region, then discovers its fields and groups; only the
+        # reading is swapped out
+        region = self._region
+        self._region = _MemoryRegion(region, self._model_buffer)
+        try:
+            super(_BatchFitter, self)._loadModel()
+        finally:
+            self._region = region
+
+    def _loadData(self):
+        if self._data is None:
+            super(_BatchFitter, self)._loadData()
+            return
+        # the base class reads the data file into the raw data region, then matches group names to the model and
+        # moves the points into the fit region; only the reading is swapped out
+        raw_data_region = self._rawDataRegion
+        self._rawDataRegion = _MemoryRegion(raw_data_region, self._data)
+        try:
+            super(_BatchFitter, self)._loadData()
+        finally:
+            self._rawDataRegion = raw_data_region
+
+
+class _MemoryRegion:
+    """
+    Stand-in for a region of the fitter whose readFile loads the model or data from memory instead of the file.
+    Everything else is passed on to the region.
+    """
+
+    def __init__(self, region, data):
+        self._region = region
+        self._data = data
+
+    def readFile(self, file_name):
+        return read_data(self._region, self._data)
+
+    def __getattr__(self, name):
+        return getattr(self._region, name)
+
+
+def read_data(region, data) -> int:
+    """
+    Load data points into a region from memory.
+
+    :param data: dict of group name to (N, 3) points, as passed to write_ex, an EX buffer, e.g. from
+    write_ex_buffer or load_scaffold_template, or a region to copy, which may belong to another context.
+    :return: Zinc result code.
+    """
+    if isinstance(data, dict):
+        load_data_points(region, data)
+        return RESULT_OK
+    if not isinstance(data, (bytes, bytearray)):
+        data = region_buffer(data)
+    sir = region.createStreaminformationRegion()
+    sir.createStreamresourceMemoryBuffer(data)
+    return region.read(sir)
+
+
+def latest_fit_file(fit_dir: Path):
+    """
+    :return: the model file written after the last fitter step in a BatchFit output directory, or None if there is
+    no fit output in it.
+    """
+    fit_files = list()
+    for fit_file in Path(fit_dir).glob('fit_*'):
+        match = re.match(r'fit_(\d+)_(?:fit(\d+)|align)\.(?:exf|exf\.gz|exf\.zst|npz)$', fit_file.name)
+        if match:
+            fit_files.append((int(match.group(1)), int(match.group(2) or 0), fit_file))
+    return max(fit_files)[2] if fit_files else None
+
 
 class BatchFit:
     """
@@ -10,10 +142,31 @@ class BatchFit:
     fitting jobs.
     """
 
-    def __init__(self, model_file_path: Path, data_file_path: Path, output_dir: Path):
-        self._fitter = Fitter(str(model_file_path), str(data_file_path))
+    def __init__(self, model_file_path: Path, data_file_path: Path, output_dir: Path, cache_scaffold: bool = True,
+                 events_file: Path = None, convergence_tolerance: float = None, warm_start_file: Path = None,
+                 data=None, output_policy: OutputPolicy = None):
+        """
+        :param data: data to fit instead of reading data_file_path, which then only names the data in messages: a
+        dict of group name to (N, 3) points, an EX buffer or a Zinc region, see read_data.
+        :param output_policy: which fitter steps are written to output_dir, and in which format. By default the model
+        after every iteration, as plain EX.
+        """
+        model_buffer = load_scaffold_template(model_file_path) if cache_scaffold else None
+        if model_buffer is None and data is None:
+            self._fitter = Fitter(str(model_file_path), str(data_file_path))
+        else:
+            self._fitter = _BatchFitter(str(model_file_path), str(data_file_path), model_buffer=model_buffer,
+                                        data=data)
+        self._model_file_path = Path(model_file_path)
         self._filename_stem = model_file_path.stem
+        self._output_policy = output_policy or OutputPolicy()
+        self._mesh_reference = None
+        self._output_files = list()
         self._output_dir = str(output_dir)
+        self._events_file = events_file
+        self._convergence_tolerance = convergence_tolerance
+        self._warm_start_file = warm_start_file
+        self._step_metrics = list()
         self._fitter.load()
 
     def get_group_rms(self):
@@ -22,10 +175,194 @@ class BatchFit:
     def get_total_rms(self):
         return self._fitter.getDataRMSAndMaximumProjectionError()
 
+    def get_data_point_count(self):
+        fieldmodule = self._fitter.getRegion().getFieldmodule()
+        return fieldmodule.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS).getSize()
+
     def load_fit_settings(self, settings_file: Path):
         if settings_file.is_file():
             with open(settings_file, "r") as f:
                 self._fitter.decodeSettingsJSON(f.read(), decodeJSONFitterSteps)
 
+    def get_step_metrics(self):
+        """
+        :return: list with one dict per fitter step run: its index and type, the number of fit iterations run, wall
+        and CPU time, the peak RSS of the process during the step in MB (None where it cannot be reset per step, see
+        scheduler.reset_peak_rss) and the data RMS and maximum projection error after the step.
+        """
+        return self._step_metrics
+
+    def get_output_files(self):
+        """
+        :return: list of (path, size in bytes) of every fit output file written.
+        """
+        return self._output_files
+
+    def get_bytes_written(self) -> int:
+        return sum(size for _, size in self._output_files)
+
+    def _iteration_stem(self):
+        # scaffoldfitter writes the model after every iteration under this stem, when the policy asks for that
+        return str(self._output_dir) if self._output_policy.writes_iterations else None
+
     def run(self, step=None):
-        self._fitter.run(endStep=step, modelFileNameStem=str(self._output_dir))
+        fitter_steps = self._fitter.getFitterSteps()
+        if step is not None and step.hasRun():
+            # re-running an earlier step makes the fitter reload, leave that to it
+            self._fitter.run(endStep=step, modelFileNameStem=self._iteration_stem())
+            return
+
+        end_index = fitter_steps.index(step) if step is not None else len(fitter_steps) - 1
+        for index in range(1, end_index + 1):
+            fitter_step = fitter_steps[index]
+            if fitter_step.hasRun():
+                continue
+            if self._warm_start_file is not None and self._is_iterative(fitter_step):
+                self._seed_model_coordinates(self._warm_start_file, fitter_step)
+                self._warm_start_file = None
+            peak_reset = reset_peak_rss()
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+            every_iteration = True
+            if self._convergence_tolerance is not None and self._is_iterative(fitter_step):
+                iterations = self._run_until_converged(index, fitter_step)
+                # run one iteration at a time, only the model after the last one is written
+                every_iteration = fitter_step.isUpdateReferenceState()
+            else:
+                self._fitter.run(endStep=fitter_step, modelFileNameStem=self._iteration_stem())
+                iterations = fitter_step.getNumberOfIterations() if self._is_iterative(fitter_step) else None
+            bytes_written = self._write_step_output(index, fitter_step, iterations,
+                                                    index == len(fitter_steps) - 1, every_iteration)
+            self._record_step(index, fitter_step, iterations, time.perf_counter() - wall_start,
+                              time.process_time() - cpu_start, bytes_written,
+                              peak_rss_since_reset_mb() if peak_reset else None)
+
+    def _write_step_output(self, index, fitter_step, iterations, is_final, every_iteration) -> int:
+        """
+        Write the model after a fitter step if the output policy selects the step. With every iteration written, the
+        files were already written while the step ran and are only counted.
+
+        :param every_iteration: whether the model was written after every iteration of a fit step, or only after the
+        last one.
+        :return: bytes written for the step.
+        """
+        if self._output_policy.writes_iterations:
+            written = [(path, path.stat().st_size)
+                       for path in self._iteration_files(index, fitter_step, iterations, every_iteration)
+                       if path.is_file()]
+        elif self._output_policy.selects(index, fitter_step.getJsonTypeId(), is_final):
+            name = step_type_name(fitter_step.getJsonTypeId())
+            if self._is_iterative(fitter_step):
+                name += str(iterations)
+            if self._output_policy.format == 'npz' and self._mesh_reference is None:
+                self._mesh_reference = mesh_reference(self._model_file_path)
+            written = [write_model(self._fitter, f'{self._output_dir}{index}_{name}', self._output_policy.format,
+                                   self._mesh_reference)]
+        else:
+            written = list()
+        self._output_files.extend(written)
+        return sum(size for _, size in written)
+
+    def _seed_model_coordinates(self, fit_file: Path, fitter_step):
+        """
+        Overwrite the model coordinates with the fitted coordinates of an earlier fit output, so fitting starts from
+        that geometry. Done after the align step, so strain and curvature are still measured from the aligned
+        scaffold. Compressed EX output and geometry dumps of the same scaffold are read as well.
+        """
+        if Path(fit_file).suffix == '.npz':
+            geometry = load_geometry(fit_file)
+            if 'scaffold_hash' in geometry:
+                assert geometry['scaffold_hash'] == mesh_reference(self._model_file_path)['scaffold_hash'], \
+                    "Warm start file " + str(fit_file) + " belongs to another scaffold"
+            apply_geometry(self._fitter, geometry)
+            self._fitter.calculateDataProjections(fitter_step)
+            return
+
+        model_coordinates_name = self._fitter.getModelCoordinatesField().getName()
+        context = Context('Warm Start')
+        region = context.getDefaultRegion()
+        sir = region.createStreaminformationRegion()
+        sir.createStreamresourceMemoryBuffer(read_model_buffer(fit_file))
+        result = region.read(sir)
+        assert result == RESULT_OK, "Failed to load warm start file " + str(fit_file)
+        fitted_coordinates = region.getFieldmodule().findFieldByName('fitted ' + model_coordinates_name)
+        assert fitted_coordinates.isValid(), "No fitted " + model_coordinates_name + " field in " + str(fit_file)
+
+        # under the model field's name the node parameters merge straight into the model on reading
+        fitted_coordinates.setName(model_coordinates_name)
+        sir = region.createStreaminformationRegion()
+        srm = sir.createStreamresourceMemory()
+        sir.setResourceDomainTypes(srm, Field.DOMAIN_TYPE_NODES)
+        region.write(sir)
+        result, buffer = srm.getBuffer()
+        assert result == RESULT_OK, "Failed to write warm start coordinates"
+
+        sir = self._fitter.getRegion().createStreaminformationRegion()
+        sir.createStreamresourceMemoryBuffer(buffer)
+        result = self._fitter.getRegion().read(sir)
+        assert result == RESULT_OK, "Failed to seed model coordinates from " + str(fit_file)
+        self._fitter.calculateDataProjections(fitter_step)
+
+    def _iteration_files(self, index, fitter_step, iterations, every_iteration) -> list:
+        """
+        :return: paths of the files written for a step with every iteration written, named as scaffoldfitter names
+        them: <stem><index>_config.exf, <stem><index>_align.exf and <stem><index>_fit<iteration>.exf. Files of an
+        earlier fit in the same directory are not included.
+        """
+        stem = f'{self._output_dir}{index}'
+        if not self._is_iterative(fitter_step):
+            return [Path(f'{stem}_{step_type_name(fitter_step.getJsonTypeId())}.exf')]
+        first_iteration = 1 if every_iteration else iterations
+        return [Path(f'{stem}_fit{iteration}.exf') for iteration in range(first_iteration, iterations + 1)]
+
+    @staticmethod
+    def _is_iterative(fitter_step):
+        return fitter_step.getJsonTypeId() == '_FitterStepFit'
+
+    def _run_until_converged(self, index, fitter_step):
+        """
+        Run the iterations of a fit step one at a time and stop once the relative change of the data RMS drops below
+        the convergence tolerance, or the configured number of iterations is reached. When the output policy writes
+        every iteration, only the model after the last iteration is written here.
+
+        :return: number of iterations run.
+        """
+        maximum_iterations = fitter_step.getNumberOfIterations()
+        if fitter_step.isUpdateReferenceState():
+            # the reference state is updated at the end of every run, so the iterations cannot be split up
+            self._fitter.run(endStep=fitter_step, modelFileNameStem=self._iteration_stem())
+            return maximum_iterations
+
+        previous_rms = self.get_total_rms()[0]
+        iterations = 0
+        fitter_step.setNumberOfIterations(1)
+        try:
+            while iterations < maximum_iterations:
+                fitter_step.run(None)
+                iterations += 1
+                rms = self.get_total_rms()[0]
+                if previous_rms and abs(previous_rms - rms) / previous_rms < self._convergence_tolerance:
+                    break
+                previous_rms = rms
+        finally:
+            fitter_step.setNumberOfIterations(maximum_iterations)
+
+        if self._output_policy.writes_iterations:
+            self._fitter.writeModel(str(self._output_dir) + str(index) + "_fit" + str(iterations) + ".exf")
+        return iterations
+
+    def _record_step(self, index, fitter_step, iterations, wall_time, cpu_time, bytes_written, peak_rss):
+        rms, max_error = self.get_total_rms()
+        metrics = {'step': index,
+                   'type': fitter_step.getJsonTypeId(),
+                   'iterations': iterations,
+                   'wall_time': wall_time,
+                   'cpu_time': cpu_time,
+                   'peak_rss': peak_rss,
+                   'rms': rms,
+                   'max_error': max_error,
+                   'bytes_written': bytes_written}
+        self._step_metrics.append(metrics)
+        if self._events_file is not None:
+            with open(self._events_file, 'a') as f:
+                f.write(json.dumps(metrics) + '\n')
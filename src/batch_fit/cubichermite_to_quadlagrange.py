@@ -1,183 +1,197 @@
 import argparse
-from scipy.spatial import cKDTree
+from pathlib import Path
+
+import numpy as np
 
 from opencmiss.zinc.context import Context
 from opencmiss.zinc.field import Field
 from opencmiss.zinc.node import Node
-from opencmiss.utils.zinc.finiteelement import getMaximumNodeIdentifier, getMaximumElementIdentifier
 from opencmiss.zinc.element import Element, Elementbasis
+from opencmiss.utils.zinc.general import ChangeManager
+from opencmiss.utils.zinc.finiteelement import getMaximumNodeIdentifier
 from opencmiss.utils.zinc.field import findOrCreateFieldCoordinates
 
 
-def create_middle_nodes(zinc_file):
+# xi of the 27 local nodes of a quadratic Lagrange element, xi1 varying fastest. Index (i, j, k) is at xi
+# (i/2, j/2, k/2), so local node i + 3*j + 9*k lies between the cube corners with xi (i//2, j//2, k//2) when no index
+# is 1, and spans both corners in every direction whose index is 1
+QUADRATIC_LAGRANGE_INDEXES = [(i, j, k) for k in range(3) for j in range(3) for i in range(3)]
+
+DEFAULT_FIELD_NAMES = ('coordinates', 'lung coordinates')
+
+
+def element_corner_nodes(element, eft) -> list:
+    """
+    :return: identifiers of the 8 corner nodes of a trilinear or tricubic Hermite element, xi1 varying fastest.
+    Collapsed elements repeat the node of the collapsed corners.
+    """
+    basis = eft.getElementbasis()
+    for xi_index in range(1, 4):
+        assert basis.getFunctionType(xi_index) in (Elementbasis.FUNCTION_TYPE_LINEAR_LAGRANGE,
+                                                   Elementbasis.FUNCTION_TYPE_CUBIC_HERMITE), \
+            "Element " + str(element.getIdentifier()) + " is not trilinear or tricubic Hermite"
+    # the value function of each corner comes first among its functions
+    functions_per_corner = eft.getNumberOfFunctions() // 8
+    corner_nodes = list()
+    for corner in range(8):
+        function_number = corner * functions_per_corner + 1
+        assert eft.getFunctionNumberOfTerms(function_number) == 1, \
+            "No single value parameter at a corner of element " + str(element.getIdentifier())
+        node = element.getNode(eft, eft.getTermLocalNodeIndex(function_number, 1))
+        corner_nodes.append(node.getIdentifier())
+    return corner_nodes
+
+
+def quadratic_node_keys(element_identifier: int, corner_nodes: list) -> list:
+    """
+    Topological identity of the 27 quadratic Lagrange nodes of an element: the set of corner nodes of the line or
+    face each node is the midpoint of. Neighbouring elements sharing a line or face get the same key for its
+    midpoint, and a line collapsed to a single node maps its midpoint onto that node.
+
+    :return: list of 27 keys, an int for nodes that are an existing node and a tuple for new midpoint nodes.
+    """
+    keys = list()
+    for index in QUADRATIC_LAGRANGE_INDEXES:
+        if all(i == 1 for i in index):
+            keys.append(('element', element_identifier))
+            continue
+        spanned = [(0, 1) if i == 1 else (i // 2,) for i in index]
+        nodes = sorted(set(corner_nodes[a + 2 * b + 4 * c]
+                           for c in spanned[2] for b in spanned[1] for a in spanned[0]))
+        keys.append(nodes[0] if len(nodes) == 1 else tuple(nodes))
+    return keys
+
+
+def create_middle_nodes(zinc_file, field_names=DEFAULT_FIELD_NAMES):
     """
-    Create middle nodes in cubic hermite mesh. Loop over each line and create a middle node. repeat it for the faces
-    and elements
-    :param zinc_file:
-    :return:
+    Derive the nodes of a quadratic Lagrange mesh from the 3D elements of a cubic Hermite mesh. Corner nodes keep
+    their identifiers and coordinates. A midpoint node is made once per line, face and element, shared through the
+    mesh topology, and its coordinates are evaluated in the first element using it.
+
+    :param zinc_file: cubic Hermite model file.
+    :param field_names: coordinate fields to convert, the first one must exist.
+    :return: node identifiers, dict of field name to (number of nodes, components) array of node coordinates, and
+    the 27 node identifiers of every element.
     """
     context = Context('create_middle_nodes')
     region = context.getDefaultRegion()
-    region.readFile(zinc_file)
+    region.readFile(str(zinc_file))
     field_module = region.getFieldmodule()
-    coordinates = field_module.findFieldByName('coordinates').castFiniteElement()
-    lung_coordinates = field_module.findFieldByName('lung coordinates').castFiniteElement()
+    fields = [field_module.findFieldByName(field_name).castFiniteElement() for field_name in field_names]
+    assert fields[0].isValid(), "No " + field_names[0] + " field in " + str(zinc_file)
+    fields = [(field_name, field) for field_name, field in zip(field_names, fields) if field.isValid()]
     nodes = field_module.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
-    mesh1d = field_module.findMeshByDimension(1)
-    mesh2d = field_module.findMeshByDimension(2)
     mesh3d = field_module.findMeshByDimension(3)
-
     fieldcache = field_module.createFieldcache()
-    fieldcache2 = field_module.createFieldcache()
-
-    # create a node template with 2 coordinate fields
-    nodetemplate = nodes.createNodetemplate()
-    nodetemplate.defineField(coordinates)
-    nodetemplate.defineField(lung_coordinates)
-    nodetemplate.setValueNumberOfVersions(coordinates, -1, Node.VALUE_LABEL_VALUE, 1)
-    nodetemplate.setValueNumberOfVersions(lung_coordinates, -1, Node.VALUE_LABEL_VALUE, 1)
-
-    nodeIdentifier = max(1, getMaximumNodeIdentifier(nodes) + 1)
-    # get element iterator for line, face and element and loop over each element and add a middle point
-    for mesh in [mesh1d, mesh2d, mesh3d]:
-        elementiterator = mesh.createElementiterator()
-        element = elementiterator.next()
-        if mesh.getDimension() == 1:
-            xi_list = [0.5]
-        elif mesh.getDimension() == 2:
-            xi_list = [[0.5, 0.5]]
-        else:
-            xi_list = [[0.5, 0.5, 0.5]]
-        while element.isValid():
-            print(element.getIdentifier())
-            # create the middle nodes where at least one xi is 0.5 in one of the directions
-            for xi in xi_list:
-                # get coordinates at xi
-                fieldcache2.setMeshLocation(element, xi)
-                result, x = coordinates.evaluateReal(fieldcache2, coordinates.getNumberOfComponents())
-                result, x_lc = lung_coordinates.evaluateReal(fieldcache2, lung_coordinates.getNumberOfComponents())
-                # create a node at x
-                node = nodes.createNode(nodeIdentifier, nodetemplate)
-                fieldcache.setNode(node)
-                coordinates.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, x)
-                lung_coordinates.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, x_lc)
-                nodeIdentifier += 1
-            element = elementiterator.next()
-
-    # get all the nodes and create a kd tree
-    points = []
-    points2 = []
-    node_ids = []
-    node_iterator = nodes.createNodeiterator()
-    node = node_iterator.next()
-    while node.isValid():
-        fieldcache.setNode(node)
-        result, x = coordinates.evaluateReal(fieldcache, coordinates.getNumberOfComponents())
-        result, x_lc = lung_coordinates.evaluateReal(fieldcache, lung_coordinates.getNumberOfComponents())
-        if node.getIdentifier() not in [136, 137, 138, 139]:
-            points.append(x)
-            points2.append(x_lc)
-            node_ids.append(node.getIdentifier())
-        node = node_iterator.next()
-
-    tree = cKDTree(points)
-    elementiterator = mesh3d.createElementiterator()
-    element = elementiterator.next()
-
-    xis = [0.0, 0.5, 1.0]
-    xi_list = [[x, y, z] for z in xis for y in xis for x in xis]
-    elem_node_lists = []
-    # element_ids
-    # get node identifiers for each element
+
+    # topology first: corners and midpoint keys of every element, with the element and xi to evaluate a new node at
+    node_index = dict()
+    evaluate_at = list()
+    element_keys = list()
+    element_iterator = mesh3d.createElementiterator()
+    element = element_iterator.next()
     while element.isValid():
-        elem_node_list = []
-        for xi in xi_list:
+        corner_nodes = element_corner_nodes(element, element.getElementfieldtemplate(fields[0][1], -1))
+        keys = quadratic_node_keys(element.getIdentifier(), corner_nodes)
+        for key, index in zip(keys, QUADRATIC_LAGRANGE_INDEXES):
+            if key not in node_index:
+                node_index[key] = len(evaluate_at)
+                evaluate_at.append((element, [i / 2 for i in index], key))
+        element_keys.append(keys)
+        element = element_iterator.next()
+
+    # then every node is evaluated exactly once; only nodes used by elements are kept, so marker nodes drop out
+    values = {field_name: np.empty((len(evaluate_at), field.getNumberOfComponents())) for field_name, field in fields}
+    next_identifier = max(1, getMaximumNodeIdentifier(nodes) + 1)
+    node_ids = list()
+    for row, (element, xi, key) in enumerate(evaluate_at):
+        if isinstance(key, int):
+            fieldcache.setNode(nodes.findNodeByIdentifier(key))
+            node_ids.append(key)
+        else:
             fieldcache.setMeshLocation(element, xi)
-            result, x = coordinates.evaluateReal(fieldcache, coordinates.getNumberOfComponents())
-            dist, idx = tree.query(x)
-            elem_node_list.append(node_ids[idx])
-        elem_node_lists.append(elem_node_list)
-        element = elementiterator.next()
-
-    # fielditer = field_module.createFielditerator()
-    # field = fielditer.next()
-    # while field.isValid():
-    #     field_name = field.getName()
-    #     if 'marker' in field_name.lower():
-    #         if 'name' in field_name.lower():
-    #             marker_name = field_name
-    #         elif 'location' in field_name.lower():
-    #             marker_location_name = field_name
-    #         elif '.' not in field_name:
-    #             marker_group_name = field_name
-    #     field = fielditer.next()
-    # if all([marker_name, marker_location_name, marker_group_name]):
-    #     return marker_location_name, marker_name, marker_group_name
-    # else:
-    #     raise AssertionError('Could not find marker fields')
-
-    return node_ids, points, points2, elem_node_lists
-
-
-def create_quad_lagrange_elements(node_ids, points, points2, elem_node_lists):
+            node_ids.append(next_identifier)
+            next_identifier += 1
+        for field_name, field in fields:
+            result, x = field.evaluateReal(fieldcache, field.getNumberOfComponents())
+            values[field_name][row] = x
+
+    node_ids = np.asarray(node_ids)
+    elem_node_lists = [[int(node_ids[node_index[key]]) for key in keys] for keys in element_keys]
+    return node_ids, values, elem_node_lists
+
+
+def create_quad_lagrange_elements(node_ids, points, elem_node_lists, output_file):
     """
-    Read the zinc file which includes the middle nodes and create quadratic lagrange elements.
-
-    *** Not sure why 1D mesh and 2D mesh do not return the nodes - I am going to use closest point to generate
-    the elements
-    :param node_ids: list of node identifiers corresponding to points
-    :param points: list of coordinates.
-    :param points2: list of lung coordinates.
-    :param elem_node_lists: list of node identifiers for each element
-    :return:
+    Write a quadratic Lagrange mesh with the given nodes and elements.
+
+    :param node_ids: node identifiers.
+    :param points: dict of coordinate field name to the coordinates of every node.
+    :param elem_node_lists: list of the 27 node identifiers of every element.
+    :param output_file: model file to write.
     """
     context = Context('create_elements')
     region = context.getDefaultRegion()
     field_module = region.getFieldmodule()
-    coordinates = findOrCreateFieldCoordinates(field_module, name="coordinates")
-    lung_coordinates = findOrCreateFieldCoordinates(field_module, name="lung coordinates")
     nodes = field_module.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
     mesh3d = field_module.findMeshByDimension(3)
-
     fieldcache = field_module.createFieldcache()
 
-    nodetemplate = nodes.createNodetemplate()
-    nodetemplate.defineField(coordinates)
-    nodetemplate.defineField(lung_coordinates)
-    nodetemplate.setValueNumberOfVersions(coordinates, -1, Node.VALUE_LABEL_VALUE, 1)
-    nodetemplate.setValueNumberOfVersions(lung_coordinates, -1, Node.VALUE_LABEL_VALUE, 1)
+    with ChangeManager(field_module):
+        fields = [(findOrCreateFieldCoordinates(field_module, name=field_name), values)
+                  for field_name, values in points.items()]
 
-    for node_id, point, point2 in zip(node_ids, points, points2):
-        node = nodes.createNode(node_id, nodetemplate)
-        fieldcache.setNode(node)
-        coordinates.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, point)
-        lung_coordinates.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, point2)
+        nodetemplate = nodes.createNodetemplate()
+        for field, _ in fields:
+            nodetemplate.defineField(field)
+            nodetemplate.setValueNumberOfVersions(field, -1, Node.VALUE_LABEL_VALUE, 1)
 
-    # create quadratic lagrange 3d mesh
-    quadratic_lagrange_basis = field_module.createElementbasis(3, Elementbasis.FUNCTION_TYPE_QUADRATIC_LAGRANGE)
-    eft = mesh3d.createElementfieldtemplate(quadratic_lagrange_basis)
-    elementtemplate = mesh3d.createElementtemplate()
-    elementtemplate.setElementShapeType(Element.SHAPE_TYPE_CUBE)
-    result = elementtemplate.defineField(coordinates, -1, eft)
-    result = elementtemplate.defineField(lung_coordinates, -1, eft)
+        for row, node_id in enumerate(node_ids):
+            node = nodes.createNode(int(node_id), nodetemplate)
+            fieldcache.setNode(node)
+            for field, values in fields:
+                field.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, values[row].tolist())
 
-    elementIdentifier = 1
-    for elem_node_list in elem_node_lists:
-        element = mesh3d.createElement(elementIdentifier, elementtemplate)
-        element.setNodesByIdentifier(eft, elem_node_list)
-        elementIdentifier += 1
+        quadratic_lagrange_basis = field_module.createElementbasis(3, Elementbasis.FUNCTION_TYPE_QUADRATIC_LAGRANGE)
+        eft = mesh3d.createElementfieldtemplate(quadratic_lagrange_basis)
+        elementtemplate = mesh3d.createElementtemplate()
+        elementtemplate.setElementShapeType(Element.SHAPE_TYPE_CUBE)
+        for field, _ in fields:
+            elementtemplate.defineField(field, -1, eft)
 
-    field_module.defineAllFaces()
-    region.writeFile('lung_quad_lagrange7.exf')
+        for element_identifier, elem_node_list in enumerate(elem_node_lists, start=1):
+            element = mesh3d.createElement(element_identifier, elementtemplate)
+            element.setNodesByIdentifier(eft, elem_node_list)
 
+        field_module.defineAllFaces()
+    region.writeFile(str(output_file))
 
-if __name__ == "__main__":
-    ar = argparse.ArgumentParser()
-    ar.add_argument('-f', '--file', help='Input file')
-    args = vars(ar.parse_args())
 
-    node_ids, points, points2, elem_node_lists = create_middle_nodes(args['file'])
-    create_quad_lagrange_elements(node_ids, points, points2, elem_node_lists)
+def convert(input_file, output_file, field_names=DEFAULT_FIELD_NAMES):
+    node_ids, points, elem_node_lists = create_middle_nodes(input_file, field_names)
+    create_quad_lagrange_elements(node_ids, points, elem_node_lists, output_file)
 
 
+def output_path(input_file: Path, output, many_inputs: bool) -> Path:
+    """
+    :return: where to write the conversion of input_file: `output` itself for a single input, otherwise
+    <stem>_quad_lagrange.exf inside the `output` directory, or next to the input file when no output is given.
+    """
+    if output is not None and not many_inputs:
+        return Path(output)
+    directory = Path(output) if output is not None else input_file.parent
+    return directory / f'{input_file.stem}_quad_lagrange.exf'
+
+
+if __name__ == "__main__":
+    ar = argparse.ArgumentParser()
+    ar.add_argument('-f', '--file', nargs='+', required=True, help='Input cubic Hermite files')
+    ar.add_argument('-o', '--output', help='Output file for a single input, or output directory for several')
+    ar.add_argument('--fields', nargs='+', default=list(DEFAULT_FIELD_NAMES), help='Coordinate fields to convert')
+    args = vars(ar.parse_args())
 
+    input_files = [Path(file_name) for file_name in args['file']]
+    if args['output'] is not None and len(input_files) > 1:
+        Path(args['output']).mkdir(parents=True, exist_ok=True)
+    for input_file in input_files:
+        convert(input_file, output_path(input_file, args['output'], len(input_files) > 1), args['fields'])
@@ -1,13 +1,17 @@
+import warnings
+
+import numpy as np
+
 from opencmiss.zinc.context import Context
 from opencmiss.zinc.field import FieldGroup
 from opencmiss.zinc.result import RESULT_OK
-from opencmiss.zinc.field import Field
 
 from opencmiss.utils.zinc.general import ChangeManager
 from opencmiss.utils.zinc.general import AbstractNodeDataObject
-from opencmiss.utils.zinc.general import create_node as create_zinc_node
 from opencmiss.utils.zinc.field import create_field_coordinates, find_or_create_field_group
 
+from .ex_reader import read_ex_points
+
 
 class Point(AbstractNodeDataObject):
 
@@ -28,6 +32,13 @@ class Point(AbstractNodeDataObject):
 
 
 def write_ex(file_name, data):
+    """
+    Write the data points of all groups into a single EX file.
+
+    :param file_name: output EX file.
+    :param data: dict of group name to the group's points, either as an (N, 3) array or a list of coordinates or
+    Point objects.
+    """
     context = Context("Lung Data")
     region = context.getDefaultRegion()
     load(region, data)
@@ -36,68 +47,124 @@ def write_ex(file_name, data):
     region.writeFile(file_name)
 
 
-def read_single_group(file_name):
-    context = Context('Single Data')
+def write_ex_buffer(data) -> bytes:
+    """
+    The EX file write_ex would write for the data points of all groups, serialized in memory.
+    """
+    context = Context("Lung Data")
     region = context.getDefaultRegion()
-    result = region.readFile(file_name)
-    assert result == RESULT_OK, "Failed to load data file " + str(file_name)
-    node_parameters = extract_node_parameter(region)
-    return node_parameters
+    load(region, data)
+    return region_buffer(region)
 
 
-def extract_node_parameter(region):
-    fieldmodule = region.getFieldmodule()
-    coordinates = fieldmodule.findFieldByName('coordinates').castFiniteElement()
-    components_count = coordinates.getNumberOfComponents()
-    assert components_count in [1, 2, 3], 'extract_node_parameter. Invalid coordinates number of components'
-    cache = fieldmodule.createFieldcache()
+def region_buffer(region) -> bytes:
+    """
+    :return: everything in a region, serialized in memory in the EX format.
+    """
+    sir = region.createStreaminformationRegion()
+    srm = sir.createStreamresourceMemory()
+    region.write(sir)
+    result, buffer = srm.getBuffer()
+    assert result == RESULT_OK, "Failed to serialize region"
+    return buffer
 
-    return_values = list()
-    nodes = fieldmodule.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
-    node_iter = nodes.createNodeiterator()
-    node = node_iter.next()
-    while node.isValid():
-        cache.setNode(node)
-        result, values = coordinates.getNodeParameters(cache, -1, 1, 1, components_count)
-        return_values.append(values)
-        node = node_iter.next()
 
-    return return_values
+def read_single_group(file_name):
+    """
+    :return: (N, 3) array of the node coordinates in the file.
+    """
+    return read_ex_points(file_name, nodeset='nodes').coordinates
 
 
 def load(region, data):
     field_module = region.getFieldmodule()
-    coordinate_filed = create_field_coordinates(field_module)
+    with ChangeManager(field_module):
+        coordinates = create_field_coordinates(field_module)
+        nodeset = field_module.findNodesetByName('datapoints')
+        node_template = nodeset.createNodetemplate()
+        node_template.defineField(coordinates)
+        field_cache = field_module.createFieldcache()
+
+        for surface, points in data.items():
+            nodeset_group = get_group_nodeset(field_module, surface, node_set_name='datapoints')
+            create_datapoints(nodeset, nodeset_group, node_template, field_cache, coordinates, as_point_array(points))
+
+
+def as_point_array(points):
+    """
+    Convert the points of one group to an (N, 3) float64 array. Lists of Point objects, possibly nested, are
+    accepted for compatibility with the earlier per-point interface.
+    """
+    if isinstance(points, np.ndarray):
+        return np.asarray(points, dtype=np.float64).reshape(-1, 3)
+
+    flat_points = list()
+    for pt in points:
+        if isinstance(pt, AbstractNodeDataObject):
+            flat_points.append(pt.coordinates())
+        elif len(pt) and isinstance(pt[0], (list, AbstractNodeDataObject)):
+            flat_points.extend(as_point_array(pt))
+        else:
+            flat_points.append(pt)
 
-    for surface, points in data.items():
-        node_identifiers = create_nodes(field_module, points)
-        create_group_nodes(field_module, surface, node_identifiers, node_set_name='datapoints')
+    return np.asarray(flat_points, dtype=np.float64).reshape(-1, 3)
 
 
-def create_nodes(field_module, embedded_lists, node_set_name='datapoints'):
-    node_identifiers = []
-    for pt in embedded_lists:
-        if isinstance(pt, list):
-            node_ids = create_nodes(field_module, pt, node_set_name=node_set_name)
-            node_identifiers.extend(node_ids)
-        else:
-            local_node_id = create_zinc_node(field_module, pt, node_set_name=node_set_name)
-            node_identifiers.append(local_node_id)
+def create_datapoints(nodeset, nodeset_group, node_template, field_cache, coordinates, points) -> list:
+    """
+    Create one datapoint per row of `points` from a shared node template and add it to the group straight away, if
+    a group is given. Call inside a ChangeManager so Zinc sends a single change notification for the whole group.
 
+    :return: identifiers of the datapoints created.
+    """
+    node_identifiers = list()
+    for xyz in points.tolist():
+        node = nodeset.createNode(-1, node_template)
+        field_cache.setNode(node)
+        coordinates.assignReal(field_cache, xyz)
+        if nodeset_group is not None:
+            nodeset_group.addNode(node)
+        node_identifiers.append(node.getIdentifier())
     return node_identifiers
 
 
-def create_group_nodes(field_module, group_name, node_ids, node_set_name='datapoints'):
+def create_nodes(field_module, embedded_lists, node_set_name='datapoints'):
+    """
+    Deprecated, use load, which creates the points of every group in bulk.
+    Create a node with the 'coordinates' field for every point of a possibly nested list of points.
+
+    :return: list of node identifiers.
+    """
+    warnings.warn('create_nodes is deprecated, use load', DeprecationWarning, stacklevel=2)
     with ChangeManager(field_module):
-        group = find_or_create_field_group(field_module, name=group_name)
-        group.setSubelementHandlingMode(FieldGroup.SUBELEMENT_HANDLING_MODE_FULL)
+        coordinates = field_module.findFieldByName('coordinates').castFiniteElement()
+        nodeset = field_module.findNodesetByName(node_set_name)
+        node_template = nodeset.createNodetemplate()
+        node_template.defineField(coordinates)
+        return create_datapoints(nodeset, None, node_template, field_module.createFieldcache(), coordinates,
+                                 as_point_array(embedded_lists))
+
 
+def create_group_nodes(field_module, group_name, node_ids, node_set_name='datapoints'):
+    """
+    Deprecated, use load, which adds the points of every group as they are created.
+    Add the nodes with the given identifiers to a group, created if need be.
+    """
+    warnings.warn('create_group_nodes is deprecated, use load', DeprecationWarning, stacklevel=2)
+    with ChangeManager(field_module):
         nodeset = field_module.findNodesetByName(node_set_name)
-        node_group = group.getFieldNodeGroup(nodeset)
-        if not node_group.isValid():
-            node_group = group.createFieldNodeGroup(nodeset)
+        nodeset_group = get_group_nodeset(field_module, group_name, node_set_name=node_set_name)
+        for node_id in node_ids:
+            nodeset_group.addNode(nodeset.findNodeByIdentifier(node_id))
 
-        nodeset_group = node_group.getNodesetGroup()
-        for group_node_id in node_ids:
-            node = nodeset.findNodeByIdentifier(group_node_id)
-            nodeset_group.addNode(node)
+
+def get_group_nodeset(field_module, group_name, node_set_name='datapoints'):
+    group = find_or_create_field_group(field_module, name=group_name)
+    group.setSubelementHandlingMode(FieldGroup.SUBELEMENT_HANDLING_MODE_FULL)
+
+    nodeset = field_module.findNodesetByName(node_set_name)
+    node_group = group.getFieldNodeGroup(nodeset)
+    if not node_group.isValid():
+        node_group = group.createFieldNodeGroup(nodeset)
+
+    return node_group.getNodesetGroup()
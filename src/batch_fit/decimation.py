@@ -0,0 +1,61 @@
+import numpy as np
+
+
+def voxel_decimate(points: np.ndarray, spacing: float) -> np.ndarray:
+    """
+    Voxel-grid decimation: bin the points into cubes of side `spacing` and keep, for every occupied cube, the point
+    closest to the mean of the points in it. Kept points are original data points, so surfaces are not smoothed.
+
+    :param points: (N, 3) array.
+    :param spacing: voxel size, in data units. Values <= 0 keep every point.
+    :return: sorted row indices of the kept points.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    if spacing is None or spacing <= 0 or len(points) < 2:
+        return np.arange(len(points))
+
+    voxels = np.floor((points - points.min(axis=0)) / spacing).astype(np.int64)
+    _, voxel_index, voxel_counts = np.unique(voxels, axis=0, return_inverse=True, return_counts=True)
+    voxel_index = voxel_index.reshape(-1)
+
+    voxel_means = np.zeros((len(voxel_counts), 3))
+    np.add.at(voxel_means, voxel_index, points)
+    voxel_means /= voxel_counts[:, None]
+    distances = np.einsum('ij,ij->i', points - voxel_means[voxel_index], points - voxel_means[voxel_index])
+
+    # order by voxel then by distance, the first row of each voxel is the one kept
+    order = np.lexsort((distances, voxel_index))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = voxel_index[order][1:] != voxel_index[order][:-1]
+    return np.sort(order[first])
+
+
+def group_spacing(file_stem: str, decimation: dict) -> float:
+    """
+    Target spacing of a group: its entry in decimation['spacing'] if any, otherwise edge_spacing for edge_* groups
+    and surface_spacing for everything else.
+    """
+    overrides = decimation.get('spacing') or dict()
+    if file_stem in overrides:
+        return overrides[file_stem]
+    if file_stem.startswith('edge_'):
+        return decimation.get('edge_spacing', 0.0)
+    return decimation.get('surface_spacing', 0.0)
+
+
+def decimate_groups(data: dict, spacings: dict):
+    """
+    Decimate every group of a subject.
+
+    :param data: dict of group name to (N, 3) array.
+    :param spacings: dict of group name to target spacing; groups without one are kept whole.
+    :return: the decimated data and a dict of group name to (points in, points out).
+    """
+    decimated = dict()
+    report = dict()
+    for group_name, points in data.items():
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        kept = points[voxel_decimate(points, spacings.get(group_name, 0.0))]
+        decimated[group_name] = kept
+        report[group_name] = (len(points), len(kept))
+    return decimated, report
@@ -0,0 +1,254 @@
+import itertools
+import re
+import warnings
+from typing import Dict, NamedTuple
+
+import numpy as np
+
+
+class ExPoints(NamedTuple):
+    coordinates: np.ndarray  # (N, 3) float64, in identifier order
+    identifiers: np.ndarray  # (N,) int64
+    groups: Dict[str, np.ndarray]  # group name -> row indices into coordinates
+
+
+class UnsupportedExFormat(Exception):
+    """
+    Raised by the native parser for anything outside the simple point-cloud EX layout it understands.
+    """
+
+
+_HEADER_PATTERNS = [re.compile(p) for p in (
+    r'EX Version: 3$',
+    r'Region: /$',
+    r'!#nodeset (\w+)$',
+    r'Define node template: \S+$',
+    r'Shape\. Dimension=0$',
+    r'#Fields=1$',
+    r'1\) coordinates, coordinate, rectangular cartesian, real, #Components=3$',
+    r'[xyz]\. #Values=1 \(value\)$',
+    r'Node template: \S+$',
+)]
+_NODESET_PATTERN = _HEADER_PATTERNS[2]
+_RANGE_PATTERN = re.compile(r'^(\d+)(?:\.\.(\d+))?$')
+
+# characters of a file read and converted at a time
+_BLOCK_SIZE = 1 << 20
+
+
+def read_ex_points(file_name, nodeset: str = 'datapoints') -> ExPoints:
+    """
+    Read the point coordinates and group membership of an EX/EXDATA file. Files holding a single 3 component
+    'coordinates' field, as written for the lung data, are parsed directly with NumPy; everything else falls back to
+    loading the file in a Zinc region.
+
+    :param file_name: EX file to read.
+    :param nodeset: 'nodes' or 'datapoints', the nodeset to read the points from.
+    """
+    try:
+        return parse_ex_points(file_name, nodeset)
+    except UnsupportedExFormat:
+        return read_ex_points_zinc(file_name, nodeset)
+
+
+def parse_ex_points(file_name, nodeset: str = 'datapoints') -> ExPoints:
+    """
+    Parse a point-cloud EX file as it is read, _BLOCK_SIZE characters at a time: the header is checked against the
+    simple layout, the node block is converted by NumPy a block at a time and the groups are read last, so only the
+    parsed values and one block of text are held in memory.
+
+    :raises UnsupportedExFormat: for anything outside the layout, which read_ex_points reads with Zinc instead.
+    """
+    with open(file_name, 'r') as f:
+        blocks = _read_blocks(f)
+
+        header = ''
+        for block in blocks:
+            node_start = block.find('Node:')
+            if node_start >= 0:
+                header += block[:node_start]
+                block = block[node_start:]
+                break
+            header += block
+        else:
+            raise UnsupportedExFormat('no nodes')
+        file_nodeset = _parse_header(header)
+        if file_nodeset != nodeset:
+            # let Zinc decide what ends up in the requested nodeset
+            raise UnsupportedExFormat(f'points are in nodeset {file_nodeset}')
+
+        # nodes: 'Node: <id>' followed by x y z, split over any number of lines, up to the first group. Anything else
+        # in this block makes the number of parsed values disagree with the node count
+        chunks = list()
+        node_count = 0
+        group_text = list()
+        for block in itertools.chain([block], blocks):
+            group_start = block.find('Group name:')
+            if group_start >= 0:
+                node_count += _parse_nodes(block[:group_start], chunks)
+                group_text.append(block[group_start:])
+                group_text.extend(blocks)
+                break
+            node_count += _parse_nodes(block, chunks)
+        values = np.concatenate(chunks)
+        if values.size != 4 * node_count:
+            raise UnsupportedExFormat('unexpected content in node block')
+        values = values.reshape(-1, 4)
+        identifiers = values[:, 0].astype(np.int64)
+        coordinates = values[:, 1:]
+        if np.any(np.diff(identifiers) <= 0):
+            order = np.argsort(identifiers, kind='stable')
+            identifiers = identifiers[order]
+            coordinates = coordinates[order]
+            if np.any(np.diff(identifiers) == 0):
+                raise UnsupportedExFormat('duplicate node identifiers')
+
+        groups = _parse_groups(''.join(group_text), file_nodeset, identifiers)
+
+    return ExPoints(np.ascontiguousarray(coordinates), identifiers, groups)
+
+
+def _read_blocks(f):
+    """
+    :return: generator of about _BLOCK_SIZE characters of `f` at a time, every block ending at the end of a line.
+    """
+    rest = ''
+    while True:
+        block = f.read(_BLOCK_SIZE)
+        if not block:
+            if rest:
+                yield rest
+            return
+        block = rest + block
+        line_end = block.rfind('\n') + 1
+        rest = block[line_end:]
+        if line_end:
+            yield block[:line_end]
+
+
+def _parse_header(text) -> str:
+    """
+    Check the header holds one node template defining coordinates only.
+
+    :return: the nodeset of the nodes, 'nodes' if the header does not name one.
+    """
+    file_nodeset = 'nodes'
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        for pattern in _HEADER_PATTERNS:
+            match = pattern.match(line)
+            if match:
+                if pattern is _NODESET_PATTERN:
+                    file_nodeset = match.group(1)
+                break
+        else:
+            raise UnsupportedExFormat(line)
+    return file_nodeset
+
+
+def _parse_nodes(text, chunks: list) -> int:
+    """
+    Convert whole lines of the node block to floats, identifiers included, and append them to `chunks`.
+
+    :return: number of nodes started in the text.
+    """
+    with warnings.catch_warnings():
+        # unparsable text stops the conversion early, which the size check of the caller catches
+        warnings.simplefilter('ignore', DeprecationWarning)
+        try:
+            chunks.append(np.fromstring(text.replace('Node:', ' '), dtype=np.float64, sep=' '))
+        except ValueError:
+            raise UnsupportedExFormat('unexpected content in node block')
+    return text.count('Node:')
+
+
+def _parse_groups(text, file_nodeset, identifiers):
+    groups = dict()
+    group_name = None
+    ranges = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('Group name:'):
+            group_name = line[len('Group name:'):].strip()
+            ranges = None
+        elif line.startswith('!#nodeset '):
+            if group_name is None or line != f'!#nodeset {file_nodeset}':
+                raise UnsupportedExFormat(line)
+        elif line == 'Node group:':
+            if group_name is None:
+                raise UnsupportedExFormat(line)
+            ranges = groups.setdefault(group_name, list())
+        elif ranges is not None:
+            for token in line.replace(',', ' ').split():
+                match = _RANGE_PATTERN.match(token)
+                if match is None:
+                    raise UnsupportedExFormat(line)
+                first = int(match.group(1))
+                last = int(match.group(2)) if match.group(2) else first
+                ranges.append((first, last))
+        else:
+            raise UnsupportedExFormat(line)
+
+    group_rows = dict()
+    for group_name, ranges in groups.items():
+        rows = [np.arange(np.searchsorted(identifiers, first), np.searchsorted(identifiers, last, side='right'))
+                for first, last in ranges]
+        group_rows[group_name] = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+
+    return group_rows
+
+
+def read_ex_points_zinc(file_name, nodeset: str = 'datapoints') -> ExPoints:
+    # Zinc is only needed for files the native parser cannot read
+    from opencmiss.zinc.context import Context
+    from opencmiss.zinc.result import RESULT_OK
+
+    context = Context('Single Data')
+    region = context.getDefaultRegion()
+    result = region.readFile(str(file_name))
+    assert result == RESULT_OK, "Failed to load data file " + str(file_name)
+    fieldmodule = region.getFieldmodule()
+    coordinates_field = fieldmodule.findFieldByName('coordinates').castFiniteElement()
+    components_count = coordinates_field.getNumberOfComponents()
+    assert components_count in [1, 2, 3], 'read_ex_points. Invalid coordinates number of components'
+    cache = fieldmodule.createFieldcache()
+
+    identifiers = list()
+    coordinates = list()
+    zinc_nodeset = fieldmodule.findNodesetByName(nodeset)
+    node_iter = zinc_nodeset.createNodeiterator()
+    node = node_iter.next()
+    while node.isValid():
+        cache.setNode(node)
+        result, values = coordinates_field.getNodeParameters(cache, -1, 1, 1, components_count)
+        identifiers.append(node.getIdentifier())
+        coordinates.append(values if components_count > 1 else [values])
+        node = node_iter.next()
+
+    coordinates = np.zeros((len(identifiers), 3)) if not coordinates else \
+        np.pad(np.asarray(coordinates, dtype=np.float64), ((0, 0), (0, 3 - components_count)))
+    identifiers = np.asarray(identifiers, dtype=np.int64)
+
+    groups = dict()
+    field_iter = fieldmodule.createFielditerator()
+    field = field_iter.next()
+    while field.isValid():
+        group = field.castGroup()
+        if group.isValid():
+            node_group = group.getFieldNodeGroup(zinc_nodeset)
+            if node_group.isValid():
+                nodeset_group = node_group.getNodesetGroup()
+                member_ids = list()
+                node_iter = nodeset_group.createNodeiterator()
+                node = node_iter.next()
+                while node.isValid():
+                    member_ids.append(node.getIdentifier())
+                    node = node_iter.next()
+                groups[field.getName()] = np.searchsorted(identifiers, np.asarray(member_ids, dtype=np.int64))
+        field = field_iter.next()
+
+    return ExPoints(coordinates, identifiers, groups)
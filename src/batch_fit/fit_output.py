@@ -0,0 +1,243 @@
+import gzip
+from pathlib import Path
+from typing import NamedTuple, Tuple, Union
+
+import numpy as np
+
+from .manifest import hash_file
+
+
+OUTPUT_FORMATS = ('exf', 'exf.gz', 'exf.zst', 'npz')
+
+
+class OutputPolicy(NamedTuple):
+    """
+    Which fitter steps of a fit are written, and how.
+
+    `steps` is 'iterations' for the model after every iteration of every step, as scaffoldfitter writes it, 'all'
+    for the model after every step, 'final' for the model after the last step only, or a list of step indexes and
+    step types ('config', 'align', 'fit'), which may include 'final'. `format` is one of OUTPUT_FORMATS.
+    """
+    steps: Union[str, Tuple] = 'iterations'
+    format: str = 'exf'
+
+    @classmethod
+    def create(cls, steps='iterations', format: str = 'exf') -> 'OutputPolicy':
+        if format not in OUTPUT_FORMATS:
+            raise ValueError(f'Unknown fit output format {format}, expected one of {", ".join(OUTPUT_FORMATS)}')
+        if isinstance(steps, str):
+            if steps not in ('iterations', 'all', 'final'):
+                raise ValueError(f"Unknown fit output steps {steps}, expected 'iterations', 'all', 'final' or a list")
+        else:
+            steps = tuple(step if isinstance(step, int) else str(step).lower() for step in steps)
+        if steps == 'iterations' and format != 'exf':
+            raise ValueError("Every iteration is written by scaffoldfitter as plain EX, use steps 'all' for "
+                             f"{format} output")
+        if format == 'exf.zst':
+            _zstandard()
+        return cls(steps, format)
+
+    @property
+    def writes_iterations(self) -> bool:
+        return self.steps == 'iterations'
+
+    def selects(self, index: int, step_type: str, is_final: bool) -> bool:
+        """
+        :param step_type: JSON type id of the fitter step, e.g. '_FitterStepFit'.
+        :param is_final: whether the step is the last of the fit settings.
+        """
+        if self.steps in ('iterations', 'all'):
+            return True
+        steps = ('final',) if self.steps == 'final' else self.steps
+        return (is_final and 'final' in steps) or index in steps or step_type_name(step_type) in steps
+
+
+def step_type_name(step_type: str) -> str:
+    """
+    :return: short name of a fitter step type, e.g. 'fit' for '_FitterStepFit'.
+    """
+    return step_type.replace('_FitterStep', '').lower()
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('exf.zst fit output needs the zstandard package') from None
+    return zstandard
+
+
+def node_value_labels() -> tuple:
+    """
+    :return: every node value label a coordinates field can hold, in the order they are stored in a geometry dump.
+    """
+    # Zinc is imported where it is used, so the output policy can be set up without loading it
+    from opencmiss.zinc.node import Node
+    return (Node.VALUE_LABEL_VALUE, Node.VALUE_LABEL_D_DS1, Node.VALUE_LABEL_D_DS2, Node.VALUE_LABEL_D2_DS1DS2,
+            Node.VALUE_LABEL_D_DS3, Node.VALUE_LABEL_D2_DS1DS3, Node.VALUE_LABEL_D2_DS2DS3,
+            Node.VALUE_LABEL_D3_DS1DS2DS3)
+
+
+def model_buffer(fitter) -> bytes:
+    """
+    The EX file Fitter.writeModel writes, serialized in memory: the nodes and elements of the model fit group with
+    the model coordinates named 'fitted <name>'.
+    """
+    from opencmiss.utils.zinc.general import ChangeManager
+    from opencmiss.zinc.field import Field
+    from opencmiss.zinc.result import RESULT_OK
+
+    fieldmodule = fitter.getFieldmodule()
+    coordinates = fitter.getModelCoordinatesField()
+    name = coordinates.getName()
+    output_name = 'fitted ' + name
+    with ChangeManager(fieldmodule):
+        coordinates.setName(output_name)
+        try:
+            region = fitter.getRegion()
+            sir = region.createStreaminformationRegion()
+            sir.setRecursionMode(sir.RECURSION_MODE_OFF)
+            srm = sir.createStreamresourceMemory()
+            sir.setResourceFieldNames(srm, [output_name])
+            sir.setResourceDomainTypes(srm, Field.DOMAIN_TYPE_NODES | Field.DOMAIN_TYPE_MESH1D |
+                                       Field.DOMAIN_TYPE_MESH2D | Field.DOMAIN_TYPE_MESH3D)
+            fit_group = fitter.getModelFitGroup()
+            if fit_group:
+                sir.setResourceGroupName(srm, fit_group.getName())
+            result = region.write(sir)
+            assert result == RESULT_OK, 'Failed to write model'
+            result, buffer = srm.getBuffer()
+            assert result == RESULT_OK, 'Failed to serialize model'
+        finally:
+            coordinates.setName(name)
+    return buffer
+
+
+def geometry_arrays(fitter) -> dict:
+    """
+    Node identifiers and parameters of the model coordinates field, as written to a geometry dump.
+
+    :return: dict with 'node_ids' (n,) and 'parameters' (n, len(node_value_labels()), versions, 3), NaN where a
+    node has no such parameter, plus the 'value_labels' and the name of the coordinates 'field'.
+    """
+    from opencmiss.zinc.field import Field
+    from opencmiss.zinc.result import RESULT_OK
+
+    labels = node_value_labels()
+    fieldmodule = fitter.getFieldmodule()
+    coordinates = fitter.getModelCoordinatesField().castFiniteElement()
+    components = coordinates.getNumberOfComponents()
+    nodes = fieldmodule.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
+    fieldcache = fieldmodule.createFieldcache()
+    node_template = nodes.createNodetemplate()
+
+    node_ids = list()
+    node_parameters = list()
+    node_iterator = nodes.createNodeiterator()
+    node = node_iterator.next()
+    while node.isValid():
+        defined = node_template.defineFieldFromNode(coordinates, node) == RESULT_OK
+        versions = [node_template.getValueNumberOfVersions(coordinates, -1, label) if defined else 0
+                    for label in labels]
+        if max(versions) > 0:
+            fieldcache.setNode(node)
+            parameters = np.full((len(labels), max(versions), components), np.nan)
+            for row, (label, label_versions) in enumerate(zip(labels, versions)):
+                for version in range(label_versions):
+                    result, values = coordinates.getNodeParameters(fieldcache, -1, label, version + 1, components)
+                    if result == RESULT_OK:
+                        parameters[row, version] = values
+            node_ids.append(node.getIdentifier())
+            node_parameters.append(parameters)
+        node = node_iterator.next()
+
+    max_versions = max([parameters.shape[1] for parameters in node_parameters] + [1])
+    parameters = np.full((len(node_ids), len(labels), max_versions, components), np.nan)
+    for row, node_parameter in enumerate(node_parameters):
+        parameters[row, :, :node_parameter.shape[1]] = node_parameter
+    return {'node_ids': np.asarray(node_ids, dtype=np.int64), 'parameters': parameters,
+            'value_labels': np.asarray(labels, dtype=np.int64), 'field': coordinates.getName()}
+
+
+def apply_geometry(fitter, geometry: dict):
+    """
+    Set the node parameters of the model coordinates field from a geometry dump of the same scaffold.
+    """
+    from opencmiss.utils.zinc.general import ChangeManager
+    from opencmiss.zinc.field import Field
+
+    fieldmodule = fitter.getFieldmodule()
+    coordinates = fitter.getModelCoordinatesField().castFiniteElement()
+    nodes = fieldmodule.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
+    fieldcache = fieldmodule.createFieldcache()
+    with ChangeManager(fieldmodule):
+        for node_id, parameters in zip(geometry['node_ids'].tolist(), geometry['parameters']):
+            node = nodes.findNodeByIdentifier(node_id)
+            assert node.isValid(), f'Node {node_id} of the geometry dump is not in the model'
+            fieldcache.setNode(node)
+            for label, label_parameters in zip(geometry['value_labels'].tolist(), parameters):
+                for version, values in enumerate(label_parameters):
+                    if not np.isnan(values).any():
+                        coordinates.setNodeParameters(fieldcache, -1, label, version + 1, values.tolist())
+
+
+def mesh_reference(scaffold_path: Path) -> dict:
+    """
+    :return: the reference to the scaffold recorded in a geometry dump: its path and content hash.
+    """
+    return {'scaffold': str(scaffold_path), 'scaffold_hash': hash_file(scaffold_path)}
+
+
+def write_model(fitter, file_stem: str, format: str = 'exf', reference: dict = None) -> Tuple[Path, int]:
+    """
+    Write the current model of a fitter as <file_stem>.<format>.
+
+    :param reference: mesh_reference of the scaffold the fit started from, recorded in a geometry dump so the dump
+    can be put back on the same mesh.
+    :return: the path written and its size in bytes.
+    """
+    path = Path(f'{file_stem}.{format}')
+    if format == 'exf':
+        fitter.writeModel(str(path))
+    elif format == 'exf.gz':
+        with gzip.open(path, 'wb', compresslevel=6) as f:
+            f.write(model_buffer(fitter))
+    elif format == 'exf.zst':
+        with open(path, 'wb') as f:
+            f.write(_zstandard().ZstdCompressor().compress(model_buffer(fitter)))
+    elif format == 'npz':
+        geometry = geometry_arrays(fitter)
+        geometry.update(reference or dict())
+        with open(path, 'wb') as f:
+            np.savez(f, **geometry)
+    else:
+        raise ValueError(f'Unknown fit output format {format}')
+    return path, path.stat().st_size
+
+
+def read_model_buffer(path: Path) -> bytes:
+    """
+    :return: the EX content of a fit output file, decompressed if need be.
+    """
+    path = Path(path)
+    if path.name.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            return f.read()
+    if path.name.endswith('.zst'):
+        with open(path, 'rb') as f:
+            return _zstandard().ZstdDecompressor().decompress(f.read())
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def load_geometry(path: Path) -> dict:
+    """
+    :return: the arrays of a geometry dump, see geometry_arrays, with the 'scaffold' path and 'scaffold_hash' if
+    recorded.
+    """
+    with np.load(path, allow_pickle=False) as dump:
+        geometry = {key: dump[key] for key in dump.files}
+    for key in ('field', 'scaffold', 'scaffold_hash'):
+        if key in geometry:
+            geometry[key] = str(geometry[key])
+    return geometry
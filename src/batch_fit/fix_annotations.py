@@ -1,48 +1,27 @@
+import argparse
 from typing import List
-from functools import partial
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from scipy.spatial.distance import pdist, squareform
 
 import numpy as np
-import pandas as pd
 
-from sklearn.preprocessing import StandardScaler
-from sklearn.neighbors import KDTree
-from sklearn.cluster import DBSCAN
-from sklearn.neighbors import NearestNeighbors
+from .annotation_qc import GroupIndex
+from .ex_reader import read_ex_points
+from .point_cache import load_point_cache
+from .registration import register_points
 
-from opencmiss.zinc.context import Context
-from opencmiss.zinc.field import FieldGroup
-from opencmiss.zinc.result import RESULT_OK
-from opencmiss.zinc.field import Field
+
+LABEL = 'posterior edge of lower lobe of right lung'
 
 
 def load_exdata(file_name: str):
-    context = Context('Single Data')
-    region = context.getDefaultRegion()
-    result = region.readFile(file_name)
-    assert result == RESULT_OK, "Failed to load data file " + str(file_name)
-    fieldmodule = region.getFieldmodule()
-    coordinates = fieldmodule.findFieldByName('coordinates').castFiniteElement()
-    components_count = coordinates.getNumberOfComponents()
-    assert components_count in [1, 2, 3], 'extract_node_parameter. Invalid coordinates number of components'
-    cache = fieldmodule.createFieldcache()
-
-    return_values = list()
-    nodes = fieldmodule.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
-    node_iter = nodes.createNodeiterator()
-    node = node_iter.next()
-    while node.isValid():
-        cache.setNode(node)
-        result, values = coordinates.getNodeParameters(cache, -1, 1, 1, components_count)
-        return_values.append(values)
-        node = node_iter.next()
-
-    return np.asarray(return_values)
+    # use the memory mapped binary copy of a combined data file when it is up to date
+    points = load_point_cache(file_name)
+    if points is not None:
+        return points.coordinates
+    return read_ex_points(file_name, nodeset='datapoints').coordinates
 
 
 def generate_df(data: np.ndarray, label: str, label_ids: List):
+    import pandas as pd
     df = pd.DataFrame(data, columns=['x', 'y', 'z'])
     df['label'] = 'unlabeled'
     df.loc[label_ids, 'label'] = label
@@ -50,8 +29,9 @@ def generate_df(data: np.ndarray, label: str, label_ids: List):
     return df
 
 
-def downsample(data, factor=30):
-    base_data = data[data['label'] == 'posterior edge of lower lobe of right lung']
+def downsample(data, factor=30, label: str = LABEL):
+    import pandas as pd
+    base_data = data[data['label'] == label]
     unlabeled_data = data[data['label'] == 'unlabeled']
 
     downsampled_unlabeled = unlabeled_data.iloc[::factor, :].copy()
@@ -64,12 +44,9 @@ def check_distance(d, label):
     # Filter the ground-truth dataset to keep only the 'base' labeled points
     ground_truth_base = d[d['label'] == label]
 
-    # Compute the pairwise distances between all 'base' labeled points
-    # pairwise_distances = pdist(ground_truth_base[['x', 'y', 'z']].to_numpy())
-    distance_matrix = squareform(pdist(ground_truth_base[['x', 'y', 'z']].to_numpy(), metric='euclidean'))
-    # Calculate the mean and standard deviation of distances
-    mean_distance = np.mean(distance_matrix)
-    std_distance = np.std(distance_matrix)
+    # Mean and standard deviation of the pairwise distances between all 'base' labeled points, streamed rather
+    # than held as a distance matrix
+    mean_distance, std_distance = GroupIndex(ground_truth_base[['x', 'y', 'z']].to_numpy()).distance_statistics()
     print(mean_distance)
 
     threshold = mean_distance * 0.30  # Set a threshold for ectopic labels
@@ -78,117 +55,82 @@ def check_distance(d, label):
     return threshold
 
 
-def register(ground_truth_data, source_data):
+def register(ground_truth_data, source_data, label: str = LABEL, threshold_scale: float = 0.3, eps: float = 1.0,
+             min_samples: int = 2, plot: bool = False):
+    """
+    Register a subject onto a ground truth subject and look for wrongly labelled points of one annotation.
+
+    Both point sets are standardised with the scaling of the ground truth. The source is then moved onto the ground
+    truth by an affine ICP followed by a deformable CPD. A labelled source point is a mismatch when DBSCAN labels it
+    noise among the registered labelled points, or when it lies more than threshold_scale times the mean pairwise
+    distance of the ground truth's labelled points away from them.
 
-    # incomplete
+    :param ground_truth_data: DataFrame with 'x', 'y', 'z' and 'label' columns, as made by generate_df.
+    :param source_data: the same for the subject to check.
+    :param plot: show the k-distance graph of the registered labelled points, needs matplotlib.
+    :return: the registered source coordinates (n, 3), in the units of the ground truth, and the mask of the source
+    rows that are mismatched labels.
+    """
+    # sklearn and matplotlib are loaded only by the code that uses them, headless runs never import a plotting stack
+    from sklearn.preprocessing import StandardScaler
 
     scaler = StandardScaler()
-    ground_truth_data[['x', 'y', 'z']] = scaler.fit_transform(ground_truth_data[['x', 'y', 'z']])
-    source_data[['x', 'y', 'z']] = scaler.transform(source_data[['x', 'y', 'z']])
-
-    # Run the CPD algorithm
-
-    # fig = plt.figure()
-    # ax = fig.add_subplot(111, projection='3d')
-    # callback = partial(visualize, ax=ax)
-    #
-    # reg = DeformableRegistration(**{'X': ground_truth_data[['x', 'y', 'z']].values,
-    #                                 'Y': source_data[['x', 'y', 'z']].values})
-    # reg.register(callback)
-    # plt.show()
-    # reg = DeformableRegistration(**{'X': ground_truth_data[['x', 'y', 'z']].values,
-    #                                 'Y': source_data[['x', 'y', 'z']].values})
-    # reg.register(callback=visualize)
-    # reg.register()
-    # T = reg.R
-    # t = reg.t
-
-    # Apply the CPD transformation to the source dataset
-    # transformed_source_data = np.dot(source_data[['x', 'y', 'z']].values, T) + t.T
-    transformed_source_data = reg.transform_point_cloud(source_data[['x', 'y', 'z']].values)
-
-    # Filter the ground-truth and source datasets to keep only the 'base' labeled points
-    ground_truth_base = ground_truth_data[ground_truth_data['label'] == 'posterior edge of lower lobe of right lung']
-    source_base = source_data[source_data['label'] == 'posterior edge of lower lobe of right lung']
-
-    # Convert the filtered data to NumPy arrays
-    ground_truth_base_points = ground_truth_base[['x', 'y', 'z']].to_numpy()
-    source_base_points = source_base[['x', 'y', 'z']].to_numpy()
-
-    # Choose the number of nearest neighbors (k)
-    k = 5
-
-    # Compute the average distances between each point and its k-nearest neighbors
-    nearest_neighbors = NearestNeighbors(n_neighbors=k)
-    nearest_neighbors.fit(transformed_source_data[source_base.index])
-    distances, _ = nearest_neighbors.kneighbors(transformed_source_data[source_base.index])
-    avg_distances = np.mean(distances, axis=1)
-    # Plot the k-distance graph
-    sorted_distances = np.sort(avg_distances)[::-1]
-    plt.plot(sorted_distances)
-    plt.xlabel("Points")
-    plt.ylabel(f"Average distance to {k} nearest neighbors")
-    plt.show()
-
-    # Apply DBSCAN clustering on the transformed source points with the 'base' label
-    dbscan = DBSCAN(eps=1, min_samples=2)
-    clusters = dbscan.fit_predict(transformed_source_data[source_base.index])
-    # Identify incorrect labels
-    mismatches = clusters == -1
-
-    # Build the KDTree using the filtered ground-truth points
-    kd_tree = KDTree(ground_truth_base_points)
-
-    # Find the nearest neighbors in the ground-truth dataset for each point in the transformed source dataset with the 'base' label
-    # _, indices = kd_tree.query(transformed_source_data[source_base.index])
-
-    # Find the nearest neighbors in the ground-truth dataset for each point in the transformed source dataset with the 'base' label
-    distances, indices = kd_tree.query(transformed_source_data[source_base.index])
-
-    # Set a threshold distance to consider a 'base' label as incorrect
-    threshold_distance = check_distance(ground_truth_data, 'posterior edge of lower lobe of right lung')
-
-    # Identify incorrect 'base' labels
-    mismatches = distances > threshold_distance
-
-    # Compare labels and identify incorrect labels only for the 'base' labeled points
-    source_base_labels = source_base['label'].values
-    ground_truth_base_labels = ground_truth_base['label'].values
-    # mismatches = source_base_labels != ground_truth_base_labels[indices]
-
-
-def visualize(iteration, error, X, Y, ax):
-    plt.cla()
-    ax.scatter(X[:, 0], X[:, 1], X[:, 2], color='red', label='Target')
-    ax.scatter(Y[:, 0], Y[:, 1], Y[:, 2], color='blue', label='Source')
-    ax.text2D(0.87, 0.92, 'Iteration: {:d}'.format(
-        iteration), horizontalalignment='center', verticalalignment='center', transform=ax.transAxes,
-              fontsize='x-large')
-    ax.legend(loc='upper left', fontsize='x-large')
-    plt.draw()
-    plt.pause(0.001)
+    ground_truth_points = scaler.fit_transform(ground_truth_data[['x', 'y', 'z']].to_numpy())
+    source_points = scaler.transform(source_data[['x', 'y', 'z']].to_numpy())
+
+    # Register the source dataset onto the ground truth: affine ICP followed by a deformable CPD
+    registration = register_points(source_points, ground_truth_points, mode='affine', deformable=True)
+
+    # One tree per group, shared by the k-distance, DBSCAN and nearest ground truth steps below
+    source_rows = np.flatnonzero(source_data['label'].to_numpy() == label)
+    ground_truth_rows = np.flatnonzero(ground_truth_data['label'].to_numpy() == label)
+    source_index = GroupIndex(registration.points[source_rows])
+    ground_truth_index = GroupIndex(ground_truth_points[ground_truth_rows])
+
+    if plot:
+        # Compute the average distances between each point and its k-nearest neighbors, as a k-distance graph
+        from .plotting import plot_k_distance
+        k = 5
+        plot_k_distance(source_index.mean_knn_distance(k, include_self=True), k)
+
+    # DBSCAN noise of the registered source points with the label
+    isolated = source_index.noise_mask(eps=eps, min_samples=min_samples)
+
+    # Distance of every labelled source point to the nearest labelled ground truth point
+    ectopic = np.zeros(len(source_rows), dtype=bool)
+    if len(ground_truth_index) and len(source_index):
+        distances, _ = ground_truth_index.nearest(source_index.points)
+        mean_distance, _ = ground_truth_index.distance_statistics()
+        ectopic = distances > threshold_scale * mean_distance
+
+    mismatches = np.zeros(len(source_points), dtype=bool)
+    mismatches[source_rows] = isolated | ectopic
+    return scaler.inverse_transform(registration.points), mismatches
+
+
+def main():
+    ar = argparse.ArgumentParser(description='Check the points of one annotation of a subject against a ground truth '
+                                             'subject')
+    ar.add_argument('ground_truth', help='Combined data file of the ground truth subject')
+    ar.add_argument('source', help='Combined data file of the subject to check')
+    ar.add_argument('--ground-truth-rows', type=int, nargs=2, required=True, metavar=('FIRST', 'LAST'),
+                    help='Rows of the labelled points in the ground truth file, LAST excluded')
+    ar.add_argument('--source-rows', type=int, nargs=2, required=True, metavar=('FIRST', 'LAST'),
+                    help='Rows of the labelled points in the subject file, LAST excluded')
+    ar.add_argument('-l', '--label', default=LABEL, help='Annotation to check')
+    ar.add_argument('--downsample', type=int, default=30, help='Keep every n-th unlabelled point')
+    ar.add_argument('--plot', action='store_true', help='Show the k-distance graph, needs matplotlib')
+    args = vars(ar.parse_args())
+
+    ground_truth = downsample(generate_df(load_exdata(args['ground_truth']), args['label'],
+                                          list(range(*args['ground_truth_rows']))), args['downsample'], args['label'])
+    source = downsample(generate_df(load_exdata(args['source']), args['label'], list(range(*args['source_rows']))),
+                        args['downsample'], args['label'])
+
+    _, mismatches = register(ground_truth, source, label=args['label'], plot=args['plot'])
+    labelled = int(np.sum(source['label'].to_numpy() == args['label']))
+    print(f'{int(mismatches.sum())} of {labelled} points labelled {args["label"]} look mislabelled')
 
 
 if __name__ == '__main__':
-    # testing
-    root = r'D:\12-labours\lung\merryn-data-fitting\new-annotations\high-rms'
-    annotation = 'posterior edge of lower lobe of right lung'
-
-    template_id = '18964E'
-    target_id = '16565G'
-
-    template_label_ids = [i for i in range(304, 360)]
-    target_label_ids = [i for i in range(322, 397)]
-
-    template = load_exdata(rf'{root}\{template_id}\{template_id}_combined_lung_data.ex')
-    target = load_exdata(rf'{root}\{target_id}\{target_id}_combined_lung_data.ex')
-
-    template_df = generate_df(template, annotation, template_label_ids)
-    target_df = generate_df(target, annotation, target_label_ids)
-
-    downsample_template = downsample(template_df)
-    downsample_target = downsample(target_df)
-
-    register(downsample_template, downsample_target)
-
-    print()
+    main()
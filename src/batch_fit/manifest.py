@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+class RunManifest:
+    """
+    Record of what every subject was last combined and fitted from, keyed on content hashes of the inputs. Used to
+    skip subjects whose fit is still valid when a batch is run again.
+    """
+
+    def __init__(self, manifest_path: Path):
+        self._manifest_path = Path(manifest_path)
+        self._entries = dict()
+        if self._manifest_path.is_file():
+            with open(self._manifest_path, 'r') as f:
+                self._entries = json.load(f)
+
+    def get(self, subject: str) -> dict:
+        return self._entries.get(subject, dict())
+
+    def is_combined_valid(self, subject: str, data_key: str) -> bool:
+        return self.get(subject).get('data_key') == data_key
+
+    def is_fit_valid(self, subject: str, fit_key: str) -> bool:
+        entry = self.get(subject)
+        return entry.get('fit_key') == fit_key and Path(entry.get('fit_dir', '')).is_dir()
+
+    def update(self, subject: str, data_key: str, fit_key: str, fit_dir: Path):
+        self._entries[subject] = {'data_key': data_key, 'fit_key': fit_key, 'fit_dir': str(fit_dir)}
+        self.save()
+
+    def update_combined(self, subject: str, data_key: str):
+        """
+        Record the combined data file of a subject as written from `data_key`, leaving its fit as recorded. The fit
+        key depends on the data key, so an earlier fit of other data is not taken as valid.
+        """
+        entry = dict(self.get(subject))
+        entry['data_key'] = data_key
+        self._entries[subject] = entry
+        self.save()
+
+    def save(self):
+        self._manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = self._manifest_path.with_name(self._manifest_path.name + '.tmp')
+        with open(temporary_path, 'w') as f:
+            json.dump(self._entries, f, indent=4, sort_keys=True)
+        os.replace(temporary_path, self._manifest_path)
+
+
+def hash_file(file_path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_object(obj) -> str:
+    return hashlib.sha256(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def subject_data_key(subject_path: Path, groups: dict, decimation: dict = None) -> str:
+    """
+    Key of the combined data of a subject: the content of every .exdata file that goes into the combined .ex file,
+    together with the group mapping used to name them and the decimation settings, if any.
+    """
+    exdata_hashes = {ex_file.stem: hash_file(ex_file) for ex_file in sorted(subject_path.glob("*.exdata"))
+                     if ex_file.stem in groups.keys()}
+    key = {'exdata': exdata_hashes, 'groups': groups}
+    if decimation is not None:
+        key['decimation'] = decimation
+    return hash_object(key)
+
+
+def subject_fit_key(data_key: str, scaffold_key: str, settings_key: str, output_policy: dict = None) -> str:
+    """
+    Key of the fit of a subject: its combined data, the scaffold, the fit settings and, unless it is the default of
+    writing every iteration as EX, the output policy, so fits written in another format are not taken as done.
+
+    :param output_policy: the fit output policy as a dict, OutputPolicy._asdict().
+    """
+    key = {'data': data_key, 'scaffold': scaffold_key, 'settings': settings_key}
+    if output_policy is not None and output_policy != {'steps': 'iterations', 'format': 'exf'}:
+        key['output'] = output_policy
+    return hash_object(key)
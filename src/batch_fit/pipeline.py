@@ -0,0 +1,239 @@
+import json
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+from loguru import logger
+
+from .decimation import decimate_groups, group_spacing
+from .fit_output import OutputPolicy
+from .point_cache import load_point_cache, source_signature, write_point_cache
+from .profiling import SubjectProfiler, profile_stage
+
+# Zinc and scaffoldfitter, through core and data_combiner, are imported by the functions using them, so importing the
+# pipeline, e.g. to hand its functions to worker processes, does not load them
+
+
+def combined_data_path(subject_path: Path, suffix: str = '') -> Path:
+    return subject_path / f'{subject_path.stem}_combined_lung_data{suffix}.ex'
+
+
+def combine_subject(subject_path: Path, groups: dict, rebuild: bool = False, point_cache: bool = False,
+                    decimation: dict = None, suffix: str = '') -> Path:
+    """
+    Combine all the .exdata files of a subject into one single .ex file, unless it already exists.
+
+    :param subject_path: directory holding the subject's .exdata files.
+    :param groups: mapping of .exdata file stems to the group names used in the combined file.
+    :param rebuild: regenerate the combined file even if it exists, e.g. when it is stale.
+    :param point_cache: also keep a binary copy of the combined points next to the .ex file, see point_cache.
+    :param decimation: decimation settings from fit.yaml, or None to combine every point.
+    :param suffix: added to the name of the combined file, so data combined with other settings than the run's, e.g.
+    for a retry with reduced settings, does not replace the combined file the manifest records.
+    :return: path of the combined .ex file.
+    """
+    from .data_combiner import write_ex
+    output_ex = combined_data_path(subject_path, suffix)
+    if point_cache and load_point_cache(output_ex, groups, decimation=decimation) is None:
+        rebuild = True
+    if rebuild or not output_ex.exists():
+        logger.info('Generating EX file')
+        single_data = read_subject_groups(subject_path, groups, decimation=decimation)
+        write_ex(output_ex, single_data)
+        if point_cache:
+            write_point_cache(output_ex, single_data, source_signature(subject_path, groups, decimation=decimation))
+
+    return output_ex
+
+
+def combine_subject_in_memory(subject_path: Path, groups: dict, rebuild: bool = False, point_cache: bool = False,
+                              decimation: dict = None, write_file: bool = True, suffix: str = '') -> dict:
+    """
+    Combine all the .exdata files of a subject in memory, to hand the points to BatchFit without writing the
+    combined .ex file and parsing it back. The points come from the point cache when it is up to date.
+
+    :param write_file: still write the combined .ex file, as an archive, when it is missing or rebuilt. Otherwise
+    a stale combined file is removed, and combine_subject writes it again when it is next needed.
+    :param suffix: see combine_subject.
+    :return: dict of group name to (N, 3) array.
+    """
+    from .data_combiner import write_ex
+    output_ex = combined_data_path(subject_path, suffix)
+    if point_cache and not rebuild:
+        points = load_point_cache(output_ex, groups, decimation=decimation)
+        if points is not None:
+            return {label: points.group(label) for label in points.labels}
+
+    single_data = read_subject_groups(subject_path, groups, decimation=decimation)
+    # with the point cache on, getting here means the cache was stale, and so is the file
+    if rebuild or point_cache or not output_ex.exists():
+        if write_file:
+            write_ex(output_ex, single_data)
+        elif output_ex.exists():
+            # the manifest records the new data as combined, so a stale file left behind would be fitted as current
+            # by a later run combining through the file, or by the sweep
+            output_ex.unlink()
+    if point_cache:
+        write_point_cache(output_ex, single_data, source_signature(subject_path, groups, decimation=decimation))
+    return single_data
+
+
+def read_subject_groups(subject_path: Path, groups: dict, decimation: dict = None) -> dict:
+    """
+    Read the points of every group of a subject from its .exdata files, decimated if decimation settings are given.
+
+    :return: dict of group name to (N, 3) array.
+    """
+    from .data_combiner import read_single_group
+    single_data = dict()
+    spacings = dict()
+    for ex_file in subject_path.glob("*.exdata"):
+        file_name = ex_file.stem
+        if file_name in groups.keys():
+            group_name = groups[file_name]
+            single_data[group_name] = np.asarray(read_single_group(str(ex_file)), dtype=np.float64)
+            if decimation is not None:
+                spacings[group_name] = group_spacing(file_name, decimation)
+
+    if decimation is not None:
+        single_data, report = decimate_groups(single_data, spacings)
+        for group_name, (points_in, points_out) in report.items():
+            logger.info(f'Decimated {group_name}: {points_in} -> {points_out} points')
+    return single_data
+
+
+class FitJob(NamedTuple):
+    """
+    The arguments of fit_subject for one subject, in the order of its parameters, so a job is run as
+    `fit_subject(*job)`, e.g. by run_parallel, and can be changed field by field with `_replace`.
+    """
+    subject_path: Path
+    groups: dict
+    scaffold_path: Path
+    setting_file: Path
+    output_fit_dir: Path
+    rebuild_data: bool = False
+    point_cache: bool = False
+    decimation: dict = None
+    convergence_tolerance: float = None
+    warm_start_file: Path = None
+    in_memory: bool = False
+    write_combined: bool = True
+    output_policy: OutputPolicy = None
+    profiler: SubjectProfiler = None
+    combined_suffix: str = ''
+
+
+def fit_subject(subject_path: Path, groups: dict, scaffold_path: Path, setting_file: Path, output_fit_dir: Path,
+                rebuild_data: bool = False, point_cache: bool = False, decimation: dict = None,
+                convergence_tolerance: float = None, warm_start_file: Path = None, in_memory: bool = False,
+                write_combined: bool = True, output_policy: OutputPolicy = None, profiler: SubjectProfiler = None,
+                combined_suffix: str = ''):
+    """
+    Run the whole combine and fit pipeline for a single subject. Everything Zinc related is created inside this
+    call, so it can safely run in its own worker process.
+
+    :param in_memory: hand the combined points to the fitter in memory, see combine_subject_in_memory, instead of
+    through the combined .ex file.
+    :param write_combined: with in_memory, still write the combined .ex file as an archive.
+    :param output_policy: which fitter steps are written to output_fit_dir and how, see OutputPolicy.
+    :param profiler: profile the combine, setup and fit stages of the subject with it, see SubjectProfiler.
+    :param combined_suffix: suffix of the combined data file, see combine_subject.
+    :return: dict with the 'group_rms' values, the 'total_rms', the 'max_error', the 'wall_time', the per fitter
+    step metrics ('steps'), the number of 'data_points', the wall time of every pipeline stage ('stage_times') and
+    the fit output 'bytes_written' and 'output_files' of the subject, or None if the scaffold or data file is
+    missing.
+    """
+    start_time = time.perf_counter()
+    with profile_stage(profiler, 'combine'):
+        if in_memory:
+            output_ex = combined_data_path(subject_path, combined_suffix)
+            data = combine_subject_in_memory(subject_path, groups, rebuild=rebuild_data, point_cache=point_cache,
+                                             decimation=decimation, write_file=write_combined,
+                                             suffix=combined_suffix)
+        else:
+            output_ex = combine_subject(subject_path, groups, rebuild=rebuild_data, point_cache=point_cache,
+                                        decimation=decimation, suffix=combined_suffix)
+            data = None
+    combine_time = time.perf_counter() - start_time
+
+    logger.info(f'Fitting {subject_path.stem}')
+
+    result = fit_data(output_ex, scaffold_path, setting_file, output_fit_dir,
+                      convergence_tolerance=convergence_tolerance, warm_start_file=warm_start_file, data=data,
+                      output_policy=output_policy, profiler=profiler)
+    if result is not None:
+        result['wall_time'] = time.perf_counter() - start_time
+        result['stage_times']['combine'] = combine_time
+    return result
+
+
+def fit_data(data_path: Path, scaffold_path: Path, setting_file: Path, output_fit_dir: Path,
+             convergence_tolerance: float = None, warm_start_file: Path = None, data=None,
+             output_policy: OutputPolicy = None, profiler: SubjectProfiler = None):
+    """
+    Fit the scaffold to an already combined data file with one settings file.
+    If `warm_start_file` is given, fitting starts from the geometry of that earlier fit output.
+    If `data` is given, the combined data is taken from it instead of being read from `data_path`, see BatchFit.
+    If `profiler` is given, the setup and fit stages are profiled with it and the profile is saved once the fit ends.
+
+    :return: same as fit_subject, with the 'wall_time' of the fit only and no 'combine' stage time.
+    """
+    from .core import BatchFit
+    start_time = time.perf_counter()
+    if not (scaffold_path.is_file() and (data is not None or data_path.is_file())):
+        return None
+
+    output_fit_dir.mkdir(parents=True, exist_ok=True)
+    # the events of this fit only, so a fit stopped part way can be told from an earlier one in the same directory
+    events_file = output_fit_dir / 'steps.jsonl'
+    if events_file.exists():
+        events_file.unlink()
+    try:
+        with profile_stage(profiler, 'setup'):
+            batch_fit = BatchFit(scaffold_path, data_path, output_fit_dir / 'fit_', events_file=events_file,
+                                 convergence_tolerance=convergence_tolerance, warm_start_file=warm_start_file,
+                                 data=data, output_policy=output_policy)
+            batch_fit.load_fit_settings(setting_file)
+        setup_time = time.perf_counter() - start_time
+        with profile_stage(profiler, 'fit'):
+            batch_fit.run()
+        fit_time = time.perf_counter() - start_time - setup_time
+    finally:
+        if profiler is not None:
+            profiler.save()
+
+    bytes_written = batch_fit.get_bytes_written()
+    logger.info(f'Wrote {len(batch_fit.get_output_files())} fit output files, {bytes_written / 1e6:.1f} MB, to '
+                f'{output_fit_dir}')
+
+    total_rms, max_error = batch_fit.get_total_rms()
+    return {'group_rms': batch_fit.get_group_rms(),
+            'total_rms': total_rms,
+            'max_error': max_error,
+            'wall_time': time.perf_counter() - start_time,
+            'steps': batch_fit.get_step_metrics(),
+            'data_points': batch_fit.get_data_point_count(),
+            'stage_times': {'setup': setup_time, 'fit': fit_time},
+            'bytes_written': bytes_written,
+            'output_files': [path.name for path, _ in batch_fit.get_output_files()]}
+
+
+def read_step_events(output_fit_dir: Path) -> list:
+    """
+    :return: the metrics of every fitter step a fit in `output_fit_dir` completed, as recorded while it ran, so also
+    for a fit that was stopped before it finished.
+    """
+    events_file = Path(output_fit_dir) / 'steps.jsonl'
+    if not events_file.is_file():
+        return list()
+    steps = list()
+    with open(events_file, 'r') as f:
+        for line in f:
+            try:
+                steps.append(json.loads(line))
+            except ValueError:
+                # a line cut short by the process being stopped
+                break
+    return steps
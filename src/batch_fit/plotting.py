@@ -0,0 +1,43 @@
+import numpy as np
+
+
+def _pyplot():
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        raise ImportError('plotting needs the matplotlib package') from None
+    return plt
+
+
+def plot_k_distance(mean_distances: np.ndarray, k: int):
+    """
+    Plot the mean distance of every point to its k nearest neighbours, largest first, to pick a DBSCAN eps from.
+    """
+    plt = _pyplot()
+    plt.plot(np.sort(mean_distances)[::-1])
+    plt.xlabel("Points")
+    plt.ylabel(f"Average distance to {k} nearest neighbors")
+    plt.show()
+
+
+def registration_axes():
+    """
+    :return: 3D axes of a new figure for visualize.
+    """
+    plt = _pyplot()
+    # registers the 3d projection with older matplotlib versions
+    from mpl_toolkits.mplot3d import Axes3D  # noqa: F401
+    return plt.figure().add_subplot(projection='3d')
+
+
+def visualize(iteration, error, X, Y, ax):
+    plt = _pyplot()
+    plt.cla()
+    ax.scatter(X[:, 0], X[:, 1], X[:, 2], color='red', label='Target')
+    ax.scatter(Y[:, 0], Y[:, 1], Y[:, 2], color='blue', label='Source')
+    ax.text2D(0.87, 0.92, 'Iteration: {:d}'.format(
+        iteration), horizontalalignment='center', verticalalignment='center', transform=ax.transAxes,
+              fontsize='x-large')
+    ax.legend(loc='upper left', fontsize='x-large')
+    plt.draw()
+    plt.pause(0.001)
@@ -0,0 +1,110 @@
+import json
+import os
+from pathlib import Path
+from typing import List, NamedTuple
+
+import numpy as np
+
+from .manifest import hash_object
+
+
+class SubjectPoints(NamedTuple):
+    coordinates: np.ndarray  # (N, 3) float64, memory mapped when loaded from the cache
+    labels: List[str]  # group names, in storage order
+    offsets: np.ndarray  # (len(labels) + 1,) row offsets, group i is coordinates[offsets[i]:offsets[i + 1]]
+
+    def group(self, label: str) -> np.ndarray:
+        index = self.labels.index(label)
+        return self.coordinates[self.offsets[index]:self.offsets[index + 1]]
+
+    def label_array(self) -> np.ndarray:
+        """
+        :return: (N,) array with the group name of every row.
+        """
+        return np.repeat(np.asarray(self.labels, dtype=object), np.diff(self.offsets))
+
+
+def cache_paths(combined_ex_path: Path):
+    """
+    :return: paths of the coordinate array and of the index of the binary sidecar of a combined .ex file.
+    """
+    combined_ex_path = Path(combined_ex_path)
+    return (combined_ex_path.with_name(combined_ex_path.stem + '.points.npy'),
+            combined_ex_path.with_name(combined_ex_path.stem + '.points.json'))
+
+
+def source_signature(subject_path: Path, groups: dict, decimation: dict = None) -> dict:
+    """
+    Size and modification time of every .exdata file combined for a subject, plus a hash of the group mapping and of
+    the decimation settings. Cheap to recompute, so the cache can be checked every time it is opened.
+    """
+    sources = dict()
+    for ex_file in sorted(Path(subject_path).glob("*.exdata")):
+        if ex_file.stem in groups.keys():
+            stat = ex_file.stat()
+            sources[ex_file.name] = [stat.st_size, stat.st_mtime_ns]
+    signature = {'sources': sources, 'groups': hash_object(groups)}
+    if decimation is not None:
+        signature['decimation'] = hash_object(decimation)
+    return signature
+
+
+def write_point_cache(combined_ex_path: Path, data: dict, signature: dict):
+    """
+    Store the combined points of a subject as one contiguous float64 array with a group offset index.
+
+    :param data: dict of group name to (N, 3) array, as passed to write_ex.
+    :param signature: source_signature of the subject the data was built from.
+    """
+    array_path, index_path = cache_paths(combined_ex_path)
+    labels = list(data.keys())
+    arrays = [np.asarray(data[label], dtype=np.float64).reshape(-1, 3) for label in labels]
+    offsets = np.concatenate([[0], np.cumsum([len(array) for array in arrays])]).astype(np.int64)
+    coordinates = np.concatenate(arrays) if arrays else np.zeros((0, 3))
+
+    # the index is written last and names the signature, so a half written cache is never picked up as valid
+    temporary_array_path = array_path.with_name(array_path.name + '.tmp')
+    with open(temporary_array_path, 'wb') as f:
+        np.save(f, coordinates)
+    os.replace(temporary_array_path, array_path)
+
+    temporary_index_path = index_path.with_name(index_path.name + '.tmp')
+    with open(temporary_index_path, 'w') as f:
+        json.dump({'labels': labels, 'offsets': offsets.tolist(), 'signature': signature}, f, indent=4)
+    os.replace(temporary_index_path, index_path)
+
+
+def load_point_cache(combined_ex_path: Path, groups: dict = None, mmap_mode='r', decimation: dict = None):
+    """
+    Open the binary sidecar of a combined .ex file without copying the coordinates into memory.
+
+    :param groups: group mapping of the cohort. When given the whole source signature is checked, otherwise only the
+    .exdata files recorded in the cache are.
+    :param decimation: decimation settings the cache is expected to be built with, checked along with groups.
+    :return: SubjectPoints, or None if there is no cache or its source files changed.
+    """
+    array_path, index_path = cache_paths(combined_ex_path)
+    if not (array_path.is_file() and index_path.is_file()):
+        return None
+
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+
+    subject_path = Path(combined_ex_path).parent
+    signature = index['signature']
+    if groups is not None:
+        if source_signature(subject_path, groups, decimation=decimation) != signature:
+            return None
+    else:
+        for file_name, (size, mtime_ns) in signature['sources'].items():
+            source = subject_path / file_name
+            if not source.is_file():
+                return None
+            stat = source.stat()
+            if [stat.st_size, stat.st_mtime_ns] != [size, mtime_ns]:
+                return None
+
+    offsets = np.asarray(index['offsets'], dtype=np.int64)
+    # an empty array cannot be memory mapped
+    coordinates = np.load(array_path, mmap_mode=mmap_mode if offsets[-1] > 0 else None)
+    return SubjectPoints(coordinates, index['labels'], offsets)
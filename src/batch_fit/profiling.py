@@ -0,0 +1,270 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import NamedTuple
+
+
+class ProfileSettings(NamedTuple):
+    """
+    How the pipeline stages of a subject are profiled: under cProfile if `cprofile` is set, and with a sample of the
+    stack of the profiled thread every `sampling_interval` seconds unless it is None. The profiles are written to
+    `directory`, tagged with `run_id` so the report of a run leaves out profiles of earlier runs in the same directory.
+    """
+    directory: Path
+    cprofile: bool = True
+    sampling_interval: float = 0.005
+    # seconds between writes of the sampled stacks while a subject runs
+    flush_interval: float = 10.0
+    run_id: str = None
+
+
+class _NullStage:
+    """
+    Stage of a subject that is not profiled: a reusable context manager doing nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def profile_stage(profiler: 'SubjectProfiler', stage: str):
+    """
+    :return: context manager profiling a pipeline stage with `profiler`, or doing nothing if it is None.
+    """
+    return _NULL_STAGE if profiler is None else profiler.stage(stage)
+
+
+class SubjectProfiler:
+    """
+    Profile of the pipeline stages of one subject, written as <name>.<run_id>.prof, the cProfile statistics readable
+    by pstats and snakeviz, and <name>.<run_id>.collapsed, the sampled stacks in the collapsed format of flamegraph.pl
+    and speedscope, every stack starting with the stage it was sampled in.
+
+    The profiler holds nothing but its settings until the first stage starts, so it can be created in the parent and
+    sent to the worker process fitting the subject. The sampled stacks are also written every flush_interval while
+    the subject runs, so a subject stopped for exceeding its time limit still leaves them behind.
+
+    Samples are taken from a background thread, which only gets to run between Python bytecodes of the profiled
+    thread: a long call into Zinc is counted as one sample when it returns, so the samples undercount time spent in
+    compiled code. cProfile, which times every call, does not have that bias.
+    """
+
+    def __init__(self, name: str, settings: ProfileSettings):
+        self.name = name
+        self.settings = settings
+        self._profile = None
+        self._stacks = Counter()
+        self._stages = list()
+        self._base_depth = 0
+        self._thread_id = None
+        self._sampler = None
+        self._stop = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # only the settings go to a spawned worker process, the profile is made there
+        return self.name, self.settings
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def stage(self, stage: str) -> '_Stage':
+        return _Stage(self, stage)
+
+    @property
+    def profile_file(self) -> Path:
+        return Path(self.settings.directory) / f'{_file_name(self.name)}{_run_suffix(self.settings.run_id)}.prof'
+
+    @property
+    def collapsed_file(self) -> Path:
+        return Path(self.settings.directory) / f'{_file_name(self.name)}{_run_suffix(self.settings.run_id)}.collapsed'
+
+    def _enter(self, stage: str, depth: int):
+        if not self._stages:
+            self._base_depth = depth
+            if self.settings.sampling_interval:
+                self._start_sampler()
+            if self.settings.cprofile:
+                if self._profile is None:
+                    self._profile = cProfile.Profile()
+                self._profile.enable()
+        self._stages.append(stage)
+
+    def _exit(self):
+        self._stages.pop()
+        if not self._stages:
+            if self._profile is not None:
+                self._profile.disable()
+            self._stop_sampler()
+
+    def _start_sampler(self):
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+        self._sampler.start()
+
+    def _stop_sampler(self):
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def _sample(self):
+        flushed_at = time.perf_counter()
+        while not self._stop.wait(self.settings.sampling_interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stages = tuple(self._stages)
+            if frame is None or not stages:
+                continue
+            stack = list()
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            # frames outside the outermost stage, from the worker or the command line, are the same in every sample
+            stack = stack[:max(len(stack) - self._base_depth + 1, 1)]
+            with self._lock:
+                self._stacks[stages + tuple(reversed(stack))] += 1
+            if time.perf_counter() - flushed_at > self.settings.flush_interval:
+                self._write_collapsed()
+                flushed_at = time.perf_counter()
+
+    def _write_collapsed(self):
+        with self._lock:
+            lines = [f'{";".join(stack)} {count}\n' for stack, count in self._stacks.items()]
+        _write_atomic(self.collapsed_file, ''.join(lines))
+
+    def save(self):
+        """
+        Write the profile of the stages run so far. Called again, the files are rewritten with everything since the
+        first stage.
+        """
+        Path(self.settings.directory).mkdir(parents=True, exist_ok=True)
+        if self._profile is not None:
+            temporary_path = self.profile_file.with_name(f'{self.profile_file.name}.{os.getpid()}.tmp')
+            self._profile.dump_stats(str(temporary_path))
+            os.replace(temporary_path, self.profile_file)
+        if self.settings.sampling_interval:
+            self._write_collapsed()
+
+
+class _Stage:
+
+    def __init__(self, profiler: SubjectProfiler, stage: str):
+        self._profiler = profiler
+        self._stage = stage
+
+    def __enter__(self):
+        # depth of the frame entering the stage, the outermost frame kept in the sampled stacks
+        frame = sys._getframe(1)
+        depth = 0
+        while frame is not None:
+            depth += 1
+            frame = frame.f_back
+        self._profiler._enter(self._stage, depth)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._profiler._exit()
+        return False
+
+
+def _frame_name(code) -> str:
+    return f'{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})'
+
+
+def _file_name(name: str) -> str:
+    return name.replace('/', '__').replace(os.sep, '__')
+
+
+def _run_suffix(run_id: str) -> str:
+    return '' if run_id is None else f'.{run_id}'
+
+
+def _write_atomic(path: Path, text: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(temporary_path, 'w') as f:
+        f.write(text)
+    os.replace(temporary_path, path)
+
+
+def merge_collapsed(collapsed_files) -> Counter:
+    """
+    :return: Counter of stack (a ';' joined string) to samples, summed over the files.
+    """
+    stacks = Counter()
+    for collapsed_file in collapsed_files:
+        with open(collapsed_file, 'r') as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if stack and count.isdigit():
+                    stacks[stack] += int(count)
+    return stacks
+
+
+def sampled_hot_functions(stacks: Counter, top: int) -> list:
+    """
+    :return: the `top` functions with the most samples on top of the stack, as (function, own samples, samples
+    anywhere on the stack) tuples.
+    """
+    own = Counter()
+    total = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    return [(function, samples, total[function]) for function, samples in own.most_common(top)]
+
+
+def write_cohort_report(directory: Path, top: int = 40, run_id: str = None) -> dict:
+    """
+    Merge the profiles of every subject in `directory` into hot_functions.txt, the functions ranked by own time under
+    cProfile and by own samples, and cohort.collapsed, the sampled stacks of all subjects in one flamegraph input.
+
+    :param run_id: merge only the profiles written with this run id, or every profile in `directory` if None.
+    :return: dict with the paths written, empty if there were no profiles.
+    """
+    directory = Path(directory)
+    suffix = _run_suffix(run_id)
+    profile_files = sorted(directory.glob(f'*{suffix}.prof'))
+    collapsed_files = sorted(path for path in directory.glob(f'*{suffix}.collapsed') if path.name != 'cohort.collapsed')
+    if not profile_files and not collapsed_files:
+        return dict()
+
+    report = io.StringIO()
+    if profile_files:
+        stats = pstats.Stats(str(profile_files[0]), stream=report)
+        for profile_file in profile_files[1:]:
+            stats.add(str(profile_file))
+        report.write(f'cProfile of {len(profile_files)} subjects, by own time\n')
+        stats.sort_stats('tottime').print_stats(top)
+        report.write(f'cProfile of {len(profile_files)} subjects, by cumulative time\n')
+        stats.sort_stats('cumulative').print_stats(top)
+
+    written = {'hot_functions': directory / 'hot_functions.txt'}
+    if collapsed_files:
+        stacks = merge_collapsed(collapsed_files)
+        samples = sum(stacks.values())
+        report.write(f'Stack samples of {len(collapsed_files)} subjects, {samples} samples, by own samples\n\n')
+        report.write(f'{"own %":>7} {"total %":>8}  function\n')
+        for function, own, total in sampled_hot_functions(stacks, top):
+            report.write(f'{100 * own / samples:7.2f} {100 * total / samples:8.2f}  {function}\n')
+        written['collapsed'] = directory / 'cohort.collapsed'
+        _write_atomic(written['collapsed'], ''.join(f'{stack} {count}\n' for stack, count in
+                                                    sorted(stacks.items())))
+
+    _write_atomic(written['hot_functions'], report.getvalue())
+    return written
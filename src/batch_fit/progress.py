@@ -0,0 +1,305 @@
+import json
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn
+
+import numpy as np
+from loguru import logger
+
+
+# upper bounds of the latency histogram buckets, in seconds, and of the data points per subject histogram
+LATENCY_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 1800.0, 3600.0, 7200.0)
+POINT_BUCKETS = (1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 500000)
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket bounds, as Prometheus histograms are exposed.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[int(np.searchsorted(self.bounds, value))] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound, number of observations up to it), ending with ('+Inf', count).
+        """
+        return list(zip([_format_bound(bound) for bound in self.bounds] + ['+Inf'], np.cumsum(self.counts).tolist()))
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else None,
+                'buckets': dict(self.cumulative())}
+
+
+class ProgressMonitor:
+    """
+    Live view of a batch run: subjects done, failed, running and remaining, throughput and ETA, the worker fitting
+    every running subject, latency histograms of every pipeline stage and fitter step type, and the data points of
+    every subject. Running subjects taking more than `straggler_factor` times the median subject are flagged.
+
+    The state is written to `status_file` as JSON every `update_interval` seconds and on every finished subject,
+    replacing the file in one step so readers never see half of it. With `prometheus_port` set, the same metrics are
+    served in the Prometheus text format at http://<prometheus_host>:<prometheus_port>/metrics. Both run on
+    background threads between start() and stop(); the monitor itself is fed from the thread running the batch.
+    """
+
+    def __init__(self, total: int, status_file: Path = None, update_interval: float = 10.0,
+                 prometheus_port: int = None, prometheus_host: str = '127.0.0.1', straggler_factor: float = 2.0):
+        self._total = total
+        self._status_file = None if status_file is None else Path(status_file)
+        self._update_interval = update_interval
+        self._prometheus_address = None if prometheus_port is None else (prometheus_host, int(prometheus_port))
+        self._straggler_factor = straggler_factor
+        self._host = socket.gethostname()
+        self._started_at = time.time()
+        self._running = dict()
+        self._completed = dict()
+        self._failed = dict()
+        self._skipped = set()
+        self._stragglers = set()
+        self._stages = dict()
+        self._points = Histogram(POINT_BUCKETS)
+        self._bytes_written = 0
+        self._lock = threading.Lock()
+        # the periodic writer and a finished subject may write at the same time
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._writer = None
+        self._server = None
+
+    def add_jobs(self, count: int):
+        with self._lock:
+            self._total += count
+
+    def started(self, subject: str, worker=None):
+        """
+        :param worker: what is fitting the subject, e.g. the process id of its worker process.
+        """
+        with self._lock:
+            self._running[subject] = {'worker': worker if worker is not None else os.getpid(),
+                                      'started_at': time.time()}
+
+    def finished(self, subject: str, result: dict):
+        """
+        :param result: the result of fit_subject or fit_data for the subject.
+        """
+        with self._lock:
+            running = self._running.pop(subject, None)
+            wall_time = result.get('wall_time')
+            if wall_time is None and running is not None:
+                wall_time = time.time() - running['started_at']
+            stage_times = dict(result.get('stage_times') or dict())
+            stage_times['total'] = wall_time
+            for step in result.get('steps') or list():
+                stage_times.setdefault(f'step {step["type"].lstrip("_")}', 0.0)
+                stage_times[f'step {step["type"].lstrip("_")}'] += step['wall_time']
+            for stage, seconds in stage_times.items():
+                if seconds is not None:
+                    self._stages.setdefault(stage, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            if result.get('data_points') is not None:
+                self._points.observe(result['data_points'])
+            self._bytes_written += result.get('bytes_written') or 0
+            self._completed[subject] = {'wall_time': wall_time, 'data_points': result.get('data_points'),
+                                        'total_rms': result.get('total_rms'), 'stage_times': stage_times,
+                                        'bytes_written': result.get('bytes_written'),
+                                        'worker': None if running is None else running['worker'],
+                                        'finished_at': time.time()}
+        self._write_status()
+
+    def failed(self, subject: str, error: str):
+        with self._lock:
+            running = self._running.pop(subject, None)
+            self._failed[subject] = {'error': error, 'worker': None if running is None else running['worker'],
+                                     'finished_at': time.time()}
+        self._write_status()
+
+    def skipped(self, subject: str):
+        """
+        Count a subject as handled without fitting it here, e.g. because it is up to date or fitted by another worker.
+        """
+        with self._lock:
+            self._skipped.add(subject)
+
+    def status(self) -> dict:
+        """
+        :return: JSON-ready snapshot of the run.
+        """
+        with self._lock:
+            now = time.time()
+            elapsed = now - self._started_at
+            processed = len(self._completed) + len(self._failed)
+            remaining = max(self._total - processed - len(self._skipped), 0)
+            throughput = processed / elapsed if processed and elapsed > 0 else None
+            wall_times = [subject['wall_time'] for subject in self._completed.values()
+                          if subject['wall_time'] is not None]
+            straggler_time = self._straggler_factor * float(np.median(wall_times)) if wall_times else None
+
+            running = dict()
+            for subject, assignment in self._running.items():
+                running_time = now - assignment['started_at']
+                straggler = straggler_time is not None and running_time > straggler_time
+                running[subject] = {'worker': assignment['worker'], 'running_time': running_time,
+                                    'straggler': straggler}
+                if straggler and subject not in self._stragglers:
+                    self._stragglers.add(subject)
+                    logger.warning(f'Subject {subject} has been running for {running_time:.0f} s, more than '
+                                   f'{self._straggler_factor} times the median subject')
+
+            slowest = sorted(self._completed, key=lambda subject: self._completed[subject]['wall_time'] or 0.0,
+                             reverse=True)[:5]
+            return {'host': self._host,
+                    'pid': os.getpid(),
+                    'started_at': self._started_at,
+                    'updated_at': now,
+                    'elapsed': elapsed,
+                    'subjects': {'total': self._total, 'done': len(self._completed), 'failed': len(self._failed),
+                                 'skipped': len(self._skipped), 'running': len(self._running),
+                                 'remaining': remaining},
+                    'throughput_per_hour': None if throughput is None else throughput * 3600,
+                    'eta_seconds': None if throughput is None else remaining / throughput,
+                    'straggler_seconds': straggler_time,
+                    'running': running,
+                    'slowest': slowest,
+                    'stages': {stage: histogram.to_dict() for stage, histogram in sorted(self._stages.items())},
+                    'data_points': self._points.to_dict(),
+                    'bytes_written': self._bytes_written,
+                    'completed': dict(self._completed),
+                    'failed': dict(self._failed)}
+
+    def prometheus_text(self) -> str:
+        """
+        :return: the metrics in the Prometheus text exposition format.
+        """
+        status = self.status()
+        lines = ['# HELP batch_fit_subjects Subjects of the run by state.', '# TYPE batch_fit_subjects gauge']
+        for state in ('total', 'done', 'failed', 'skipped', 'running', 'remaining'):
+            lines.append(f'batch_fit_subjects{{state="{state}"}} {status["subjects"][state]}')
+        lines += ['# HELP batch_fit_elapsed_seconds Time since the run started.',
+                  '# TYPE batch_fit_elapsed_seconds gauge',
+                  f'batch_fit_elapsed_seconds {status["elapsed"]:.3f}']
+        if status['eta_seconds'] is not None:
+            lines += ['# HELP batch_fit_eta_seconds Estimated time until every remaining subject is processed.',
+                      '# TYPE batch_fit_eta_seconds gauge',
+                      f'batch_fit_eta_seconds {status["eta_seconds"]:.3f}',
+                      '# HELP batch_fit_throughput_subjects_per_hour Subjects processed per hour so far.',
+                      '# TYPE batch_fit_throughput_subjects_per_hour gauge',
+                      f'batch_fit_throughput_subjects_per_hour {status["throughput_per_hour"]:.3f}']
+
+        lines += ['# HELP batch_fit_output_bytes Fit output written by the subjects done so far.',
+                  '# TYPE batch_fit_output_bytes gauge',
+                  f'batch_fit_output_bytes {status["bytes_written"]}']
+        lines += ['# HELP batch_fit_running_seconds Time every running subject has been running, by worker.',
+                  '# TYPE batch_fit_running_seconds gauge']
+        for subject, running in status['running'].items():
+            lines.append(f'batch_fit_running_seconds{{subject="{_escape(subject)}",worker="{running["worker"]}",'
+                         f'straggler="{str(running["straggler"]).lower()}"}} {running["running_time"]:.3f}')
+
+        lines += ['# HELP batch_fit_stage_seconds Wall time of the pipeline stages and fitter steps of a subject.',
+                  '# TYPE batch_fit_stage_seconds histogram']
+        with self._lock:
+            stages = sorted(self._stages.items())
+            points = self._points
+            for stage, histogram in stages:
+                lines += _histogram_lines('batch_fit_stage_seconds', histogram, f'stage="{_escape(stage)}"')
+            lines += ['# HELP batch_fit_subject_data_points Data points of a subject.',
+                      '# TYPE batch_fit_subject_data_points histogram']
+            lines += _histogram_lines('batch_fit_subject_data_points', points)
+        return '\n'.join(lines) + '\n'
+
+    def _write_status(self):
+        if self._status_file is None:
+            return
+        status = self.status()
+        with self._write_lock:
+            self._status_file.parent.mkdir(parents=True, exist_ok=True)
+            temporary_path = self._status_file.with_name(f'{self._status_file.name}.{os.getpid()}.tmp')
+            with open(temporary_path, 'w') as f:
+                json.dump(status, f, indent=4, default=str)
+            os.replace(temporary_path, self._status_file)
+
+    def _write_periodically(self):
+        while not self._stop.wait(self._update_interval):
+            try:
+                self._write_status()
+            except OSError as e:
+                logger.warning(f'Could not write the status file {self._status_file}: {e}')
+
+    def start(self):
+        """
+        Start rewriting the status file every update_interval seconds and serving the Prometheus endpoint, if set.
+        """
+        self._stop.clear()
+        self._write_status()
+        if self._status_file is not None:
+            self._writer = threading.Thread(target=self._write_periodically, name='progress-status', daemon=True)
+            self._writer.start()
+        if self._prometheus_address is not None:
+            self._server = _MetricsServer(self._prometheus_address, _MetricsHandler)
+            self._server.monitor = self
+            threading.Thread(target=self._server.serve_forever, name='progress-metrics', daemon=True).start()
+            logger.info(f'Serving metrics at http://{self._prometheus_address[0]}:{self._server.server_port}/metrics')
+
+    def stop(self):
+        """
+        Stop the background threads and write the final status.
+        """
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self._write_status()
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.monitor.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # every scrape would otherwise end up on stderr next to the run's log
+        pass
+
+
+def _format_bound(bound) -> str:
+    return str(int(bound)) if float(bound).is_integer() else str(bound)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram_lines(name: str, histogram: Histogram, labels: str = '') -> list:
+    separator = ',' if labels else ''
+    lines = [f'{name}_bucket{{{labels}{separator}le="{bound}"}} {count}' for bound, count in histogram.cumulative()]
+    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}' if labels else f'{name}_sum {histogram.sum}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}' if labels else f'{name}_count {histogram.count}')
+    return lines
@@ -0,0 +1,191 @@
+from typing import NamedTuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class Transform(NamedTuple):
+    matrix: np.ndarray  # (3, 3) linear part
+    translation: np.ndarray  # (3,)
+
+    def apply(self, points: np.ndarray) -> np.ndarray:
+        return points @ self.matrix.T + self.translation
+
+
+class Registration(NamedTuple):
+    points: np.ndarray  # source points moved onto the target
+    transform: Transform  # rigid, similarity or affine part
+    rms: float  # RMS distance of the moved points to their nearest target point
+
+
+def _subsample(points: np.ndarray, size, generator) -> np.ndarray:
+    if size is None or len(points) <= size:
+        return points
+    return points[generator.choice(len(points), size, replace=False)]
+
+
+def fit_transform(source: np.ndarray, target: np.ndarray, mode: str = 'rigid') -> Transform:
+    """
+    Least squares transform taking the source points onto the corresponding target points.
+
+    :param mode: 'rigid' (rotation and translation), 'similarity' (plus a uniform scale) or 'affine'.
+    """
+    if mode == 'affine':
+        homogeneous = np.hstack([source, np.ones((len(source), 1))])
+        solution, _, _, _ = np.linalg.lstsq(homogeneous, target, rcond=None)
+        return Transform(solution[:3].T, solution[3])
+    if mode not in ('rigid', 'similarity'):
+        raise ValueError(f'Unknown transform mode {mode}')
+
+    # Umeyama: rotation from the SVD of the cross covariance, with the reflection removed
+    source_mean = source.mean(axis=0)
+    target_mean = target.mean(axis=0)
+    centred_source = source - source_mean
+    covariance = (target - target_mean).T @ centred_source / len(source)
+    u, sigma, vt = np.linalg.svd(covariance)
+    signs = np.array([1.0, 1.0, np.sign(np.linalg.det(u) * np.linalg.det(vt)) or 1.0])
+    rotation = (u * signs) @ vt
+    scale = 1.0
+    if mode == 'similarity':
+        scale = float(np.dot(sigma, signs) / np.mean(np.sum(np.square(centred_source), axis=1)))
+    return Transform(scale * rotation, target_mean - scale * rotation @ source_mean)
+
+
+def icp(source: np.ndarray, target: np.ndarray, mode: str = 'rigid', max_iterations: int = 50,
+        tolerance: float = 1e-6, sample_size: int = 5000, trim: float = 0.9, seed: int = 0,
+        initial: Transform = None) -> Transform:
+    """
+    Iterative closest point: match a sample of the source points to their nearest target points with a KD-tree and
+    refit the transform, until the RMS of the matches stops improving.
+
+    :param mode: transform to fit, see fit_transform.
+    :param sample_size: number of source points matched per iteration, None for all of them.
+    :param trim: fraction of the closest matches used for the fit, so parts of the source missing in the target do not
+    pull the transform.
+    :param initial: transform to start from. By default the centroids are put on top of each other, with the spreads
+    matched unless the fit is rigid, and an affine fit starts from a similarity fit, as its extra freedom lets it
+    collapse onto a part of the target from a poor start.
+    """
+    generator = np.random.default_rng(seed)
+    sample = _subsample(source, sample_size, generator)
+    tree = cKDTree(target)
+
+    if initial is not None:
+        transform = initial
+    elif mode == 'affine':
+        transform = icp(sample, target, 'similarity', max_iterations, tolerance, None, trim, seed)
+    else:
+        scale = 1.0 if mode == 'rigid' else np.sqrt(np.sum(np.var(target, axis=0)) / np.sum(np.var(sample, axis=0)))
+        transform = Transform(scale * np.eye(3), target.mean(axis=0) - scale * sample.mean(axis=0))
+
+    previous_rms = np.inf
+    for _ in range(max_iterations):
+        distances, indices = tree.query(transform.apply(sample))
+        keep = distances <= np.quantile(distances, trim)
+        transform = fit_transform(sample[keep], target[indices[keep]], mode)
+        rms = np.sqrt(np.mean(np.square(distances[keep])))
+        if previous_rms - rms <= tolerance * max(rms, np.finfo(np.float64).tiny):
+            break
+        previous_rms = rms
+    return transform
+
+
+def _gaussian_kernel(a: np.ndarray, b: np.ndarray, beta: float) -> np.ndarray:
+    squared = np.sum(np.square(a), axis=1)[:, None] - 2 * a @ b.T + np.sum(np.square(b), axis=1)[None, :]
+    return np.exp(-np.maximum(squared, 0.0) / (2 * beta ** 2))
+
+
+def cpd_deformable(source: np.ndarray, target: np.ndarray, beta: float = 2.0, lamb: float = 2.0, w: float = 0.1,
+                   max_iterations: int = 30, tolerance: float = 1e-4, source_points: int = 1000,
+                   target_points: int = 2000, control_points: int = 200, chunk_size: int = 2048,
+                   seed: int = 0) -> np.ndarray:
+    """
+    Coherent point drift (Myronenko and Song, 2010), subsampled and with a low-rank displacement field: the GMM is
+    fitted between `source_points` source and `target_points` target points, and the displacement is a sum of
+    Gaussian kernels on `control_points` of the source points, so every M-step solves a system the size of the
+    control points and the field is evaluated at every source point in the end. The correspondence matrix is never
+    held whole, it is accumulated over blocks of `chunk_size` target points, so memory stays bounded by the source
+    sample times the block size.
+
+    :param beta: width of the Gaussian displacement kernel, relative to the RMS radius of the target.
+    :param lamb: smoothness weight of the displacement field.
+    :param w: expected fraction of outliers in the target.
+    :return: the source points displaced.
+    """
+    generator = np.random.default_rng(seed)
+    # CPD's parameters assume data of unit size
+    centre = target.mean(axis=0)
+    size = np.sqrt(np.mean(np.sum(np.square(target - centre), axis=1)))
+    y = (_subsample(source, source_points, generator) - centre) / size
+    x = (_subsample(target, target_points, generator) - centre) / size
+    control = _subsample(y, control_points, generator)
+    m, d = y.shape
+    n = len(x)
+
+    g = _gaussian_kernel(y, control, beta)
+    g_control = _gaussian_kernel(control, control, beta)
+    weights = np.zeros((len(control), d))
+    moved = y.copy()
+    # the source is already aligned, so start from the residual of the alignment rather than from the spread of the
+    # whole point sets, which would first pull the source together and take many iterations to undo
+    nearest, _ = cKDTree(x).query(y)
+    sigma2 = max(np.mean(np.square(nearest)) / d, 1e-10)
+    x_squared = np.sum(np.square(x), axis=1)
+    for _ in range(max_iterations):
+        # E-step, block by block over the target points
+        outlier_term = (2 * np.pi * sigma2) ** (d / 2) * w / (1 - w) * m / n
+        p1 = np.zeros(m)
+        pt1 = np.zeros(n)
+        px = np.zeros((m, d))
+        moved_squared = np.sum(np.square(moved), axis=1)
+        for start in range(0, n, chunk_size):
+            block = x[start:start + chunk_size]
+            # in place, this block is the bulk of the run time
+            p = moved @ block.T
+            p *= -2.0
+            p += moved_squared[:, None]
+            p += x_squared[None, start:start + chunk_size]
+            np.maximum(p, 0.0, out=p)
+            p *= -1.0 / (2 * sigma2)
+            np.exp(p, out=p)
+            p /= p.sum(axis=0) + outlier_term
+            p1 += p.sum(axis=1)
+            pt1[start:start + chunk_size] = p.sum(axis=0)
+            px += p @ block
+        total = p1.sum()
+
+        # M-step on the control point weights: (G' diag(P1) G + lambda sigma2 Gc) W = G' (PX - diag(P1) Y)
+        weights = np.linalg.lstsq(g.T @ (p1[:, None] * g) + lamb * sigma2 * g_control,
+                                  g.T @ (px - p1[:, None] * y), rcond=None)[0]
+        moved = y + g @ weights
+        previous_sigma2 = sigma2
+        sigma2 = (np.dot(pt1, x_squared) - 2 * np.sum(px * moved) + np.dot(p1, np.sum(np.square(moved), axis=1))) / \
+            (total * d)
+        sigma2 = max(sigma2, 1e-10)
+        if abs(previous_sigma2 - sigma2) <= tolerance * previous_sigma2:
+            break
+
+    displaced = np.empty_like(source, dtype=np.float64)
+    for start in range(0, len(source), chunk_size):
+        block = (source[start:start + chunk_size] - centre) / size
+        displaced[start:start + chunk_size] = (block + _gaussian_kernel(block, control, beta) @ weights) * size + centre
+    return displaced
+
+
+def register_points(source: np.ndarray, target: np.ndarray, mode: str = 'affine', deformable: bool = False,
+                    icp_options: dict = None, cpd_options: dict = None) -> Registration:
+    """
+    Move the source points onto the target: a coarse ICP fit of a rigid, similarity or affine transform, followed by
+    an optional deformable CPD.
+
+    :param icp_options: keyword arguments of icp.
+    :param cpd_options: keyword arguments of cpd_deformable.
+    """
+    source = np.asarray(source, dtype=np.float64).reshape(-1, 3)
+    target = np.asarray(target, dtype=np.float64).reshape(-1, 3)
+    transform = icp(source, target, mode=mode, **(icp_options or dict()))
+    points = transform.apply(source)
+    if deformable:
+        points = cpd_deformable(points, target, **(cpd_options or dict()))
+    distances, _ = cKDTree(target).query(points)
+    return Registration(points, transform, float(np.sqrt(np.mean(np.square(distances)))))
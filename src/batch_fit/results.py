@@ -0,0 +1,219 @@
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    subject TEXT NOT NULL,
+    group_name TEXT NOT NULL,
+    rms REAL,
+    max_error REAL,
+    setting_id TEXT,
+    wall_time REAL,
+    input_hashes TEXT,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_subject ON results (subject, setting_id, group_name);
+CREATE TABLE IF NOT EXISTS steps (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    subject TEXT NOT NULL,
+    setting_id TEXT,
+    step INTEGER NOT NULL,
+    step_type TEXT,
+    iterations INTEGER,
+    wall_time REAL,
+    cpu_time REAL,
+    peak_rss REAL,
+    rms REAL,
+    max_error REAL,
+    recorded_at REAL NOT NULL,
+    result_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS steps_subject ON steps (subject, setting_id);
+CREATE TABLE IF NOT EXISTS failures (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    subject TEXT NOT NULL,
+    setting_id TEXT,
+    reason TEXT,
+    error TEXT,
+    recorded_at REAL NOT NULL
+);
+"""
+
+
+_INSERT_STEP = ('INSERT INTO steps (subject, setting_id, step, step_type, iterations, wall_time, cpu_time, peak_rss, '
+                'rms, max_error, recorded_at, result_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+
+def _step_rows(subject: str, setting_id, steps: list, recorded_at: float, result_id) -> list:
+    return [(subject, setting_id, step['step'], step['type'], step['iterations'], step['wall_time'], step['cpu_time'],
+             step['peak_rss'], step['rms'], step['max_error'], recorded_at, result_id) for step in steps or list()]
+
+
+class ResultsStore:
+    """
+    Append-only store of per-subject fit results in a local SQLite database. Every subject is appended in a single
+    transaction, so several processes can record results into the same store, and cohort tables are built with one
+    query instead of re-reading the results of every earlier run.
+
+    WAL mode needs shared memory between the writers, so it only works on a local filesystem. Workers on several
+    hosts sharing one store over a network filesystem should open it with `wal=False`.
+    """
+
+    def __init__(self, store_path: Path, timeout: float = 60.0, wal: bool = True):
+        self._store_path = Path(store_path)
+        self._store_path.parent.mkdir(parents=True, exist_ok=True)
+        self._timeout = timeout
+        connection = self._connect()
+        try:
+            connection.execute('PRAGMA journal_mode=' + ('WAL' if wal else 'DELETE'))
+            connection.executescript(_SCHEMA)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(str(self._store_path), timeout=self._timeout)
+
+    def append(self, subject: str, group_rms: dict, total_rms: float, max_error: float = None, setting_id=None,
+               wall_time: float = None, input_hashes: dict = None, steps: list = None, once: bool = False) -> bool:
+        """
+        Record the fit of one subject: a row per group, plus a 'total' row carrying the maximum projection error,
+        and a row per fitter step in the steps table if `steps` (BatchFit.get_step_metrics) is given.
+
+        :param once: record nothing if a fit of the subject with the same setting and input hashes is recorded
+        already, e.g. by a worker that died before marking the subject done.
+        :return: True if the fit was recorded.
+        """
+        recorded_at = time.time()
+        hashes = json.dumps(input_hashes, sort_keys=True) if input_hashes else None
+        setting_id = None if setting_id is None else str(setting_id)
+        rows = [(subject, group_name, rms, None, setting_id, wall_time, hashes, recorded_at)
+                for group_name, rms in group_rms.items()]
+
+        connection = self._connect()
+        try:
+            with connection:
+                if once:
+                    # hold the write lock from the check on, so two writers cannot both find the fit missing
+                    connection.execute('BEGIN IMMEDIATE')
+                    if connection.execute('SELECT 1 FROM results WHERE subject = ? AND IFNULL(setting_id, \'\') = '
+                                          'IFNULL(?, \'\') AND input_hashes IS ? AND group_name = \'total\'',
+                                          (subject, setting_id, hashes)).fetchone() is not None:
+                        return False
+                connection.executemany(
+                    'INSERT INTO results (subject, group_name, rms, max_error, setting_id, wall_time, input_hashes, '
+                    'recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                # the steps of the fit point at its 'total' row
+                result_id = connection.execute(
+                    'INSERT INTO results (subject, group_name, rms, max_error, setting_id, wall_time, input_hashes, '
+                    'recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (subject, 'total', total_rms, max_error, setting_id, wall_time, hashes, recorded_at)).lastrowid
+                connection.executemany(_INSERT_STEP, _step_rows(subject, setting_id, steps, recorded_at, result_id))
+        finally:
+            connection.close()
+        return True
+
+    def append_failure(self, subject: str, reason: str, error: str = None, setting_id=None, steps: list = None):
+        """
+        Record a fit that did not finish, e.g. one stopped for exceeding its time or memory limit, with the metrics of
+        the fitter steps it completed. No results rows are written, so the last complete fit stays the latest result.
+        """
+        recorded_at = time.time()
+        setting_id = None if setting_id is None else str(setting_id)
+
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute('INSERT INTO failures (subject, setting_id, reason, error, recorded_at) '
+                                   'VALUES (?, ?, ?, ?, ?)', (subject, setting_id, reason, error, recorded_at))
+                connection.executemany(_INSERT_STEP, _step_rows(subject, setting_id, steps, recorded_at, None))
+        finally:
+            connection.close()
+
+    def query(self, setting_id=None, subjects=None) -> 'pandas.DataFrame':
+        """
+        :return: long table with the latest result of every (subject, setting, group), optionally filtered.
+        """
+        sql = ('SELECT r.* FROM results r JOIN ('
+               '    SELECT subject, IFNULL(setting_id, \'\') AS setting_key, MAX(recorded_at) AS latest'
+               '    FROM results GROUP BY subject, setting_key'
+               ') l ON r.subject = l.subject AND IFNULL(r.setting_id, \'\') = l.setting_key '
+               'AND r.recorded_at = l.latest')
+        conditions = list()
+        parameters = list()
+        if setting_id is not None:
+            conditions.append('r.setting_id = ?')
+            parameters.append(str(setting_id))
+        if subjects is not None:
+            subjects = list(subjects)
+            conditions.append(f'r.subject IN ({", ".join("?" * len(subjects))})')
+            parameters.extend(subjects)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+
+        connection = self._connect()
+        try:
+            return _read_sql_query(connection, sql + ' ORDER BY r.id', parameters)
+        finally:
+            connection.close()
+
+    def query_steps(self, setting_id=None) -> 'pandas.DataFrame':
+        """
+        :return: the fitter step metrics of the latest fit of every subject, optionally for one setting only. A
+        latest fit that recorded no steps has none, the steps of earlier fits are not taken instead.
+        """
+        # the 'total' row of the latest result of every (subject, setting), and the steps linked to it
+        sql = ('SELECT s.* FROM steps s JOIN ('
+               '    SELECT r.id FROM results r JOIN ('
+               '        SELECT subject, IFNULL(setting_id, \'\') AS setting_key, MAX(recorded_at) AS latest'
+               '        FROM results GROUP BY subject, setting_key'
+               '    ) l ON r.subject = l.subject AND IFNULL(r.setting_id, \'\') = l.setting_key '
+               '    AND r.recorded_at = l.latest AND r.group_name = \'total\''
+               ') t ON s.result_id = t.id')
+        parameters = list()
+        if setting_id is not None:
+            sql += ' WHERE s.setting_id = ?'
+            parameters.append(str(setting_id))
+
+        connection = self._connect()
+        try:
+            return _read_sql_query(connection, sql + ' ORDER BY s.id', parameters)
+        finally:
+            connection.close()
+
+    def export_csv(self, output_csv_path: Path, setting_id=None):
+        """
+        Write the wide RMS table (one row per group, one column per subject, plus a 'total' row) used by the
+        rms_output_dir CSV files.
+        """
+        df = self.query(setting_id=setting_id)
+        if df.empty:
+            return
+
+        group_order = list(dict.fromkeys(df['group_name']))
+        group_order.remove('total')
+        wide_df = df.pivot_table(index='group_name', columns='subject', values='rms', aggfunc='last')
+        wide_df = wide_df.reindex(index=group_order + ['total'], columns=sorted(set(df['subject'])))
+        wide_df.index.name = None
+        wide_df.columns.name = None
+
+        # several workers may export at the same time, replace the file in one step so readers never see half of it
+        output_csv_path = Path(output_csv_path)
+        output_csv_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = output_csv_path.with_name(f'{output_csv_path.name}.{os.getpid()}.tmp')
+        wide_df.to_csv(temporary_path)
+        os.replace(temporary_path, output_csv_path)
+
+
+def _read_sql_query(connection, sql: str, parameters: list) -> 'pandas.DataFrame':
+    # pandas is only loaded to read results back, not by every run appending to the store
+    import pandas as pd
+    return pd.read_sql_query(sql, connection, params=parameters)
@@ -0,0 +1,173 @@
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
+from typing import Any, Callable, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple, Union
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+class JobResult(NamedTuple):
+    name: str
+    value: Any
+    error: Optional[str]
+    limit: Optional[str] = None  # 'time' or 'memory' when the job was stopped for exceeding that limit
+
+
+def run_parallel(function: Callable, jobs: Union[Dict[str, tuple], Iterable[Tuple[str, tuple]]],
+                 num_workers: int, time_limit: float = None, memory_limit: float = None,
+                 poll_interval: float = 1.0, on_start: Callable[[str, int], None] = None) -> Iterator[JobResult]:
+    """
+    Run `function(*args)` for every job, each one in its own worker process, with at most `num_workers` processes
+    alive at the same time. A fresh process per job keeps the Zinc state of one subject away from the others, and
+    means a job that raises or crashes the interpreter is reported as a failed result instead of stopping the batch.
+
+    :param function: module level callable, so it can be sent to the worker process.
+    :param jobs: mapping of job name to the positional arguments of `function`, or an iterable of (name, arguments)
+    pairs. An iterable is only advanced when a worker is free, so it can hand out jobs lazily.
+    :param num_workers: maximum number of concurrent worker processes.
+    :param time_limit: wall-clock seconds a job may run before its process is terminated.
+    :param memory_limit: resident set size in MB a job process may reach before it is terminated. Checked every
+    `poll_interval` seconds, and only where the platform reports the RSS of other processes (Linux).
+    :param on_start: called with the name of every job and the process id of its worker when the job starts.
+    :return: iterator of JobResult, in completion order.
+    """
+    supervised = time_limit is not None or memory_limit is not None
+    pending = iter(jobs.items()) if isinstance(jobs, dict) else iter(jobs)
+    exhausted = False
+    running = dict()
+
+    while not exhausted or running:
+        while not exhausted and len(running) < max(1, num_workers):
+            try:
+                name, args = next(pending)
+            except StopIteration:
+                exhausted = True
+                break
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_worker, args=(sender, function, args), name=name, daemon=True)
+            process.start()
+            # only the worker may hold the sending end, so a dead worker shows up as EOF on the receiver
+            sender.close()
+            running[receiver] = (name, process, time.monotonic())
+            if on_start is not None:
+                on_start(name, process.pid)
+
+        if not running:
+            break
+
+        for receiver in wait(list(running), poll_interval if supervised else None):
+            name, process, _ = running.pop(receiver)
+            try:
+                value, error = receiver.recv()
+            except EOFError:
+                value, error = None, None
+            receiver.close()
+            process.join()
+            if error is None and process.exitcode != 0:
+                error = f'worker process exited with code {process.exitcode}'
+            yield JobResult(name, value, error)
+
+        if supervised:
+            for receiver, (name, process, started) in list(running.items()):
+                error = None
+                if time_limit is not None and time.monotonic() - started > time_limit:
+                    error, limit = f'time limit of {time_limit} s exceeded', 'time'
+                elif memory_limit is not None and (process_rss_mb(process.pid) or 0.0) > memory_limit:
+                    error, limit = f'memory limit of {memory_limit} MB exceeded', 'memory'
+                if error is not None:
+                    del running[receiver]
+                    _stop(process)
+                    receiver.close()
+                    yield JobResult(name, None, error, limit)
+
+
+def _stop(process, grace_period: float = 5.0):
+    process.terminate()
+    process.join(grace_period)
+    if process.is_alive():
+        process.kill()
+        process.join()
+
+
+def process_rss_mb(pid: int):
+    """
+    :return: current resident set size of a process in MB, or None where /proc is not available.
+    """
+    try:
+        with open(f'/proc/{pid}/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+# peak RSS in MB this process reached before reset_peak_rss last reset its high-water mark
+_peak_rss_before_reset = 0.0
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the high-water mark of the resident set size of this process, so peak_rss_since_reset_mb gives the peak
+    from now on, including memory allocated and freed again inside a single long call. peak_rss_mb still reports the
+    peak over the life of the process.
+
+    :return: whether the mark was reset, which needs /proc/self/clear_refs (Linux 4.0 and later).
+    """
+    global _peak_rss_before_reset
+    peak = _proc_status_mb('VmHWM')
+    if peak is None:
+        return False
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    _peak_rss_before_reset = max(_peak_rss_before_reset, peak)
+    return True
+
+
+def peak_rss_since_reset_mb():
+    """
+    :return: peak resident set size of this process in MB since reset_peak_rss, or None where /proc is not available.
+    """
+    return _proc_status_mb('VmHWM')
+
+
+def peak_rss_mb():
+    """
+    :return: peak resident set size of this process in MB over its life, or None where the platform does not report
+    it.
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    peak_rss = peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+    return max(peak_rss, _peak_rss_before_reset)
+
+
+def _proc_status_mb(key: str):
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, IndexError, ValueError):
+        return None
+    return None
+
+
+def _worker(connection, function, args):
+    try:
+        result = (function(*args), None)
+    except BaseException:
+        result = (None, traceback.format_exc())
+    connection.send(result)
+    connection.close()
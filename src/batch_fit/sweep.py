@@ -0,0 +1,115 @@
+import copy
+import itertools
+import json
+import random
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas
+
+
+def sweep_points(sweep: dict):
+    """
+    Parameter combinations of a sweep, either the full grid of the listed values or `samples` random draws from
+    them with the given `seed`.
+
+    :param sweep: the sweep block of fit.yaml, with lists of 'strain_penalty_scale', 'curvature_penalty_scale' and
+    'iterations' values. An empty or missing list leaves that parameter as it is in the base settings.
+    :return: list of dicts with one value (or None) per parameter.
+    """
+    names = ['strain_penalty_scale', 'curvature_penalty_scale', 'iterations']
+    values = [list(sweep.get(name) or [None]) for name in names]
+
+    if sweep.get('mode', 'grid') == 'grid':
+        combinations = list(itertools.product(*values))
+    elif sweep['mode'] == 'random':
+        generator = random.Random(sweep.get('seed'))
+        combinations = list()
+        for _ in range(sweep['samples']):
+            combination = tuple(generator.choice(value) for value in values)
+            if combination not in combinations:
+                combinations.append(combination)
+    else:
+        raise ValueError(f'Unknown sweep mode {sweep["mode"]}')
+
+    return [dict(zip(names, combination)) for combination in combinations]
+
+
+def apply_sweep_point(settings: dict, point: dict) -> dict:
+    """
+    Derive fit settings from the base settings: scale the strain and curvature penalties given by every fit step,
+    for the default and for single groups, and set the number of iterations of every fit step.
+    """
+    settings = copy.deepcopy(settings)
+    for fitter_step in settings['fitterSteps']:
+        if not fitter_step.get('_FitterStepFit'):
+            continue
+        for group_settings in fitter_step['groupSettings'].values():
+            for key, scale_name in (('strainPenalty', 'strain_penalty_scale'),
+                                    ('curvaturePenalty', 'curvature_penalty_scale')):
+                if key in group_settings and point[scale_name] is not None:
+                    group_settings[key] = [value * point[scale_name] for value in group_settings[key]]
+        if point['iterations'] is not None:
+            fitter_step['numberOfIterations'] = point['iterations']
+    return settings
+
+
+def write_reduced_settings(setting_file: Path, iterations_scale: float, output_file: Path) -> Path:
+    """
+    Write a cheaper variant of a settings file, with the iterations of every fit step scaled down (at least 1).
+    """
+    with open(setting_file, 'r') as f:
+        settings = json.load(f)
+    for fitter_step in settings['fitterSteps']:
+        if fitter_step.get('_FitterStepFit') and 'numberOfIterations' in fitter_step:
+            fitter_step['numberOfIterations'] = max(1, int(round(fitter_step['numberOfIterations'] * iterations_scale)))
+
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_file, 'w') as f:
+        json.dump(settings, f, indent=4)
+    return output_file
+
+
+def sweep_setting_id(base_setting_id: str, point: dict) -> str:
+    parts = [str(base_setting_id)]
+    for name, short_name in (('strain_penalty_scale', 'sp'), ('curvature_penalty_scale', 'cp'), ('iterations', 'it')):
+        if point[name] is not None:
+            parts.append(f'{short_name}{point[name]:g}')
+    return '-'.join(parts)
+
+
+def write_sweep_settings(setting_file: Path, base_setting_id: str, sweep: dict, output_dir: Path) -> dict:
+    """
+    Write one settings file per sweep point.
+
+    :return: dict of setting id to settings file.
+    """
+    with open(setting_file, 'r') as f:
+        base_settings = json.load(f)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    setting_files = dict()
+    for point in sweep_points(sweep):
+        setting_id = sweep_setting_id(base_setting_id, point)
+        setting_files[setting_id] = output_dir / f'settings_{setting_id}.json'
+        with open(setting_files[setting_id], 'w') as f:
+            json.dump(apply_sweep_point(base_settings, point), f, indent=4)
+    return setting_files
+
+
+def rank_settings(results: 'pandas.DataFrame') -> 'pandas.DataFrame':
+    """
+    Rank the settings of a sweep on their mean RMS over the subjects, per group and for the total RMS.
+
+    :param results: long results table, as returned by ResultsStore.query.
+    :return: table with one row per group and a column with the mean RMS of every setting, plus the best setting
+    and its mean RMS.
+    """
+    mean_rms = results.pivot_table(index='group_name', columns='setting_id', values='rms', aggfunc='mean')
+    mean_rms.columns.name = None
+    ranking = mean_rms.copy()
+    ranking.insert(0, 'best_rms', mean_rms.min(axis=1))
+    ranking.insert(0, 'best_setting', mean_rms.idxmin(axis=1))
+    ranking.index.name = None
+    return ranking
@@ -0,0 +1,199 @@
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable
+
+
+class WorkQueue:
+    """
+    Coordinator-free work queue on a shared filesystem. A worker owns a subject while it holds the subject's lease
+    file, created with O_CREAT | O_EXCL so only one worker can claim it, and kept alive by touching it. Leases not
+    renewed within `lease_seconds` belong to dead workers and can be taken over. A finished fit is only published by
+    a worker still holding the lease, and the subject's done marker is written after its result is stored, so a
+    worker dying in between leaves the subject due again instead of done without a result.
+
+    Every file is keyed on the subject and its fit key, so new inputs or settings make a subject due again. Lease
+    expiry compares file modification times with the local clock, so the hosts' clocks must roughly agree.
+    """
+
+    def __init__(self, queue_dir: Path, lease_seconds: float = 600.0, worker_id: str = None):
+        self._queue_dir = Path(queue_dir)
+        self._lease_seconds = lease_seconds
+        self._worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        for sub_directory in ('leases', 'done', 'failed'):
+            (self._queue_dir / sub_directory).mkdir(parents=True, exist_ok=True)
+        self._held = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._stop = threading.Event()
+
+    @property
+    def worker_id(self):
+        return self._worker_id
+
+    def run_id(self) -> str:
+        """
+        :return: id of the run the queue belongs to, created by the first worker asking for it, so every worker sharing
+        the queue directory, on any host, tags its output with the same one.
+        """
+        run_id_path = self._queue_dir / 'run_id'
+        if not run_id_path.exists():
+            temporary_path = self._queue_dir / f'.run_id.{self._worker_id}'
+            temporary_path.write_text(uuid.uuid4().hex[:12])
+            try:
+                # linked once written, so no worker reads a partly written id
+                os.link(str(temporary_path), str(run_id_path))
+            except FileExistsError:
+                pass
+            finally:
+                temporary_path.unlink()
+        return run_id_path.read_text().strip()
+
+    def _path(self, kind: str, subject: str, key: str) -> Path:
+        suffix = '.lease' if kind == 'leases' else '.json'
+        return self._queue_dir / kind / f'{subject}.{key[:16]}{suffix}'
+
+    def is_finished(self, subject: str, key: str) -> bool:
+        return self._path('done', subject, key).exists() or self._path('failed', subject, key).exists()
+
+    def holds(self, subject: str, key: str) -> bool:
+        """
+        :return: True if this worker holds the lease of the subject, i.e. it was not taken over by another worker.
+        """
+        try:
+            with open(self._path('leases', subject, key), 'r') as f:
+                return json.load(f).get('worker') == self._worker_id
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def claim(self, subject: str, key: str) -> bool:
+        """
+        :return: True if this worker now holds the lease of the subject.
+        """
+        if self.is_finished(subject, key):
+            return False
+        lease_path = self._path('leases', subject, key)
+        if not _create_exclusive(lease_path, {'worker': self._worker_id, 'claimed_at': time.time()}):
+            if not self._break_stale_lease(lease_path):
+                return False
+            if not _create_exclusive(lease_path, {'worker': self._worker_id, 'claimed_at': time.time()}):
+                return False
+        # a done marker may have appeared between the first check and the claim
+        if self.is_finished(subject, key):
+            self._remove_lease(lease_path)
+            return False
+        with self._lock:
+            self._held.add(lease_path)
+        return True
+
+    def _break_stale_lease(self, lease_path: Path) -> bool:
+        try:
+            if time.time() - lease_path.stat().st_mtime < self._lease_seconds:
+                return False
+            # only one of the workers racing for a stale lease manages to move it away
+            stale_path = lease_path.with_name(f'{lease_path.name}.stale-{self._worker_id}')
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return True
+        if time.time() - stale_path.stat().st_mtime < self._lease_seconds:
+            # renewed just before it was moved: hand it back to its owner
+            try:
+                os.rename(stale_path, lease_path)
+            except OSError:
+                pass
+            return False
+        os.remove(stale_path)
+        return True
+
+    def publish(self, subject: str, key: str, result: dict, source: Path, destination: Path,
+                record: Callable[[], None]) -> bool:
+        """
+        Publish the fit of a subject this worker holds: move the fit directory `source` to `destination`, store the
+        result with `record`, then mark the subject done. A worker dying before the done marker leaves the subject to
+        be fitted again once its lease is stale, so `record` must not store a result stored before, see
+        ResultsStore.append(once=True).
+
+        :return: True if the fit was published, False if another worker took the lease over and the fit was dropped.
+        """
+        if not self.holds(subject, key):
+            shutil.rmtree(source, ignore_errors=True)
+            return False
+        publish_directory(source, destination)
+        record()
+        self.complete(subject, key, result)
+        return True
+
+    def complete(self, subject: str, key: str, result: dict) -> bool:
+        """
+        Mark a subject done with its result.
+
+        :return: True if this is the first completion, which is the one to record.
+        """
+        first = _create_exclusive(self._path('done', subject, key), {'worker': self._worker_id, 'result': result})
+        self._remove_lease(self._path('leases', subject, key))
+        return first
+
+    def fail(self, subject: str, key: str, error: str):
+        _create_exclusive(self._path('failed', subject, key), {'worker': self._worker_id, 'error': error})
+        self._remove_lease(self._path('leases', subject, key))
+
+    def _remove_lease(self, lease_path: Path):
+        with self._lock:
+            self._held.discard(lease_path)
+        try:
+            with open(lease_path, 'r') as f:
+                owner = json.load(f).get('worker')
+            if owner == self._worker_id:
+                os.remove(lease_path)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def start_heartbeat(self):
+        """
+        Renew the held leases from a background thread every third of the lease time.
+        """
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._renew_leases, name='lease heartbeat', daemon=True)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def _renew_leases(self):
+        while not self._stop.wait(self._lease_seconds / 3):
+            with self._lock:
+                held = list(self._held)
+            for lease_path in held:
+                try:
+                    os.utime(lease_path)
+                except FileNotFoundError:
+                    pass
+
+
+def _create_exclusive(path: Path, content: dict) -> bool:
+    try:
+        fd = os.open(str(path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump(content, f)
+    return True
+
+
+def publish_directory(source: Path, destination: Path):
+    """
+    Move a finished output directory into its final place, replacing an earlier version of it.
+    """
+    if destination.exists():
+        old_path = destination.with_name(f'.{destination.name}.old-{os.getpid()}-{uuid.uuid4().hex[:8]}')
+        os.rename(destination, old_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+    os.rename(source, destination)
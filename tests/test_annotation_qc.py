@@ -0,0 +1,24 @@
+import numpy as np
+
+from batch_fit.annotation_qc import AnnotationQC, GroupIndex
+
+
+def test_empty_group():
+    group_index = GroupIndex(np.empty((0, 3)))
+    distances, indices = group_index.knn(3)
+    assert distances.shape == (0, 3)
+    assert indices.shape == (0, 3)
+    assert group_index.mean_knn_distance(5, include_self=True).shape == (0,)
+    assert group_index.mean_knn_distance(5).shape == (0,)
+    assert group_index.noise_mask(eps=1.0, min_samples=2).shape == (0,)
+
+
+def test_empty_group_of_annotation_qc():
+    qc = AnnotationQC(np.random.default_rng(0).random((10, 3)), {'empty': np.array([], dtype=np.intp)})
+    assert qc.group('empty').noise_mask(eps=1.0, min_samples=3).shape == (0,)
+
+
+def test_knn_pads_small_groups():
+    distances, indices = GroupIndex(np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0]])).knn(2)
+    np.testing.assert_array_equal(distances, [[1.0, np.inf], [1.0, np.inf]])
+    np.testing.assert_array_equal(indices, [[1, 2], [0, 2]])
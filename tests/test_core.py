@@ -0,0 +1,89 @@
+import inspect
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip('opencmiss.zinc')
+pytest.importorskip('scaffoldfitter')
+
+from opencmiss.zinc.context import Context
+from opencmiss.zinc.element import Element, Elementbasis
+from opencmiss.zinc.field import Field
+from opencmiss.zinc.region import Region
+from scaffoldfitter.fitter import Fitter
+
+from batch_fit.core import BatchFit, _BatchFitter, load_scaffold_template
+from batch_fit.data_combiner import write_ex
+
+
+DATA = {'lung': np.array([[0.1, 0.2, 0.3], [0.9, 0.8, 0.7], [0.5, 0.5, 0.5]])}
+
+
+def _write_cube(path):
+    region = Context('Cube').getDefaultRegion()
+    field_module = region.getFieldmodule()
+    field_module.beginChange()
+    coordinates = field_module.createFieldFiniteElement(3)
+    coordinates.setName('coordinates')
+    coordinates.setManaged(True)
+    coordinates.setTypeCoordinate(True)
+    nodes = field_module.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
+    node_template = nodes.createNodetemplate()
+    node_template.defineField(coordinates)
+    field_cache = field_module.createFieldcache()
+    for index in range(8):
+        node = nodes.createNode(index + 1, node_template)
+        field_cache.setNode(node)
+        coordinates.assignReal(field_cache, [index % 2, index // 2 % 2, index // 4])
+    mesh = field_module.findMeshByDimension(3)
+    element_template = mesh.createElementtemplate()
+    element_template.setElementShapeType(Element.SHAPE_TYPE_CUBE)
+    basis = field_module.createElementbasis(3, Elementbasis.FUNCTION_TYPE_LINEAR_LAGRANGE)
+    eft = mesh.createElementfieldtemplate(basis)
+    element_template.defineField(coordinates, -1, eft)
+    element = mesh.createElement(1, element_template)
+    element.setNodesByIdentifier(eft, list(range(1, 9)))
+    field_module.defineAllFaces()
+    field_module.endChange()
+    region.writeFile(str(path))
+
+
+def test_base_fitter_reads_through_its_regions():
+    # _BatchFitter swaps these regions for in-memory stand-ins while the base class reads them
+    assert 'self._region.readFile(self._zincModelFileName)' in inspect.getsource(Fitter._loadModel)
+    assert 'self._rawDataRegion.readFile(self._zincDataFileName)' in inspect.getsource(Fitter._loadData)
+
+
+def test_memory_fitter_loads_like_the_file_fitter(tmp_path):
+    model_file = tmp_path / 'cube.exf'
+    data_file = tmp_path / 'data.exdata'
+    _write_cube(model_file)
+    write_ex(data_file, DATA)
+    file_fitter = Fitter(str(model_file), str(data_file))
+    file_fitter.load()
+
+    # neither file exists, so everything loaded came from memory
+    memory_fitter = _BatchFitter(str(tmp_path / 'missing.exf'), str(tmp_path / 'missing.exdata'),
+                                 model_buffer=load_scaffold_template(model_file), data=DATA)
+    memory_fitter.load()
+
+    assert isinstance(memory_fitter._region, Region)
+    assert isinstance(memory_fitter._rawDataRegion, Region)
+    assert memory_fitter.getHighestDimensionMesh().getSize() == 1
+    datapoints = memory_fitter.getRegion().getFieldmodule().findNodesetByFieldDomainType(Field.DOMAIN_TYPE_DATAPOINTS)
+    assert datapoints.getSize() == len(DATA['lung'])
+    np.testing.assert_allclose(memory_fitter.getDataCentre(), file_fitter.getDataCentre())
+    assert memory_fitter.getDataScale() == pytest.approx(file_fitter.getDataScale())
+
+
+def test_iteration_files_follow_the_fitter_names(tmp_path):
+    batch_fit = SimpleNamespace(_output_dir=str(tmp_path / 'fit_'), _is_iterative=BatchFit._is_iterative)
+    fit_step = SimpleNamespace(getJsonTypeId=lambda: '_FitterStepFit')
+    align_step = SimpleNamespace(getJsonTypeId=lambda: '_FitterStepAlign')
+
+    assert BatchFit._iteration_files(batch_fit, 1, align_step, None, True) == [tmp_path / 'fit_1_align.exf']
+    assert BatchFit._iteration_files(batch_fit, 2, fit_step, 3, True) == \
+        [tmp_path / 'fit_2_fit1.exf', tmp_path / 'fit_2_fit2.exf', tmp_path / 'fit_2_fit3.exf']
+    # a converged step run one iteration at a time only writes the model after the last one
+    assert BatchFit._iteration_files(batch_fit, 2, fit_step, 3, False) == [tmp_path / 'fit_2_fit3.exf']
@@ -0,0 +1,51 @@
+import numpy as np
+
+from batch_fit.decimation import decimate_groups, group_spacing, voxel_decimate
+
+
+DECIMATION = {'surface_spacing': 2.0, 'edge_spacing': 0.5, 'spacing': {'RLL_lateral': 3.0}}
+
+
+def _grid(count, step):
+    axis = np.arange(count) * step
+    return np.stack(np.meshgrid(axis, axis, axis, indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def test_voxel_decimate_keeps_the_point_nearest_the_voxel_mean():
+    points = np.array([[0.0, 0.0, 0.0], [0.4, 0.4, 0.4], [0.9, 0.9, 0.9], [5.0, 5.0, 5.0]])
+    np.testing.assert_array_equal(voxel_decimate(points, 1.0), [1, 3])
+
+
+def test_voxel_decimate_keeps_one_point_per_occupied_voxel():
+    points = _grid(10, 0.25)
+    kept = voxel_decimate(points, 1.0)
+    assert len(kept) == 27
+    assert np.all(np.diff(kept) > 0)
+    voxels = np.floor(points[kept] / 1.0)
+    assert len(np.unique(voxels, axis=0)) == len(kept)
+
+
+def test_voxel_decimate_without_spacing_keeps_every_point():
+    points = _grid(3, 1.0)
+    for spacing in (0.0, -1.0, None):
+        np.testing.assert_array_equal(voxel_decimate(points, spacing), np.arange(len(points)))
+    np.testing.assert_array_equal(voxel_decimate(points[:1], 1.0), [0])
+    assert len(voxel_decimate(np.zeros((0, 3)), 1.0)) == 0
+
+
+def test_group_spacing():
+    assert group_spacing('RLL_lateral', DECIMATION) == 3.0
+    assert group_spacing('edge_RL_posterior', DECIMATION) == 0.5
+    assert group_spacing('RUL_medial', DECIMATION) == 2.0
+    assert group_spacing('edge_RL_posterior', {'surface_spacing': 2.0}) == 0.0
+    assert group_spacing('RUL_medial', {'spacing': None}) == 0.0
+
+
+def test_decimate_groups_per_group_spacing():
+    data = {'surface': _grid(8, 0.5), 'edge': _grid(8, 0.5), 'whole': _grid(2, 0.5)}
+    decimated, report = decimate_groups(data, {'surface': 2.0, 'edge': 1.0})
+    assert report == {'surface': (512, 8), 'edge': (512, 64), 'whole': (8, 8)}
+    for group_name, points in decimated.items():
+        assert points.shape == (report[group_name][1], 3)
+        # kept points are data points, not voxel means
+        assert np.all(np.any(np.all(points[:, None] == data[group_name][None], axis=-1), axis=1))
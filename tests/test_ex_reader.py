@@ -0,0 +1,71 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from batch_fit import ex_reader
+from batch_fit.ex_reader import parse_ex_points, read_ex_points, read_ex_points_zinc
+
+
+DATA_FILE = Path(__file__).parent / 'resources' / 'hla-tlc_pred.exdata'
+
+# node ranges of the groups in hla-tlc_pred.exdata
+EXPECTED_GROUPS = {
+    'base of left lung surface': (1, 1688),
+    'lateral surface of lower lobe of left lung': (1689, 4960),
+    'medial surface of lower lobe of left lung': (4961, 8407),
+    'lateral surface of upper lobe of left lung': (8408, 13554),
+    'medial surface of upper lobe of left lung': (13555, 17201),
+}
+
+
+def test_parse_ex_points():
+    points = parse_ex_points(DATA_FILE, nodeset='datapoints')
+    assert points.coordinates.shape == (17201, 3)
+    assert points.coordinates.dtype == np.float64
+    np.testing.assert_array_equal(points.identifiers, np.arange(1, 17202))
+    np.testing.assert_array_equal(points.coordinates[0], [219.75, 120.625, -239.375])
+    np.testing.assert_array_equal(points.coordinates[-1], [237.875, 104.125, -240.125])
+    assert set(points.groups) == set(EXPECTED_GROUPS)
+    for group_name, (first, last) in EXPECTED_GROUPS.items():
+        np.testing.assert_array_equal(points.identifiers[points.groups[group_name]], np.arange(first, last + 1))
+
+
+def test_parse_ex_points_across_blocks(monkeypatch):
+    # blocks much smaller than a node split the node block and the groups at many places
+    points = parse_ex_points(DATA_FILE, nodeset='datapoints')
+    monkeypatch.setattr(ex_reader, '_BLOCK_SIZE', 7)
+    blocked_points = parse_ex_points(DATA_FILE, nodeset='datapoints')
+    np.testing.assert_array_equal(blocked_points.coordinates, points.coordinates)
+    np.testing.assert_array_equal(blocked_points.identifiers, points.identifiers)
+    assert set(blocked_points.groups) == set(points.groups)
+    for group_name, rows in points.groups.items():
+        np.testing.assert_array_equal(blocked_points.groups[group_name], rows)
+
+
+def test_unsupported_layout(tmp_path):
+    ex_file = tmp_path / 'nodes.exnode'
+    ex_file.write_text(DATA_FILE.read_text().replace('!#nodeset datapoints', '!#nodeset nodes'))
+    with pytest.raises(ex_reader.UnsupportedExFormat):
+        parse_ex_points(ex_file, nodeset='datapoints')
+    assert parse_ex_points(ex_file, nodeset='nodes').coordinates.shape == (17201, 3)
+
+    ex_file.write_text(DATA_FILE.read_text().replace('Node: 2\n', 'Node: 2\n label\n', 1))
+    with pytest.raises(ex_reader.UnsupportedExFormat):
+        parse_ex_points(ex_file, nodeset='datapoints')
+
+
+def test_read_ex_points_uses_native_reader():
+    points = read_ex_points(DATA_FILE, nodeset='datapoints')
+    np.testing.assert_array_equal(points.coordinates, parse_ex_points(DATA_FILE, nodeset='datapoints').coordinates)
+
+
+def test_native_reader_matches_zinc():
+    pytest.importorskip('opencmiss.zinc')
+    points = parse_ex_points(DATA_FILE, nodeset='datapoints')
+    zinc_points = read_ex_points_zinc(DATA_FILE, nodeset='datapoints')
+    np.testing.assert_array_equal(points.identifiers, zinc_points.identifiers)
+    np.testing.assert_allclose(points.coordinates, zinc_points.coordinates, rtol=0, atol=1e-12)
+    assert set(points.groups) == set(zinc_points.groups)
+    for group_name, rows in points.groups.items():
+        np.testing.assert_array_equal(np.sort(rows), np.sort(zinc_points.groups[group_name]))
@@ -0,0 +1,24 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+
+SRC = Path(__file__).parent.parent / 'src'
+
+HEAVY_MODULES = ('opencmiss.zinc', 'scaffoldfitter', 'matplotlib', 'mpl_toolkits', 'pandas', 'sklearn')
+
+
+@pytest.mark.parametrize('module', ['batch_fit', 'batch_fit.pipeline', 'batch_fit.results', 'batch_fit.sweep',
+                                    'batch_fit.fit_output', 'batch_fit.fix_annotations'])
+def test_import_is_lazy(module):
+    # a fresh interpreter, since the other tests may have loaded any of the heavy modules already
+    code = (f'import sys\n'
+            f'sys.path.insert(0, {str(SRC)!r})\n'
+            f'import {module}\n'
+            f'print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))')
+    process = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    assert process.returncode == 0, process.stderr
+    assert process.stdout.strip() == '', f'importing {module} loads {process.stdout.strip()}'
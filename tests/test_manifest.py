@@ -0,0 +1,101 @@
+import pytest
+
+from batch_fit.manifest import RunManifest, hash_file, subject_data_key, subject_fit_key
+
+
+GROUPS = {'lung': 'right lung', 'fissure': 'oblique fissure'}
+
+
+@pytest.fixture
+def cohort(tmp_path):
+    subject_path = tmp_path / 'subjects' / 's1'
+    subject_path.mkdir(parents=True)
+    (subject_path / 'lung.exdata').write_text('lung points')
+    (subject_path / 'fissure.exdata').write_text('fissure points')
+    scaffold_path = tmp_path / 'scaffold.exf'
+    scaffold_path.write_text('scaffold')
+    setting_file = tmp_path / 'settings_02.json'
+    setting_file.write_text('{"steps": []}')
+    fit_dir = tmp_path / 'fit_files' / 's1'
+    fit_dir.mkdir(parents=True)
+
+    manifest = RunManifest(tmp_path / 'manifest.json')
+    data_key = subject_data_key(subject_path, GROUPS)
+    fit_key = subject_fit_key(data_key, hash_file(scaffold_path), hash_file(setting_file))
+    manifest.update('s1', data_key, fit_key, fit_dir)
+    return {'manifest_path': tmp_path / 'manifest.json', 'subject_path': subject_path,
+            'scaffold_path': scaffold_path, 'setting_file': setting_file, 'fit_dir': fit_dir}
+
+
+def _keys(cohort, groups=GROUPS):
+    data_key = subject_data_key(cohort['subject_path'], groups)
+    return data_key, subject_fit_key(data_key, hash_file(cohort['scaffold_path']), hash_file(cohort['setting_file']))
+
+
+def test_unchanged_subject_is_valid(cohort):
+    manifest = RunManifest(cohort['manifest_path'])
+    data_key, fit_key = _keys(cohort)
+    assert manifest.is_combined_valid('s1', data_key)
+    assert manifest.is_fit_valid('s1', fit_key)
+
+
+def test_changed_setting_invalidates_the_fit(cohort):
+    cohort['setting_file'].write_text('{"steps": [{"iterations": 2}]}')
+    manifest = RunManifest(cohort['manifest_path'])
+    data_key, fit_key = _keys(cohort)
+    assert manifest.is_combined_valid('s1', data_key)
+    assert not manifest.is_fit_valid('s1', fit_key)
+
+
+def test_changed_scaffold_invalidates_the_fit(cohort):
+    cohort['scaffold_path'].write_text('another scaffold')
+    manifest = RunManifest(cohort['manifest_path'])
+    data_key, fit_key = _keys(cohort)
+    assert manifest.is_combined_valid('s1', data_key)
+    assert not manifest.is_fit_valid('s1', fit_key)
+
+
+def test_changed_data_file_invalidates_data_and_fit(cohort):
+    (cohort['subject_path'] / 'fissure.exdata').write_text('corrected fissure points')
+    manifest = RunManifest(cohort['manifest_path'])
+    data_key, fit_key = _keys(cohort)
+    assert not manifest.is_combined_valid('s1', data_key)
+    assert not manifest.is_fit_valid('s1', fit_key)
+
+
+def test_unmapped_data_file_is_ignored(cohort):
+    (cohort['subject_path'] / 'notes.exdata').write_text('not a group')
+    data_key, fit_key = _keys(cohort)
+    assert RunManifest(cohort['manifest_path']).is_fit_valid('s1', fit_key)
+
+
+def test_changed_group_mapping_invalidates_data_and_fit(cohort):
+    manifest = RunManifest(cohort['manifest_path'])
+    data_key, fit_key = _keys(cohort, dict(GROUPS, fissure='horizontal fissure'))
+    assert not manifest.is_combined_valid('s1', data_key)
+    assert not manifest.is_fit_valid('s1', fit_key)
+
+
+def test_decimation_and_output_policy_change_the_keys(cohort):
+    data_key, fit_key = _keys(cohort)
+    assert subject_data_key(cohort['subject_path'], GROUPS, decimation={'spacing': 1.0}) != data_key
+    assert subject_fit_key(data_key, 'scaffold', 'settings', {'steps': 'iterations', 'format': 'exf'}) == \
+        subject_fit_key(data_key, 'scaffold', 'settings')
+    assert subject_fit_key(data_key, 'scaffold', 'settings', {'steps': 'final', 'format': 'exf'}) != \
+        subject_fit_key(data_key, 'scaffold', 'settings')
+
+
+def test_missing_fit_directory_invalidates_the_fit(cohort):
+    cohort['fit_dir'].rmdir()
+    data_key, fit_key = _keys(cohort)
+    assert not RunManifest(cohort['manifest_path']).is_fit_valid('s1', fit_key)
+
+
+def test_update_combined_keeps_the_fit(cohort):
+    manifest = RunManifest(cohort['manifest_path'])
+    fit_key = manifest.get('s1')['fit_key']
+    manifest.update_combined('s1', 'other data')
+    manifest = RunManifest(cohort['manifest_path'])
+    assert manifest.is_combined_valid('s1', 'other data')
+    assert manifest.is_fit_valid('s1', fit_key)
+    assert manifest.get('s2') == dict()
@@ -0,0 +1,17 @@
+import inspect
+
+from batch_fit.pipeline import FitJob, combined_data_path, fit_subject
+
+
+def test_fit_job_matches_fit_subject():
+    parameters = inspect.signature(fit_subject).parameters
+    assert FitJob._fields == tuple(parameters)
+    for name, parameter in parameters.items():
+        if parameter.default is not inspect.Parameter.empty:
+            assert FitJob._field_defaults[name] == parameter.default
+
+
+def test_reduced_combined_data_path(tmp_path):
+    subject_path = tmp_path / 's1'
+    assert combined_data_path(subject_path) == subject_path / 's1_combined_lung_data.ex'
+    assert combined_data_path(subject_path, '-reduced') == subject_path / 's1_combined_lung_data-reduced.ex'
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pytest
+
+from batch_fit.point_cache import load_point_cache, source_signature, write_point_cache
+
+
+GROUPS = {'lung': 'right lung', 'fissure': 'oblique fissure'}
+DECIMATION = {'surface_spacing': 2.0, 'edge_spacing': 1.0}
+DATA = {'right lung': np.arange(12, dtype=np.float64).reshape(4, 3),
+        'oblique fissure': np.arange(6, dtype=np.float64).reshape(2, 3) + 100}
+
+
+@pytest.fixture
+def subject_path(tmp_path):
+    subject_path = tmp_path / 's1'
+    subject_path.mkdir()
+    (subject_path / 'lung.exdata').write_text('lung points')
+    (subject_path / 'fissure.exdata').write_text('fissure points')
+    write_point_cache(subject_path / 's1_combined_lung_data.ex', DATA,
+                      source_signature(subject_path, GROUPS, decimation=DECIMATION))
+    return subject_path
+
+
+def _load(subject_path, groups=GROUPS, decimation=DECIMATION):
+    return load_point_cache(subject_path / 's1_combined_lung_data.ex', groups, decimation=decimation)
+
+
+def test_unchanged_cache_is_loaded(subject_path):
+    points = _load(subject_path)
+    assert isinstance(points.coordinates, np.memmap)
+    assert points.labels == list(DATA)
+    np.testing.assert_array_equal(points.group('oblique fissure'), DATA['oblique fissure'])
+    assert points.label_array().tolist() == ['right lung'] * 4 + ['oblique fissure'] * 2
+
+
+def test_unmapped_source_does_not_change_the_signature(subject_path):
+    (subject_path / 'notes.exdata').write_text('not a group')
+    assert _load(subject_path) is not None
+
+
+def test_changed_source_rejects_the_cache(subject_path):
+    (subject_path / 'fissure.exdata').write_text('corrected fissure points')
+    assert _load(subject_path) is None
+    assert load_point_cache(subject_path / 's1_combined_lung_data.ex') is None
+
+
+def test_touched_source_rejects_the_cache(subject_path):
+    source = subject_path / 'lung.exdata'
+    stat = source.stat()
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert _load(subject_path) is None
+
+
+def test_removed_source_rejects_the_cache(subject_path):
+    (subject_path / 'lung.exdata').unlink()
+    assert _load(subject_path) is None
+    assert load_point_cache(subject_path / 's1_combined_lung_data.ex') is None
+
+
+def test_changed_group_mapping_rejects_the_cache(subject_path):
+    assert _load(subject_path, groups=dict(GROUPS, fissure='horizontal fissure')) is None
+
+
+def test_changed_decimation_rejects_the_cache(subject_path):
+    assert _load(subject_path, decimation=dict(DECIMATION, edge_spacing=0.5)) is None
+    assert _load(subject_path, decimation=None) is None
+
+
+def test_missing_cache(tmp_path):
+    assert load_point_cache(tmp_path / 's1_combined_lung_data.ex', GROUPS) is None
+
+
+def test_empty_cache(subject_path):
+    write_point_cache(subject_path / 's1_combined_lung_data.ex', dict(), source_signature(subject_path, GROUPS))
+    points = _load(subject_path, decimation=None)
+    assert points.coordinates.shape == (0, 3)
+    assert points.labels == list()
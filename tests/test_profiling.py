@@ -0,0 +1,26 @@
+from batch_fit.profiling import ProfileSettings, SubjectProfiler, merge_collapsed, profile_stage, write_cohort_report
+
+
+def _profile(directory, name, run_id):
+    profiler = SubjectProfiler(name, ProfileSettings(directory, sampling_interval=0.001, run_id=run_id))
+    with profile_stage(profiler, 'fit'):
+        sum(i * i for i in range(200000))
+    profiler.save()
+    return profiler
+
+
+def test_cohort_report_merges_only_the_run(tmp_path):
+    stale = _profile(tmp_path, 's1', 'earlier')
+    current = [_profile(tmp_path, 's1', 'current'), _profile(tmp_path, 's2/02', 'current')]
+    assert stale.profile_file.exists()
+
+    written = write_cohort_report(tmp_path, top=5, run_id='current')
+    report = written['hot_functions'].read_text()
+    assert 'cProfile of 2 subjects' in report
+    assert sum(merge_collapsed([written['collapsed']]).values()) == \
+        sum(merge_collapsed([profiler.collapsed_file for profiler in current]).values())
+
+
+def test_cohort_report_without_profiles_of_the_run(tmp_path):
+    _profile(tmp_path, 's1', 'earlier')
+    assert write_cohort_report(tmp_path, run_id='current') == dict()
@@ -0,0 +1,59 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from batch_fit import progress
+from batch_fit.progress import Histogram, ProgressMonitor
+
+
+METRICS_FILE = Path(__file__).parent / 'resources' / 'progress_metrics.prom'
+
+
+class _Clock:
+    now = 1000.0
+
+    @classmethod
+    def time(cls):
+        return cls.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    monkeypatch.setattr(progress, 'time', _Clock)
+    _Clock.now = 1000.0
+    return _Clock
+
+
+def test_histogram_buckets():
+    histogram = Histogram((1.0, 5.0, 15.0))
+    for value in (0.2, 1.0, 1.5, 5.0, 30.0, 40.0):
+        histogram.observe(value)
+    # upper bounds are inclusive, and larger values only count towards +Inf
+    assert histogram.to_dict() == {'count': 6, 'sum': 77.7, 'mean': 77.7 / 6,
+                                   'buckets': {'1': 2, '5': 4, '15': 4, '+Inf': 6}}
+    assert Histogram((0.5, 2.5)).to_dict() == {'count': 0, 'sum': 0.0, 'mean': None,
+                                               'buckets': {'0.5': 0, '2.5': 0, '+Inf': 0}}
+
+
+def test_prometheus_text(clock, tmp_path):
+    monitor = ProgressMonitor(4, status_file=tmp_path / 'status.json')
+    monitor.started('s1', worker=11)
+    monitor.started('s4/02', worker=12)
+    clock.now = 1005.0
+    monitor.finished('s1', {'wall_time': 5.0, 'stage_times': {'combine': 0.5, 'fit': 4.5},
+                            'steps': [{'type': '_FitterStepAlign', 'wall_time': 1.0},
+                                      {'type': '_FitterStepFit', 'wall_time': 1.5},
+                                      {'type': '_FitterStepFit', 'wall_time': 2.0}],
+                            'data_points': 1000, 'bytes_written': 2048})
+    monitor.skipped('s3')
+    monitor.failed('s2', 'time limit of 60 s exceeded')
+    clock.now = 1012.0
+
+    assert monitor.prometheus_text() == METRICS_FILE.read_text()
+
+    with open(tmp_path / 'status.json', 'r') as f:
+        status = json.load(f)
+    assert status['subjects'] == {'total': 4, 'done': 1, 'failed': 1, 'skipped': 1, 'running': 1, 'remaining': 1}
+    assert status['failed']['s2']['error'] == 'time limit of 60 s exceeded'
+    assert status['stages']['step FitterStepFit']['sum'] == 3.5
@@ -0,0 +1,43 @@
+import sqlite3
+
+from batch_fit.results import ResultsStore
+
+
+def _step(index, rms):
+    return {'step': index, 'type': '_FitterStepFit', 'iterations': 2, 'wall_time': 1.0, 'cpu_time': 1.0,
+            'peak_rss': 100.0, 'rms': rms, 'max_error': 2 * rms}
+
+
+def test_query_steps_of_latest_fit_without_steps(tmp_path):
+    store = ResultsStore(tmp_path / 'results.sqlite')
+    store.append('s1', {'lung': 1.0}, 1.0, max_error=2.0, setting_id='02', steps=[_step(1, 1.0), _step(2, 0.5)])
+    assert store.query_steps(setting_id='02')['rms'].tolist() == [1.0, 0.5]
+
+    store.append('s1', {'lung': 0.4}, 0.4, max_error=0.8, setting_id='02')
+    assert store.query_steps(setting_id='02').empty
+
+
+def test_query_steps_of_latest_fit(tmp_path):
+    store = ResultsStore(tmp_path / 'results.sqlite')
+    store.append('s1', {'lung': 1.0}, 1.0, setting_id='02', steps=[_step(1, 1.0)])
+    store.append('s1', {'lung': 0.4}, 0.4, setting_id='02', steps=[_step(1, 0.4), _step(2, 0.3)])
+    store.append('s2', {'lung': 0.7}, 0.7, setting_id='02', steps=[_step(1, 0.7)])
+    store.append_failure('s2', 'time_limit', setting_id='02', steps=[_step(1, 9.0)])
+
+    steps = store.query_steps(setting_id='02')
+    assert steps[steps['subject'] == 's1']['rms'].tolist() == [0.4, 0.3]
+    assert steps[steps['subject'] == 's2']['rms'].tolist() == [0.7]
+
+
+def test_append_once(tmp_path):
+    store = ResultsStore(tmp_path / 'results.sqlite')
+    assert store.append('s1', {'lung': 1.0}, 1.0, setting_id='02', input_hashes={'fit': 'a'}, once=True)
+    assert not store.append('s1', {'lung': 0.9}, 0.9, setting_id='02', input_hashes={'fit': 'a'}, once=True)
+    assert store.append('s1', {'lung': 0.8}, 0.8, setting_id='03', input_hashes={'fit': 'a'}, once=True)
+    assert store.append('s1', {'lung': 0.7}, 0.7, setting_id='02', input_hashes={'fit': 'b'}, once=True)
+    assert store.append('s1', {'lung': 0.6}, 0.6, setting_id='02', input_hashes={'fit': 'b'})
+    connection = sqlite3.connect(str(tmp_path / 'results.sqlite'))
+    try:
+        assert connection.execute("SELECT COUNT(*) FROM results WHERE group_name = 'total'").fetchone()[0] == 4
+    finally:
+        connection.close()
@@ -0,0 +1,107 @@
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pytest
+
+from batch_fit.pipeline import read_step_events
+from batch_fit.results import ResultsStore
+from batch_fit.scheduler import JobResult, peak_rss_mb, peak_rss_since_reset_mb, process_rss_mb, reset_peak_rss, \
+    run_parallel
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def _allocate(size_mb, seconds):
+    block = np.ones(int(size_mb * 1024 * 1024 // 8))
+    time.sleep(seconds)
+    return float(block[-1])
+
+
+def _fit_steps(output_fit_dir, count):
+    # the events BatchFit writes as its steps complete, then a step cut short by the process being stopped
+    with open(output_fit_dir / 'steps.jsonl', 'a') as f:
+        for index in range(1, count + 1):
+            f.write(json.dumps({'step': index, 'type': '_FitterStepFit', 'iterations': 2, 'wall_time': 1.0,
+                                'cpu_time': 1.0, 'peak_rss': 100.0, 'rms': 1.0 / index, 'max_error': 2.0}) + '\n')
+        f.write('{"step": ')
+    time.sleep(60.0)
+
+
+def _run(function, jobs, **kwargs):
+    start = time.monotonic()
+    results = {result.name: result for result in run_parallel(function, jobs, 2, poll_interval=0.1, **kwargs)}
+    return results, time.monotonic() - start
+
+
+def test_jobs_run_in_worker_processes():
+    results, _ = _run(os.getpid, {'a': (), 'b': ()})
+    assert results['a'].value != os.getpid() and results['b'].value != os.getpid()
+    assert all(result.error is None and result.limit is None for result in results.values())
+
+    results, _ = _run(_sleep, {'fails': ('not a number',)})
+    assert results['fails'].value is None
+    assert 'TypeError' in results['fails'].error
+
+
+def test_time_limit_stops_the_job():
+    results, elapsed = _run(_sleep, {'slow': (60.0,), 'quick': (0.1,)}, time_limit=1.0)
+    assert elapsed < 10.0
+    assert results['quick'] == JobResult('quick', 0.1, None)
+    assert results['slow'].value is None
+    assert results['slow'].limit == 'time'
+    assert 'time limit' in results['slow'].error
+
+
+def test_memory_limit_stops_the_job():
+    baseline = process_rss_mb(os.getpid())
+    if baseline is None:
+        pytest.skip('the RSS of other processes is not reported on this platform')
+    # forked workers start with the RSS of this process
+    results, elapsed = _run(_allocate, {'large': (400, 60.0), 'small': (1, 0.1)}, memory_limit=baseline + 200)
+    assert elapsed < 10.0
+    assert results['small'].error is None and results['small'].value == 1.0
+    assert results['large'].value is None
+    assert results['large'].limit == 'memory'
+    assert 'memory limit' in results['large'].error
+
+
+def test_stopped_job_keeps_its_completed_steps(tmp_path):
+    results, _ = _run(_fit_steps, {'s1': (tmp_path, 2)}, time_limit=1.0)
+    assert results['s1'].limit == 'time'
+
+    # as recorded for a stopped fit by main.record_stopped
+    steps = read_step_events(tmp_path)
+    assert [step['step'] for step in steps] == [1, 2]
+    store = ResultsStore(tmp_path / 'results.sqlite')
+    store.append_failure('s1', results['s1'].limit, results['s1'].error, setting_id='02', steps=steps)
+    assert store.query(setting_id='02').empty
+    assert store.query_steps(setting_id='02').empty
+    connection = sqlite3.connect(str(tmp_path / 'results.sqlite'))
+    try:
+        assert connection.execute('SELECT subject, reason FROM failures').fetchall() == [('s1', 'time')]
+        assert connection.execute('SELECT step, rms FROM steps WHERE result_id IS NULL').fetchall() == \
+            [(1, 1.0), (2, 0.5)]
+    finally:
+        connection.close()
+
+
+def test_peak_rss_since_reset():
+    if not reset_peak_rss():
+        pytest.skip('the peak RSS cannot be reset on this platform')
+    baseline = peak_rss_since_reset_mb()
+    block = np.ones(200 * 1024 * 1024 // 8)
+    del block
+    peak = peak_rss_since_reset_mb()
+    assert peak > baseline + 150
+
+    # the next step starts from the current RSS, while the process peak is kept
+    assert reset_peak_rss()
+    assert peak_rss_since_reset_mb() < peak - 150
+    assert peak_rss_since_reset_mb() >= process_rss_mb(os.getpid()) - 1
+    assert peak_rss_mb() >= peak
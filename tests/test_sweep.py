@@ -0,0 +1,72 @@
+import json
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from batch_fit.sweep import rank_settings, sweep_points, write_reduced_settings, write_sweep_settings
+
+
+SETTING_FILE = Path(__file__).parent.parent / 'fit_settings' / 'settings_02.json'
+
+
+def _fit_steps(setting_file):
+    with open(setting_file, 'r') as f:
+        return [step for step in json.load(f)['fitterSteps'] if step.get('_FitterStepFit')]
+
+
+def test_grid_expands_to_setting_files(tmp_path):
+    sweep = {'mode': 'grid', 'strain_penalty_scale': [0.5, 2.0], 'curvature_penalty_scale': [1.0],
+             'iterations': [3, 10]}
+    setting_files = write_sweep_settings(SETTING_FILE, '02', sweep, tmp_path)
+
+    assert list(setting_files) == ['02-sp0.5-cp1-it3', '02-sp0.5-cp1-it10', '02-sp2-cp1-it3', '02-sp2-cp1-it10']
+    assert sorted(path.name for path in tmp_path.iterdir()) == \
+        sorted(f'settings_{setting_id}.json' for setting_id in setting_files)
+
+    base_steps = _fit_steps(SETTING_FILE)
+    steps = _fit_steps(setting_files['02-sp2-cp1-it3'])
+    assert [step['numberOfIterations'] for step in steps] == [3] * len(base_steps)
+    for base_step, step in zip(base_steps, steps):
+        for group_name, group_settings in base_step['groupSettings'].items():
+            if 'strainPenalty' in group_settings:
+                assert step['groupSettings'][group_name]['strainPenalty'] == \
+                    [2.0 * value for value in group_settings['strainPenalty']]
+            if 'curvaturePenalty' in group_settings:
+                assert step['groupSettings'][group_name]['curvaturePenalty'] == group_settings['curvaturePenalty']
+
+
+def test_empty_lists_keep_the_base_settings(tmp_path):
+    setting_files = write_sweep_settings(SETTING_FILE, '02', {'strain_penalty_scale': [], 'iterations': None}, tmp_path)
+    assert list(setting_files) == ['02']
+    assert _fit_steps(setting_files['02']) == _fit_steps(SETTING_FILE)
+
+
+def test_random_points_are_distinct_and_seeded():
+    sweep = {'mode': 'random', 'samples': 20, 'seed': 3, 'strain_penalty_scale': [0.5, 1.0, 2.0],
+             'curvature_penalty_scale': [0.5, 1.0], 'iterations': []}
+    points = sweep_points(sweep)
+    assert 0 < len(points) <= 6
+    assert len({tuple(point.values()) for point in points}) == len(points)
+    assert points == sweep_points(sweep)
+    with pytest.raises(ValueError):
+        sweep_points({'mode': 'latin'})
+
+
+def test_reduced_settings(tmp_path):
+    reduced = _fit_steps(write_reduced_settings(SETTING_FILE, 0.5, tmp_path / 'settings_02-reduced.json'))
+    assert [step['numberOfIterations'] for step in reduced] == \
+        [max(1, int(round(step['numberOfIterations'] * 0.5))) for step in _fit_steps(SETTING_FILE)]
+
+
+def test_rank_settings():
+    results = pd.DataFrame({'subject': ['s1', 's2', 's1', 's2', 's1', 's2', 's1', 's2'],
+                            'group_name': ['lung', 'lung', 'total', 'total'] * 2,
+                            'setting_id': ['02-sp0.5'] * 4 + ['02-sp2'] * 4,
+                            'rms': [1.0, 3.0, 2.0, 4.0, 2.5, 2.5, 1.0, 1.0]})
+    ranking = rank_settings(results)
+    assert ranking.loc['lung', 'best_setting'] == '02-sp0.5'
+    assert ranking.loc['lung', 'best_rms'] == 2.0
+    assert ranking.loc['total', 'best_setting'] == '02-sp2'
+    assert ranking.loc['total', 'best_rms'] == 1.0
+    assert list(ranking.columns) == ['best_setting', 'best_rms', '02-sp0.5', '02-sp2']
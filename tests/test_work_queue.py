@@ -0,0 +1,150 @@
+import os
+import time
+
+import pytest
+
+from batch_fit.results import ResultsStore
+from batch_fit.work_queue import WorkQueue, publish_directory
+
+
+KEY = 'a' * 64
+
+
+@pytest.fixture
+def queues(tmp_path):
+    return (WorkQueue(tmp_path / 'queue', lease_seconds=60.0, worker_id='worker-1'),
+            WorkQueue(tmp_path / 'queue', lease_seconds=60.0, worker_id='worker-2'))
+
+
+def _age_leases(tmp_path, seconds=120.0):
+    # a lease not renewed for longer than lease_seconds, as left by a dead worker
+    stale = time.time() - seconds
+    for lease_path in (tmp_path / 'queue' / 'leases').glob('*.lease'):
+        os.utime(lease_path, (stale, stale))
+
+
+def _fit_dir(tmp_path, worker_id):
+    fit_dir = tmp_path / 'fit_files' / f'.s1.{worker_id}'
+    fit_dir.mkdir(parents=True)
+    (fit_dir / 'fit_1_fit5.exf').write_text(worker_id)
+    return fit_dir
+
+
+def test_claims_are_exclusive(queues):
+    first, second = queues
+    assert first.claim('s1', KEY)
+    assert not second.claim('s1', KEY)
+    assert not first.claim('s1', KEY)
+    assert first.holds('s1', KEY) and not second.holds('s1', KEY)
+    assert second.claim('s2', KEY)
+    assert second.claim('s1', 'b' * 64)
+
+
+def test_live_lease_is_not_taken_over(tmp_path, queues):
+    first, second = queues
+    assert first.claim('s1', KEY)
+    _age_leases(tmp_path, seconds=30.0)
+    assert not second.claim('s1', KEY)
+    assert first.holds('s1', KEY)
+
+
+def test_stale_lease_is_taken_over(tmp_path, queues):
+    first, second = queues
+    assert first.claim('s1', KEY)
+    _age_leases(tmp_path)
+    assert second.claim('s1', KEY)
+    assert second.holds('s1', KEY)
+    assert not first.holds('s1', KEY)
+    assert [path.name for path in (tmp_path / 'queue' / 'leases').iterdir()] == [f's1.{KEY[:16]}.lease']
+
+
+def test_heartbeat_renews_held_leases(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue', lease_seconds=0.3, worker_id='worker-1')
+    assert queue.claim('s1', KEY)
+    queue.start_heartbeat()
+    try:
+        time.sleep(0.6)
+        assert not WorkQueue(tmp_path / 'queue', lease_seconds=0.3, worker_id='worker-2').claim('s1', KEY)
+    finally:
+        queue.stop_heartbeat()
+
+
+def test_workers_share_the_run_id(tmp_path, queues):
+    first, second = queues
+    run_id = first.run_id()
+    assert second.run_id() == run_id == first.run_id()
+    assert WorkQueue(tmp_path / 'queue', worker_id='worker-3').run_id() == run_id
+    assert WorkQueue(tmp_path / 'other_queue', worker_id='worker-1').run_id() != run_id
+    assert sorted(path.name for path in (tmp_path / 'queue').iterdir()) == ['done', 'failed', 'leases', 'run_id']
+
+
+def test_finished_key_is_never_claimed_again(tmp_path, queues):
+    first, second = queues
+    assert first.claim('s1', KEY)
+    assert first.complete('s1', KEY, {'total_rms': 1.0})
+    assert not first.claim('s1', KEY)
+    assert not second.claim('s1', KEY)
+    _age_leases(tmp_path)
+    assert not second.claim('s1', KEY)
+    assert not second.complete('s1', KEY, {'total_rms': 2.0})
+
+    assert second.claim('s2', KEY)
+    second.fail('s2', KEY, 'time limit exceeded')
+    assert first.is_finished('s2', KEY)
+    assert not first.claim('s2', KEY)
+
+
+def _record(store, rms, fit_key=KEY):
+    return lambda: store.append('s1', {'lung': rms}, rms, setting_id='02', input_hashes={'fit': fit_key}, once=True)
+
+
+def test_fit_is_published_once_after_takeover(tmp_path, queues):
+    first, second = queues
+    store = ResultsStore(tmp_path / 'results.sqlite')
+    destination = tmp_path / 'fit_files' / 's1'
+    assert first.claim('s1', KEY)
+    first_fit = _fit_dir(tmp_path, 'worker-1')
+
+    # the first worker stalls past its lease, the second takes the subject over and finishes first
+    _age_leases(tmp_path)
+    assert second.claim('s1', KEY)
+    second_fit = _fit_dir(tmp_path, 'worker-2')
+    assert second.publish('s1', KEY, {'total_rms': 0.5}, second_fit, destination, _record(store, 0.5))
+
+    assert not first.publish('s1', KEY, {'total_rms': 0.7}, first_fit, destination, _record(store, 0.7))
+    assert not first_fit.exists()
+    assert (destination / 'fit_1_fit5.exf').read_text() == 'worker-2'
+    assert store.query(setting_id='02')['rms'].tolist() == [0.5, 0.5]
+    assert first.is_finished('s1', KEY)
+
+
+def test_worker_dying_before_done_leaves_the_subject_due(tmp_path, queues):
+    first, second = queues
+    store = ResultsStore(tmp_path / 'results.sqlite')
+    destination = tmp_path / 'fit_files' / 's1'
+    assert first.claim('s1', KEY)
+
+    def record_and_die():
+        _record(store, 0.5)()
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        first.publish('s1', KEY, {'total_rms': 0.5}, _fit_dir(tmp_path, 'worker-1'), destination, record_and_die)
+    assert not first.is_finished('s1', KEY)
+
+    # the subject is fitted again once the lease is stale, and its result is not stored a second time
+    _age_leases(tmp_path)
+    assert second.claim('s1', KEY)
+    assert second.publish('s1', KEY, {'total_rms': 0.5}, _fit_dir(tmp_path, 'worker-2'), destination,
+                          _record(store, 0.5))
+    assert second.is_finished('s1', KEY)
+    assert (destination / 'fit_1_fit5.exf').read_text() == 'worker-2'
+    assert len(store.query(setting_id='02')) == 2
+
+
+def test_publish_directory_replaces_the_earlier_fit(tmp_path):
+    destination = tmp_path / 'fit_files' / 's1'
+    publish_directory(_fit_dir(tmp_path, 'worker-1'), destination)
+    publish_directory(_fit_dir(tmp_path, 'worker-2'), destination)
+    assert [path.name for path in (tmp_path / 'fit_files').iterdir()] == ['s1']
+    assert (destination / 'fit_1_fit5.exf').read_text() == 'worker-2'